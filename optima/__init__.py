@@ -84,7 +84,7 @@ del blank_function, sc_fileio
 from .colortools import *
 
 # Optimization algorithm
-from .asd import asd
+from .asd import asd, serialevaluator
 
 # Interpolation
 from .pchip import pchip, plotpchip
@@ -141,7 +141,7 @@ from .fileio import * # CK: may want to tidy up
 from .settings import *
 
 # Generate results -- import first because parameters use results
-from .results import Result, Resultset, Multiresultset, BOC, ICER, getresults
+from .results import Result, Resultset, Multiresultset, Mappedarray, Mappedraw, clearrawcache, BOC, ICER, getresults, calcdalys, getobjectiveoutcomes, objectiveoutcomekeys
 
 # Define the model parameters -- import before makespreadsheet because makespreadsheet uses partable to make a pre-filled spreadsheet
 from .parameters import * # Parameter and Parameterset classes and methods
@@ -154,6 +154,7 @@ except Exception as E: _failed.append('makespreadsheet: %s' % repr(E))
 from .loadspreadsheet import *
 
 # Define and run the model
+from .modelkernels import * # Optional compiled kernels for the model
 from .model import *
 
 # Define the programs and cost functions
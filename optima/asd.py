@@ -3,12 +3,12 @@ import numpy.random as nr
 from time import time
 import optima as op
 
-__all__ = ['asd']
+__all__ = ['asd', 'serialevaluator']
 
 def asd(function, x, args=None, stepsize=0.1, sinc=2, sdec=2, pinc=2, pdec=2,
     pinitial=None, sinitial=None, xmin=None, xmax=None, maxiters=None, maxtime=None, 
     finishtime=None, abstol=1e-6, reltol=1e-3, stalliters=None, stoppingfunc=None,
-    randseed=None, label=None, verbose=2, **kwargs):
+    randseed=None, label=None, verbose=2, popsize=None, evaluator=None, progressfunc=None, checkpoint=None, resumestate=None, **kwargs):
     """
     Optimization using adaptive stochastic descent (ASD).
     
@@ -28,16 +28,29 @@ def asd(function, x, args=None, stepsize=0.1, sinc=2, sdec=2, pinc=2, pdec=2,
       sinitial       None    Set initial step sizes; if empty, calculated from stepsize instead
       xmin           None    Min value allowed for each parameter  
       xmax           None    Max value allowed for each parameter 
-      maxiters       1000    Maximum number of iterations (1 iteration = 1 function evaluation)
+      maxiters       1000    Maximum number of iterations (1 iteration = popsize function evaluations)
       maxtime        3600    Maximum time allowed, in seconds
       finishtime     None    Time (given by time() in seconds) after which the calculation will halt
       abstol         1e-6    Minimum absolute change in objective function
       reltol         1e-3    Minimum relative change in objective function
-      stalliters     10*n    Number of iterations over which to calculate TolFun (n = number of parameters)
+      stalliters     10*n/k  Number of iterations over which to calculate TolFun (n = number of parameters, k = popsize)
       stoppingfunc   None    External method that can be used to stop the calculation from the outside.
       randseed       None    The random seed to use
       verbose        2       How much information to print during the run
       label          None    A label to use to annotate the output
+      popsize        1       Number of candidate steps to try on each iteration
+      evaluator      None    Function evaluator(function, xlist, args) returning the objective for each candidate; serial by default
+      progressfunc   None    External method called after each iteration with an objdict of the progress: iteration, maxiters, fval, fvalorig, elapsed, x and label
+      checkpoint     None    External method called with an objdict of the state after each iteration and when finishing (its arrays may be views, so save it straight away)
+      resumestate    None    A state given to checkpoint, to continue from instead of starting again
+    
+    A state has done=True if the run has finished, in which case resuming from it just returns the output; runs stopped
+    by the finish time or the stopping function can be continued. The random state is part of the state, so a resumed run
+    takes the same steps as an uninterrupted one.
+    
+    With popsize>1, each iteration draws popsize steps from the same probabilities and step sizes, evaluates them
+    together using the evaluator (e.g. in a process pool, or by running a batch of models at once), updates the
+    probabilities and step sizes from all of them, and keeps the best one if it's an improvement.
      
     asd() returns an objdict (which can be accessed by index, key, or attribute)
     with the following items:
@@ -60,7 +73,7 @@ def asd(function, x, args=None, stepsize=0.1, sinc=2, sdec=2, pinc=2, pdec=2,
         Optimization by adaptive stochastic descent. 
         PloS ONE 13 (3), e0192944.
     
-    Version: 2019jul08
+    Version: 2026oct18
     """
     if randseed is not None:
         nr.seed(int(randseed)) # Don't reset it if not supplied
@@ -117,7 +130,12 @@ def asd(function, x, args=None, stepsize=0.1, sinc=2, sdec=2, pinc=2, pdec=2,
         errormsg = 'ASD: At least one value in the vector of starting points is NaN:\n%s' % x
         raise Exception(errormsg)
     if label is None: label = ''
-    if stalliters is None: stalliters = 10 * nparams # By default, try 10 times per parameter on average
+    if popsize is None: popsize = 1
+    popsize = int(popsize)
+    if popsize<1:
+        print('ASD: popsize cannot be less than 1; resetting to 1'); popsize = 1
+    if evaluator is None: evaluator = serialevaluator
+    if stalliters is None: stalliters = np.ceil(10 * nparams / popsize) # By default, try 10 times per parameter on average
     stalliters = int(stalliters)
     maxiters = int(maxiters)
 
@@ -125,9 +143,15 @@ def asd(function, x, args=None, stepsize=0.1, sinc=2, sdec=2, pinc=2, pdec=2,
     if all(stepsizes == 0): stepsizes += stepsize # Handle the case where all step sizes are 0
     if any(stepsizes == 0): stepsizes[stepsizes == 0] = np.mean(stepsizes[stepsizes != 0]) # Replace step sizes of zeros with the mean of non-zero entries
     if args is None: args = {} # Reset if no function arguments supplied
-    fval = function(x, **args) # Calculate initial value of the objective function
-    fvalorig = fval # Store the original value of the objective function, since fval is overwritten on each step
-    xorig = op.dcp(x) # Keep the original x, just in case
+    if resumestate is None:
+        fval = function(x, **args) # Calculate initial value of the objective function
+        fvalorig = fval # Store the original value of the objective function, since fval is overwritten on each step
+        xorig = op.dcp(x) # Keep the original x, just in case
+    else:
+        if len(resumestate.x) != nparams:
+            errormsg = 'ASD: Cannot resume from a state with %i parameters, since there are %i' % (len(resumestate.x), nparams)
+            raise Exception(errormsg)
+        fval, fvalorig, xorig = resumestate.fval, resumestate.fvalorig, op.dcp(resumestate.xorig)
 
     # Initialize history
     abserrorhistory = np.zeros(stalliters) # Store previous error changes
@@ -143,39 +167,72 @@ def asd(function, x, args=None, stepsize=0.1, sinc=2, sdec=2, pinc=2, pdec=2,
     count = 0 # Keep track of how many iterations have occurred
     offset = ' ' * 4 # Offset the print statements
     exitreason = 'Unknown exit reason' # Catch everything else
-    while True:
+    resumable = False # Whether the run was stopped early, so it can be continued
+    if resumestate is not None: # Continue from where the last run stopped
+        count = min(resumestate.count, maxiters)
+        x = op.dcp(resumestate.x)
+        fvals[:count+1] = resumestate.fvals[:count+1]
+        allsteps[:count+1, :] = resumestate.allsteps[:count+1, :]
+        probabilities, stepsizes = op.dcp(resumestate.probabilities), op.dcp(resumestate.stepsizes)
+        if len(resumestate.abserrorhistory) == stalliters:
+            abserrorhistory, relerrorhistory = op.dcp(resumestate.abserrorhistory), op.dcp(resumestate.relerrorhistory)
+        nr.set_state(resumestate.randstate)
+        start -= resumestate.elapsed
+        exitreason = resumestate.exitreason
+        if verbose >= 2: print(offset + label + ' resuming from step %i (%0.1f s)' % (count, resumestate.elapsed))
+
+    def getstate(done=False, stopped=False):
+        ''' Everything needed to carry on from this point '''
+        return objdict(done=done, stopped=stopped, exitreason=exitreason, count=count, x=x, fval=fval, fvalorig=fvalorig, xorig=xorig,
+                       probabilities=probabilities, stepsizes=stepsizes, fvals=fvals[:count+1], allsteps=allsteps[:count+1, :],
+                       abserrorhistory=abserrorhistory, relerrorhistory=relerrorhistory, randstate=nr.get_state(), elapsed=time()-start)
+
+    while not (resumestate is not None and resumestate.done):
         # Check for finishtime at the start of the loop to speed up exiting
         if time() > finishtime:
             exitreason = f'Finish time reached. Ran for {op.sigfig(time() - start)} seconds'
+            resumable = True
             break
 
         count += 1 # Increment the count
         if verbose == 1: print(offset + label + 'Iteration %i; elapsed %0.1f s; objective: %0.3e' % (count, time() - start, fval)) # For more verbose, use other print statement below
         if verbose >= 4: print('\n\n Count=%i \n x=%s \n probabilities=%s \n stepsizes=%s' % (count, x, probabilities, stepsizes))
         
-        # Calculate next parameters
+        # Calculate next parameters -- one candidate step for each member of the population
         probabilities = probabilities / sum(probabilities) # Normalize probabilities
         cumprobs = np.cumsum(probabilities) # Calculate the cumulative distribution
-        inrange = False
-        for r in range(maxrangeiters): # Try to find parameters within range
-            choice = np.flatnonzero(cumprobs > nr.random())[0] # Choose a parameter and upper/lower at random
-            par = np.mod(choice, nparams) # Which parameter was chosen
-            pm = np.floor((choice) / nparams) # Plus or minus
-            newval = x[par] + ((-1)**pm) * stepsizes[choice] # Calculate the new vector
-            if newval<xmin[par]: newval = xmin[par] # Reset to the lower limit
-            if newval>xmax[par]: newval = xmax[par] # Reset to the upper limit
-            inrange = (newval != x[par])
-            if verbose >= 4: print(offset*2 + 'count=%i r=%s, choice=%s, par=%s, x[par]=%s, pm=%s, step=%s, newval=%s, xmin=%s, xmax=%s, inrange=%s' % (count, r, choice, par, x[par], (-1)**pm, stepsizes[choice], newval, xmin[par], xmax[par], inrange))
-            if inrange: # Proceed as long as they're not equal
-                break
-        if not inrange: # Treat it as a failure if a value in range can't be found
-            probabilities[choice] = probabilities[choice] / pdec
-            stepsizes[choice] = stepsizes[choice] / sdec
-
-        # Calculate the new value 
-        xnew = op.dcp(x) # Initialize the new parameter set
-        xnew[par] = newval # Update the new parameter set
-        fvalnew = function(xnew, **args) # Calculate the objective function for the new parameter set
+        choices = np.zeros(popsize, dtype=int)
+        xnews = []
+        for k in range(popsize):
+            inrange = False
+            for r in range(maxrangeiters): # Try to find parameters within range
+                choice = np.flatnonzero(cumprobs > nr.random())[0] # Choose a parameter and upper/lower at random
+                par = np.mod(choice, nparams) # Which parameter was chosen
+                pm = np.floor((choice) / nparams) # Plus or minus
+                newval = x[par] + ((-1)**pm) * stepsizes[choice] # Calculate the new vector
+                if newval<xmin[par]: newval = xmin[par] # Reset to the lower limit
+                if newval>xmax[par]: newval = xmax[par] # Reset to the upper limit
+                inrange = (newval != x[par])
+                if verbose >= 4: print(offset*2 + 'count=%i r=%s, choice=%s, par=%s, x[par]=%s, pm=%s, step=%s, newval=%s, xmin=%s, xmax=%s, inrange=%s' % (count, r, choice, par, x[par], (-1)**pm, stepsizes[choice], newval, xmin[par], xmax[par], inrange))
+                if inrange: # Proceed as long as they're not equal
+                    break
+            if not inrange: # Treat it as a failure if a value in range can't be found
+                probabilities[choice] = probabilities[choice] / pdec
+                stepsizes[choice] = stepsizes[choice] / sdec
+            xnew = op.dcp(x) # Initialize the new parameter set
+            xnew[par] = newval # Update the new parameter set
+            choices[k] = choice
+            xnews.append(xnew)
+
+        # Calculate the new values, and pick the best candidate
+        fvalnews = evaluator(function, xnews, args) # Calculate the objective function for each new parameter set
+        if popsize>1 and not all(np.isnan(fvalnews)): best = np.nanargmin(fvalnews)
+        else:                                         best = 0
+        choice = choices[best]
+        par = np.mod(choice, nparams)
+        pm = np.floor((choice) / nparams)
+        xnew = xnews[best]
+        fvalnew = fvalnews[best]
         eps = 1e-12 # Small value to avoid divide-by-zero errors
         if abs(fvalnew)<eps and abs(fval)<eps: ratio = 1 # They're both zero: set the ratio to 1
         elif abs(fvalnew)<eps:                 ratio = 1.0/eps # Only the denominator is zero: reset to the maximum ratio
@@ -184,25 +241,30 @@ def asd(function, x, args=None, stepsize=0.1, sinc=2, sdec=2, pinc=2, pdec=2,
         relerrorhistory[np.mod(count, stalliters)] = max(0, ratio-1.0) # Keep track of improvements in the error
         if verbose >= 3: print(offset + 'step=%i choice=%s, par=%s, pm=%s, origval=%s, newval=%s' % (count, choice, par, pm, x[par], xnew[par]))
 
-        # Check if this step was an improvement
+        # Update the probabilities and step sizes from every candidate, then check if this step was an improvement
         fvalold = fval # Store old fval
-        if fvalnew < fvalold: # New parameter set is better than previous one
-            probabilities[choice] = probabilities[choice] * pinc # Increase probability of picking this parameter again
-            stepsizes[choice] = stepsizes[choice] * sinc # Increase size of step for next time
+        for k in range(popsize):
+            if fvalnews[k] < fvalold: # New parameter set is better than previous one
+                probabilities[choices[k]] = probabilities[choices[k]] * pinc # Increase probability of picking this parameter again
+                stepsizes[choices[k]] = stepsizes[choices[k]] * sinc # Increase size of step for next time
+            else: # New parameter set is the same or worse than the previous one
+                probabilities[choices[k]] = probabilities[choices[k]] / pdec # Decrease probability of picking this parameter again
+                stepsizes[choices[k]] = stepsizes[choices[k]] / sdec # Decrease size of step for next time
+                if np.isnan(fvalnews[k]):
+                    if verbose >= 1: print('ASD: Warning, objective function returned NaN')
+        if fvalnew < fvalold: # Best new parameter set is better than previous one
             x = xnew # Reset current parameters
             fval = fvalnew # Reset current error
             flag = '++' # Marks an improvement
-        else: # New parameter set is the same or worse than the previous one
-            probabilities[choice] = probabilities[choice] / pdec # Decrease probability of picking this parameter again
-            stepsizes[choice] = stepsizes[choice] / sdec # Decrease size of step for next time
+        else:
             flag = '--' # Marks no change
-            if np.isnan(fvalnew):
-                if verbose >= 1: print('ASD: Warning, objective function returned NaN')
         if verbose >= 2: print(offset + label + ' step %i (%0.1f s) %s (orig: %s | best:%s | new:%s | diff:%s)' % ((count, time() - start, flag) + op.sigfig([fvalorig, fvalold, fvalnew, fvalnew - fvalold])))
 
         # Store output information
         fvals[count] = fval # Store objective function evaluations
         allsteps[count, :] = x # Store parameters
+        if checkpoint: checkpoint(getstate())
+        if progressfunc: progressfunc(objdict(iteration=count, maxiters=maxiters, fval=fval, fvalorig=fvalorig, elapsed=time()-start, x=np.reshape(x, origshape), label=label))
 
         # Stopping criteria
         if count >= maxiters: # Stop if the iteration limit is exceeded
@@ -213,6 +275,7 @@ def asd(function, x, args=None, stepsize=0.1, sinc=2, sdec=2, pinc=2, pdec=2,
             break
         if time() > finishtime:
             exitreason = f'Finish time reached. Ran for {op.sigfig(time() - start)} seconds'
+            resumable = True
             break
         if (count > stalliters) and (abs(np.mean(abserrorhistory)) < abstol): # Stop if improvement is too small
             exitreason = 'Absolute improvement too small (%s < %s)' % op.sigfig([np.mean(abserrorhistory), abstol])
@@ -222,9 +285,12 @@ def asd(function, x, args=None, stepsize=0.1, sinc=2, sdec=2, pinc=2, pdec=2,
             break
         if stoppingfunc and stoppingfunc():
             exitreason = 'Stopping function called'
+            resumable = True
             break
 
     # Return
+    state = getstate(done=not resumable, stopped=True)
+    if checkpoint: checkpoint(state)
     if verbose >= 2: print('=== %s %s (%i steps, orig: %s | best: %s | ratio: %s) ===' % ((label, exitreason, count) + op.sigfig([fvals[0], fvals[count], fvals[count] / fvals[0]])))
     output = objdict()
     output['x'] = np.reshape(x, origshape) # Parameters
@@ -235,9 +301,15 @@ def asd(function, x, args=None, stepsize=0.1, sinc=2, sdec=2, pinc=2, pdec=2,
     output['details']['xvals'] = allsteps[:count+1, :]
     output['details']['probabilities'] = probabilities
     output['details']['stepsizes'] = stepsizes
+    output['details']['state'] = state # To resume from
     return output # Return parameter vector as well as details about run
 
 
+def serialevaluator(function, xlist, args):
+    ''' Default evaluator for asd(): calculate the objective function for each parameter set in turn '''
+    return [function(x, **args) for x in xlist]
+
+
 class objdict(op.odict):
     ''' Exactly the same as an odict, but allows keys to be retrieved by object notiation '''
     def __getattribute__(self, attr):
@@ -13,6 +13,9 @@ xlrd.xlsx.ensure_elementtree_imported(False, None)
 xlrd.xlsx.Element_has_iter = True
 from xlrd import open_workbook
 import os
+import mmap as globalmmap # Since loadbinary() has an mmap argument
+import struct
+import zlib
 import optima as op
 
 # Handle types and Python 2/3 compatibility
@@ -33,6 +36,9 @@ __all__ = [
     'loaddatapars',
     'dumpstr',
     'loadstr',
+    'savebinary',
+    'loadbinary',
+    'isbinaryfile',
 ]
 
 #############################################################################################################################
@@ -117,6 +123,134 @@ def loadpickle(fileobj, verbose=False):
     return obj
 
 
+#############################################################################################################################
+### Binary format
+#############################################################################################################################
+
+# A binary file is: the magic bytes; the arrays, each aligned to binaryalign bytes; the pickled object with the arrays
+# taken out; the header (a pickled dict of where everything is); and the position of the header and the magic bytes again.
+binarymagic = b'OPTIMAB1'
+binaryalign = 64 # So that arrays are aligned in memory when the file is mapped
+binaryminsize = 4096 # Arrays smaller than this (in bytes) are left in the pickle, since it's not worth it
+binarycompressions = [None, 'zlib', 'zstd', 'lz4']
+
+
+def compressbuffer(data, compression=None):
+    if compression is None:     return data
+    elif compression == 'zlib': return zlib.compress(data, 1)
+    elif compression == 'zstd':
+        import zstandard # Optional: only needed for this compression
+        return zstandard.ZstdCompressor(level=1).compress(data)
+    elif compression == 'lz4':
+        import lz4.frame # Optional: only needed for this compression
+        return lz4.frame.compress(data)
+    else:
+        errormsg = 'Compression "%s" not recognized; choices are: %s' % (compression, binarycompressions)
+        raise OptimaException(errormsg)
+
+
+def decompressbuffer(data, compression=None):
+    if compression is None:     return data
+    elif compression == 'zlib': return bytearray(zlib.decompress(data))
+    elif compression == 'zstd':
+        import zstandard
+        return bytearray(zstandard.ZstdDecompressor().decompress(data))
+    elif compression == 'lz4':
+        import lz4.frame
+        return bytearray(lz4.frame.decompress(data))
+    else:
+        errormsg = 'Compression "%s" not recognized; choices are: %s' % (compression, binarycompressions)
+        raise OptimaException(errormsg)
+
+
+def savebinary(filename=None, obj=None, compression=None, folder=None, verbose=True):
+    '''
+    Save an object to file in the binary format, where the arrays (e.g. in results) are stored separately from the rest
+    of the object. With compression=None (default), the arrays are stored as they are, so loadbinary() can map them from
+    the file instead of reading them; otherwise, they are compressed with 'zlib', 'zstd' or 'lz4' (if installed).
+    The rest of the object is always compressed with zlib. The file is written to a temporary file and then moved into
+    place, so any arrays still mapped from an earlier version of the file aren't affected.
+
+    Usage:
+        savebinary('myproject.prj', P)
+    '''
+    if compression not in binarycompressions:
+        errormsg = 'Compression "%s" not recognized; choices are: %s' % (compression, binarycompressions)
+        raise OptimaException(errormsg)
+    fullpath = makefilepath(filename=filename, folder=folder, sanitize=True)
+    buffers = []
+    def keepbuffer(buffer): # Take large arrays out of the pickle; returning True keeps it in
+        if buffer.raw().nbytes < binaryminsize: return True
+        buffers.append(buffer)
+        return False
+    skeleton = zlib.compress(pkl.dumps(obj, protocol=5, buffer_callback=keepbuffer), 5)
+    
+    header = {'version':1, 'compression':compression, 'buffers':[]}
+    tmppath = '%s.%s.tmp' % (fullpath, op.uuid().hex)
+    try:
+        with open(tmppath, 'wb') as f:
+            f.write(binarymagic)
+            position = len(binarymagic)
+            for buffer in buffers:
+                data = compressbuffer(buffer.raw(), compression)
+                padding = -position % binaryalign
+                f.write(b'\0'*padding)
+                position += padding
+                nbytes = len(data) if compression else data.nbytes
+                header['buffers'].append((position, nbytes))
+                f.write(data)
+                position += nbytes
+            header['skeleton'] = (position, len(skeleton))
+            f.write(skeleton)
+            position += len(skeleton)
+            f.write(pkl.dumps(header, protocol=-1))
+            f.write(struct.pack('<Q', position) + binarymagic)
+        os.replace(tmppath, fullpath)
+    finally:
+        if os.path.exists(tmppath): os.remove(tmppath)
+    if verbose: print('Object saved to "%s"' % fullpath)
+    return fullpath
+
+
+def isbinaryfile(filename=None, folder=None):
+    ''' Whether a file was saved by savebinary() '''
+    fullpath = makefilepath(filename=filename, folder=folder)
+    if not os.path.isfile(fullpath): return False
+    with open(fullpath, 'rb') as f: return f.read(len(binarymagic)) == binarymagic
+
+
+def loadbinary(filename=None, folder=None, mmap=True, verbose=True):
+    '''
+    Load a file saved by savebinary(). If its arrays weren't compressed and mmap=True (default), they are mapped from the
+    file rather than read, so they are only read from disk when they're used, and only take up memory if they're changed
+    (they can be changed as usual, but the changes aren't written to the file).
+
+    Usage:
+        P = loadbinary('myproject.prj')
+    '''
+    fullpath = makefilepath(filename=filename, folder=folder)
+    with open(fullpath, 'rb') as f:
+        if f.read(len(binarymagic)) != binarymagic:
+            errormsg = 'File "%s" is not in the Optima binary format' % fullpath
+            raise OptimaException(errormsg)
+        f.seek(-8-len(binarymagic), os.SEEK_END)
+        headerstart = struct.unpack('<Q', f.read(8))[0]
+        footerstart = f.tell() - 8
+        f.seek(headerstart)
+        header = pkl.loads(f.read(footerstart - headerstart))
+        compression = header['compression']
+        if mmap and compression is None and header['buffers']:
+            data = memoryview(globalmmap.mmap(f.fileno(), 0, access=globalmmap.ACCESS_COPY)) # Copy on write: the file itself is never changed
+        else:
+            f.seek(0)
+            data = memoryview(bytearray(f.read()))
+    buffers = [decompressbuffer(data[start:start+nbytes], compression) for start,nbytes in header['buffers']]
+    start, nbytes = header['skeleton']
+    obj = pkl.loads(zlib.decompress(data[start:start+nbytes]), buffers=buffers)
+    if verbose: print('Object loaded from "%s"' % fullpath)
+    return obj
+
+
 def optimafolder(subfolder=None):
     '''
     A centralized place to get the correct paths for Optima.
@@ -1,36 +1,103 @@
 ## Imports
 from functools import partial
-from numpy import zeros, exp, maximum, minimum, inf, array, isnan, einsum, floor, ones, power as npow, concatenate as cat, interp, nan, squeeze, isinf, isfinite, argsort, take_along_axis, put_along_axis, expand_dims, ix_, tile, arange, swapaxes, errstate, where, prod, isin, transpose
+from numpy import zeros, exp, maximum, minimum, inf, array, isnan, einsum, floor, ones, power as npow, concatenate as cat, interp, nan, squeeze, isinf, isfinite, argsort, take_along_axis, put_along_axis, expand_dims, ix_, tile, arange, swapaxes, errstate, where, prod, isin, transpose, moveaxis, unique, add
 from optima import OptimaException, printv, dcp, odict, findinds, compareversions, sanitize, promotetolist, isnumber
+from optima.modelkernels import checkengine, foikernel, flowkernel, transitkernel, birthskernel
+
+__all__ = ['model', 'batchmodel']
 
-__all__ = ['model']
 
 def model(simpars=None, settings=None, version=None, initpeople=None, initprops=None, verbose=None, die=False, debug=False,
-          label=None, startind=None, advancedtracking=False, flattenraw=False):
+          label=None, startind=None, advancedtracking=False, flattenraw=False, engine=None, snapshots=None):
     """
     Runs Optima's epidemiological model.
 
+    This is a batch of one: see batchmodel() to run several sets of simpars together. Set engine='jit' (or
+    settings.engine) to use compiled kernels for the time loop if Numba is installed -- see modelkernels.py.
+
     Version: 1.8 (2017mar03)
     """
+    if label is None:    labelstr = ''
+    else:                labelstr = label + ': '
+    if simpars is None:  raise OptimaException(labelstr+'model() requires simpars as an input')
+    if settings is None: raise OptimaException(labelstr+'model() requires settings as an input')
+    if version is None:  raise OptimaException(labelstr+'model() requires version as an input')
 
-    ##################################################################################################################
-    ### Setup
-    ##################################################################################################################
+    raw = batchmodel(simparslist=[simpars], settings=settings, version=version, initpeople=initpeople, initprops=initprops, verbose=verbose,
+                     die=die, debug=debug, label=label, startind=startind, advancedtracking=advancedtracking, flattenraw=flattenraw, engine=engine,
+                     snapshots=snapshots)[0]
+    return raw
 
-    # Initialize basic quantities
 
+def batchmodel(simparslist=None, settings=None, version=None, initpeople=None, initprops=None, verbose=None, die=False, debug=False,
+               label=None, startind=None, advancedtracking=False, flattenraw=False, batchsize=None, engine=None, snapshots=None):
+    """
+    Runs Optima's epidemiological model for a list of simpars (e.g. uncertainty samples or candidate budgets) in lockstep.
+
+    Simpars with the same structure (time vector, populations and partnerships) are stacked along a leading batch
+    axis and stepped through time together, so the per-timestep overhead is paid once per batch rather than once
+    per simulation. Use batchsize to limit the number of simulations held in memory at once. initpeople and initprops,
+    if supplied, are used for every simulation. engine is 'numpy' or 'jit', as for model(). Returns a list of raw
+    outputs in the same order as simparslist.
+
+    snapshots is an optional list of time indices: the people and cascade proportions at the start of each of these
+    timesteps are stored in raw['snapshots'], and can be used as initpeople and initprops (with startind) to start
+    another run from that point -- see stitchraw().
+
+    Version: 2026oct18
+    """
+
+    # Initialize basic quantities
     if label is None:    label = ''
     else:                label += ': '# An optional label to add to error messages
     if startind is None: startind = 0 # Point to start from -- used with non-empty initpeople
-    if simpars is None:  raise OptimaException(label+'model() requires simpars as an input')
-    if settings is None: raise OptimaException(label+'model() requires settings as an input')
-    if version is None:  raise OptimaException(label+'model() requires version as an input')
+    if isinstance(simparslist, dict): simparslist = [simparslist] # A single simpars was supplied
+    if not simparslist:  raise OptimaException(label+'batchmodel() requires simpars as an input')
+    if settings is None: raise OptimaException(label+'batchmodel() requires settings as an input')
+    if version is None:  raise OptimaException(label+'batchmodel() requires version as an input')
     if verbose is None:  verbose = settings.verbose  # Verbosity of output
+    engine = checkengine(engine, settings) # 'numpy' unless 'jit' was asked for and Numba is available
     printv('Running model...', 1, verbose)
 
     if initpeople is not None and initprops is None:
         print('WARNING, results with initpeople are unreliable if you don\'t also provide the full vectors of propdx, propcare etc through initprops!')
 
+    # Do everything that doesn't depend on the epidemic state, and group the simulations that can be run together
+    setups = [setupmodel(simpars=simpars, settings=settings, version=version, initpeople=initpeople, initprops=initprops,
+                         verbose=verbose, die=die, debug=debug, label=label) for simpars in simparslist]
+    groups = odict()
+    for ind,setup in enumerate(setups):
+        structure = (tuple(setup['popkeys']), setup['dt'], setup['tvec'].tobytes(), setup['fromtoarr'].tobytes(),
+                     setup['methodsexpartnerarr'].tobytes(), setup['injpartnerarr'].tobytes(), setup['noinflows'].tobytes())
+        if structure not in groups: groups[structure] = []
+        groups[structure].append(ind)
+
+    # Run each group, in chunks of at most batchsize simulations
+    rawlist = [None]*len(setups)
+    for inds in groups.values():
+        chunksize = len(inds) if not batchsize else int(batchsize)
+        for start in range(0, len(inds), chunksize):
+            chunk = inds[start:start+chunksize]
+            raws = runbatch(setups=[setups[ind] for ind in chunk], settings=settings, version=version, verbose=verbose, die=die, debug=debug,
+                            label=label, startind=startind, advancedtracking=advancedtracking, flattenraw=flattenraw, engine=engine,
+                            snapshots=snapshots)
+            for ind,raw in zip(chunk, raws): rawlist[ind] = raw
+            for ind in chunk: setups[ind] = None # Free memory as we go
+
+    return rawlist
+
+
+def setupmodel(simpars=None, settings=None, version=None, initpeople=None, initprops=None, verbose=None, die=False, debug=False, label=''):
+    """
+    Does all of the model calculations that don't depend on the epidemic state for a single simpars: rates, the
+    time-constant transition matrix, effective numbers of acts, births, immigration and initial conditions.
+    Returns an odict used by runbatch().
+    """
+
+    ##################################################################################################################
+    ### Setup
+    ##################################################################################################################
+
     # Extract key items
     popkeys         = simpars['popkeys']
     npops           = len(popkeys)
@@ -47,33 +114,8 @@ def model(simpars=None, settings=None, version=None, initpeople=None, initprops=
     fromto          = simpars['fromto']             # States to and from
     transmatrix     = simpars['transmatrix']        # Raw transitions matrix
 
-    # Initialize people array
-    people          = zeros((nstates, npops, npts)) # Matrix to hold everything
-
-    # Initialize other arrays used for internatl calculations
-    allpeople       = zeros((npops, npts))          # Population sizes
-    effallprev      = zeros((nstates, npops))       # HIV effective prevalence (prevalence times infectiousness), by health state
-    inhomo          = zeros(npops)                  # Inhomogeneity calculations
-
-    # Initialize raw arrays -- reporting annual quantities (so need to divide by dt!)
-    raw_inci            = zeros((npops, npts))                 # Total incidence acquired by each population
-    raw_incibypop       = zeros((nstates, npops, npts))        # Total incidence caused by each population and each state
-    raw_incionpopbypopmethods = zeros((settings.nmethods, npops, nstates, npops, npts))  # Total incidence in each population caused by each population and each state, 1st axis is method of transmission, 2nd axis is acquired population. 3rd axis is caused state, 4th axis is caused population
-    raw_births          = zeros((npops, npts))                 # Total number of births to each population
-    raw_mtct            = zeros((npops, npts))                 # Number of mother-to-child transmissions to each population
-    raw_hivbirths       = zeros((npops, npts))                 # Number of births to HIV+ pregnant women
-    raw_receivepmtct    = zeros((npops, npts))                 # Initialise a place to store the number of people in each population receiving PMTCT
-    raw_diagcd4         = zeros((ncd4, npops, npts))           # Number diagnosed by CD4 per timestep
-    raw_dxforpmtct      = zeros((npops, npts))                 # Number diagnosed to go onto PMTCT per timestep
-    raw_newcare         = zeros((npops, npts))                 # Number newly in care per timestep
-    raw_newtreat        = zeros((npops, npts))                 # Number initiating ART per timestep
-    raw_newsupp         = zeros((npops, npts))                 # Number newly suppressed per timestep
-    raw_death           = zeros((nstates, npops, npts))        # Number of deaths per timestep
-    raw_otherdeath      = zeros((npops, npts))                 # Number of other deaths per timestep
-    raw_emi             = zeros((nstates, npops, npts))        # Number of immigrants by state per year
-    raw_immi            = zeros((nstates, npops, npts))        # Number of immigrants by state per year
-    raw_transitpopbypop = zeros((npops, nstates, npops, npts)) # Number of ageing AND risk transitions to and from each population and each state
-    raw_popadjustments  = zeros((npops, npts))                 # Number of people created or deleted to maintain desired population size
+    # Initialize arrays that can be precalculated -- reporting annual quantities (so need to divide by dt!)
+    raw_immi        = zeros((nstates, npops, npts))        # Number of immigrants by state per year
 
     # Biological and failure parameters
     prog            = maximum(eps,1-exp(-dt/array([simpars['progacute'], simpars['proggt500'], simpars['proggt350'], simpars['proggt200'], simpars['proggt50'], 1./simpars['deathlt50']]) ))
@@ -103,15 +145,12 @@ def model(simpars=None, settings=None, version=None, initpeople=None, initprops=
     susreg          = settings.susreg               # Susceptible, regular
     progcirc        = settings.progcirc             # Susceptible, programmatically circumcised
     sus             = settings.sus                  # Susceptible, both circumcised and uncircumcised
-    nsus            = settings.nsus                 # Number of susceptible states
     undx            = settings.undx                 # Undiagnosed
     dx              = settings.dx                   # Diagnosed
     alldx           = settings.alldx                # All diagnosed
-    allcare         = settings.allcare              # All in care
     alltx           = settings.alltx                # All on treatment
     allplhiv        = settings.allplhiv             # All PLHIV
     notonart        = settings.notonart             # All PLHIV who are not on ART
-    dxnotincare     = settings.dxnotincare          # Diagnosed + lost people not in care
     care            = settings.care                 # In care
     usvl            = settings.usvl                 # On treatment - Unsuppressed Viral Load
     svl             = settings.svl                  # On treatment - Suppressed Viral Load
@@ -125,9 +164,6 @@ def model(simpars=None, settings=None, version=None, initpeople=None, initprops=
     aidsind         = settings.aidsind              # AIDS
     heterosexsex    = settings.heterosexsex         # Infection via heterosexual sex
     homosexsex      = settings.homosexsex           # Infection via homosexual sex
-    inj             = settings.inj                  # Infection via injection
-    mtct            = settings.mtct                 # Infection via MTCT
-    nonmtctmethods  = sorted(settings.nonmtctmethods)
     nmethods        = settings.nmethods
     dxnottx         = [state for state in alldx if state not in alltx]
 
@@ -154,6 +190,7 @@ def model(simpars=None, settings=None, version=None, initpeople=None, initprops=
     immipropdiag    = simpars['immipropdiag']       #Proportion of immigrants with HIV who are already diagnosed (will be assumed linked to care but not on treatment)
 
     # Shorten to lists of key tuples so don't have to iterate over every population twice for every timestep
+    risktransitlist,agetransitlist,agelist = None,None,None # Only used for versions before 2.12.0
     if compareversions(version,"2.12.0") < 0:
         risktransitlist,agetransitlist = [],[]
         for p1 in range(npops):
@@ -194,33 +231,9 @@ def model(simpars=None, settings=None, version=None, initpeople=None, initprops=
     propsupp    = dcp(simpars['propsupp'])
     proppmtct   = dcp(simpars['proppmtct'])
 
-    #  Years to fix proportions
-    def findfixind(fixyearname):
-        fixyearpar = simpars[fixyearname]
-        tvec = simpars['tvec']
-        if isnan(fixyearpar) or     fixyearpar is None: fixind = nan # It's not defined, skip
-        elif fixyearpar > tvec[-1]: fixind = nan # It's after the end, skip
-        elif fixyearpar < tvec[0]:  fixind = 0 # It's before the beginning, set to beginning
-        else:                       fixind = findinds(tvec>=fixyearpar)[0] # Main usage case
-        return fixind
-
-    fixpropdx      = findfixind('fixpropdx')
-    fixpropcare    = findfixind('fixpropcare')
-    fixproptx      = findfixind('fixproptx')
-    fixpropsupp    = findfixind('fixpropsupp')
-    fixproppmtct   = findfixind('fixproppmtct')
-
-#    # These all have the same format, so we put them in tuples of (proptype, data structure for storing output, state below, state in question, states above (including state in question), numerator, denominator, data structure for storing new movers)
-#    #                    name,       prop,    lower,       to,    num,     denom,    raw_new,        fixyear
-    propstruct = odict([('propdx',   [propdx,   undx,       dx,    alldx,   allplhiv, raw_diagcd4,    fixpropdx]),
-                        ('propcare', [propcare, dxnotincare,care,  allcare, alldx,    raw_newcare,    fixpropcare]),    # Note that dxnotincare has twice as many states as care so we combine people when putting up into care BUT we only put people down into lost
-                        ('proptx',   [proptx,   care,       alltx, alltx,   allcare,  raw_newtreat,   fixproptx]),
-                        ('propsupp', [propsupp, usvl,       svl,   svl,     alltx,    raw_newsupp,    fixpropsupp]),
-                        ('proppmtct',[proppmtct,None,       None,  None,    None,     None,           fixproppmtct])])  # Calculation of proppmtct is done in the "Calculate births" section and does not need to be repeated at the end of this file
-
-    propslist = [val[0] for val in propstruct.values()]
-    if advancedtracking:
-        raw_propsarr = zeros((len(propstruct.keys()), npts, npts)) # 1st axis is prop, 2nd axis is at which time, 3rd axis is the prop array over time
+    # These all have the same format, so they are stored in this order and combined with the raw arrays for storing new movers in runbatch()
+    propslist = [propdx, propcare, proptx, propsupp, proppmtct]
+    fixinds   = findfixinds(simpars) # Indices at which to fix the proportions, in the same order
 
     # Population sizes
     popsize = dcp(simpars['popsize'])
@@ -319,7 +332,7 @@ def model(simpars=None, settings=None, version=None, initpeople=None, initprops=
             transmatrix[fromstate,tostate,:] *= (1.-deathhiv[fromhealthstate]*relhivdeath*deathsvl*dt)
             deathprob[fromstate,:] = deathhiv[fromhealthstate]*relhivdeath*deathsvl*dt
 
-    transdeathmatrix = ones(people.shape)
+    transdeathmatrix = ones((nstates, npops, npts))
     transdeathmatrix[alltx] = rrcomorbiditydeathtx
 
     # Recovery and progression and deaths for people on unsuppressive ART
@@ -449,7 +462,6 @@ def model(simpars=None, settings=None, version=None, initpeople=None, initprops=
         else:   printv(errormsg, 1, verbose)
         initpeople[initpeople<0] = 0.0
 
-    people[:,:,startind] = initpeople
 
 
     ##################################################################################################################
@@ -584,37 +596,251 @@ def model(simpars=None, settings=None, version=None, initpeople=None, initprops=
     agearr = zeros((npops, npops, npts))
     agearr = einsum('ij,ik->ijk', agetransit, agerate) # shape: (frompop, topop, time)
 
+
     ##################################################################################################################
-    ### Define error checking
+    ### Collect everything needed by the time loop
     ##################################################################################################################
 
-    def checkfornegativepeople(people, tind=None):
-        tvec = simpars['tvec']
-        if tind is None: tind = Ellipsis
-        if not((people[:,:,tind]>=0).all()): # If not every element is a real number >0, throw an error
-            for t in range(len(tvec)):
-                for errstate in range(nstates): # Loop over all heath states
-                    for errpop in range(npops): # Loop over all populations
-                        if not(people[errstate,errpop,t]>=0):
-                            errlines = ['WARNING, Non-positive people found (more people leaving compartment than exist in that compartment)!',
-                                        'people[%i, %i, %i] = people[%s, %s, %s] = %s' % (errstate, errpop, t, settings.statelabels[errstate], popkeys[errpop], simpars['tvec'][t], people[errstate,errpop,t]),
-                                        'Possible reasons include unrealistic numbers of deaths or infection rates in population %s.'%(popkeys[errpop]),
-                                        'Check for mortality rates or other inputs that might be missing a decimal point or try lowering force of infection']
-
-                            errormsg = label + str.join('\n',errlines)
-                            if die: raise OptimaException(errormsg)
-                            else:   printv(errormsg, 1, verbose=verbose)
-                            people[errstate,errpop,t] = 0.0 # Reset
+    setup = odict()
+
+    # Structure -- must be the same for every simulation in a batch
+    setup['popkeys']             = popkeys
+    setup['tvec']                = tvec
+    setup['dt']                  = dt
+    setup['fromtoarr']           = fromtoarr
+    setup['methodsexpartnerarr'] = methodsexpartnerarr
+    setup['regularityinds']      = regularityinds
+    setup['injpartnerarr']       = injpartnerarr
+    setup['noinflows']           = noinflows
+    setup['mtctgroupmap']        = mtctgroupmap
+    setup['plhivmap']            = plhivmap
+
+    # Arrays that get stacked along the batch axis
+    setup['initpeople']          = initpeople
+    setup['transmatrix']         = transmatrix
+    setup['transdeathmatrix']    = transdeathmatrix
+    setup['deathprob']           = deathprob
+    setup['alltrans']            = alltrans
+    setup['inhomopar']           = inhomopar
+    setup['force']               = force
+    setup['background']          = background
+    setup['backgrounddeath']     = backgrounddeath
+    setup['emiprob']             = emiprob
+    setup['transsexarr']         = transsexarr
+    setup['condarr']             = condarr
+    setup['fracactssexarr']      = fracactssexarr
+    setup['wholeactssexarr']     = wholeactssexarr
+    setup['fracactsinjarr']      = fracactsinjarr
+    setup['wholeactsinjarr']     = wholeactsinjarr
+    setup['transinj']            = transinj
+    setup['osteff']              = osteff
+    setup['sharing']             = sharing
+    setup['prepeff']             = prepeff
+    setup['alleff']              = alleff
+    setup['hivtest']             = hivtest
+    setup['aidstest']            = aidstest
+    setup['linktocare']          = linktocare
+    setup['aidslinktocare']      = aidslinktocare
+    setup['returntocare']        = returntocare
+    setup['leavecare']           = leavecare
+    setup['aidsleavecare']       = aidsleavecare
+    setup['treatfail']           = treatfail
+    setup['regainvs']            = regainvs
+    setup['numvlmon']            = numvlmon
+    setup['numcirc']             = numcirc
+    setup['raw_immi']            = raw_immi
+    setup['agearr']              = agearr
+    setup['risktransitarr']      = risktransitarr
+    setup['popsize']             = popsize
+
+    # Quantities used by the per-simulation parts of the time loop
+    setup['forcepopsize']        = forcepopsize
+    setup['allcd4eligibletx']    = allcd4eligibletx
+    setup['treatvs']             = treatvs
+    setup['numtx']               = numtx
+    setup['propslist']           = propslist
+    setup['fixinds']             = fixinds
+    setup['birthratesarr']       = birthratesarr
+    setup['relhivbirth']         = relhivbirth
+    setup['motherpops']          = motherpops
+    setup['childpops']           = childpops
+    setup['notmotherpops']       = notmotherpops
+    setup['effmtct']             = effmtct
+    setup['pmtcteff']            = pmtcteff
+    setup['numpmtct']            = numpmtct
+    setup['proppmtct']           = proppmtct
+    setup['agetransit']          = agetransit
+    setup['agetransitlist']      = agetransitlist
+    setup['agelist']             = agelist
+    setup['risktransitlist']     = risktransitlist
+
+    return setup
+
+
+def runbatch(setups=None, settings=None, version=None, verbose=None, die=False, debug=False, label='', startind=0,
+             advancedtracking=False, flattenraw=False, engine='numpy', snapshots=None):
+    """
+    Runs the time loop for a batch of structurally identical setups from setupmodel(). Every epidemic array has a
+    leading batch axis, so force-of-infection, transitions, ageing and population reconciliation are calculated for
+    the whole batch at once; births, proportions and other steps that branch on per-simulation values are done for
+    each simulation in turn on views of the batch arrays. With engine='jit', force-of-infection, transitions, ageing
+    and births use the compiled kernels in modelkernels.py instead, except when advanced tracking or debugging.
+    Returns a list of raw outputs.
+    """
+
+    # Extract key items
+    nbatch          = len(setups)
+    first           = setups[0]
+    popkeys         = first['popkeys']
+    npops           = len(popkeys)
+    tvec            = first['tvec']
+    dt              = first['dt']
+    npts            = len(tvec)
+    ncd4            = settings.ncd4
+    nstates         = settings.nstates
+    eps             = settings.eps
+    fromtoarr       = first['fromtoarr']
+    methodsexpartnerarr = first['methodsexpartnerarr']
+    regularityinds  = first['regularityinds']
+    injpartnerarr   = first['injpartnerarr']
+    noinflows       = first['noinflows']
+    mtctgroupmap    = first['mtctgroupmap']
+    plhivmap        = first['plhivmap']
+    oldageing       = compareversions(version,"2.12.0") < 0
+
+    # Disease state indices
+    susreg          = settings.susreg
+    progcirc        = settings.progcirc
+    sus             = settings.sus
+    nsus            = settings.nsus
+    undx            = settings.undx
+    dx              = settings.dx
+    alldx           = settings.alldx
+    allcare         = settings.allcare
+    alltx           = settings.alltx
+    allplhiv        = settings.allplhiv
+    notonart        = settings.notonart
+    dxnotincare     = settings.dxnotincare
+    care            = settings.care
+    usvl            = settings.usvl
+    svl             = settings.svl
+    lost            = settings.lost
+    aidsind         = settings.aidsind
+    inj             = settings.inj
+    mtct            = settings.mtct
+    nonmtctmethods  = sorted(settings.nonmtctmethods)
+    dxnottx         = [state for state in alldx if state not in alltx]
+    newbirths       = compareversions(version, "2.12.2") >= 0
+    usejit          = engine=='jit' and not (advancedtracking or debug) # The kernels don't do the extra tracking or checks
+
+    # Stack the per-simulation arrays along the batch axis
+    def stack(key): return array([setup[key] for setup in setups], dtype=float)
+    transmatrix      = stack('transmatrix')
+    transdeathmatrix = stack('transdeathmatrix')
+    deathprob        = stack('deathprob')
+    alltrans         = stack('alltrans')
+    inhomopar        = stack('inhomopar')
+    force            = stack('force')
+    background       = stack('background')
+    backgrounddeath  = stack('backgrounddeath')
+    emiprob          = stack('emiprob')
+    transsexarr      = stack('transsexarr')
+    condarr          = stack('condarr')
+    fracactssexarr   = stack('fracactssexarr')
+    wholeactssexarr  = stack('wholeactssexarr')
+    fracactsinjarr   = stack('fracactsinjarr')
+    wholeactsinjarr  = stack('wholeactsinjarr')
+    transinj         = stack('transinj')
+    osteff           = stack('osteff')
+    sharing          = stack('sharing')
+    prepeff          = stack('prepeff')
+    alleff           = stack('alleff')
+    hivtest          = stack('hivtest')
+    aidstest         = stack('aidstest')
+    linktocare       = stack('linktocare')
+    aidslinktocare   = stack('aidslinktocare')
+    returntocare     = stack('returntocare')
+    leavecare        = stack('leavecare')
+    aidsleavecare    = stack('aidsleavecare')
+    treatfail        = stack('treatfail')
+    regainvs         = stack('regainvs')
+    numvlmon         = stack('numvlmon')
+    numcirc          = stack('numcirc')
+    agearr           = stack('agearr')
+    risktransitarr   = stack('risktransitarr')
+    popsize          = stack('popsize')
+    propslists       = [setup['propslist'] for setup in setups]
+
+    # Only store the legal transitions: transitions[:,n,:] is the probability of moving from transfrom[n] to transto[n]
+    sparse           = sparsetransitions(fromtoarr, settings)
+    transfrom        = sparse['transfrom']
+    transind         = sparse['transind']
+    blocks           = sparse['blocks']
+    transitions      = transmatrix[:,transfrom,sparse['transto'],:]
+
+    # Integer index arrays for the compiled kernels
+    if usejit:
+        sexpop1       = methodsexpartnerarr[:,1].copy()
+        sexpop2       = methodsexpartnerarr[:,2].copy()
+        injpop1       = injpartnerarr[:,0].copy()
+        injpop2       = injpartnerarr[:,1].copy()
+        transto       = sparse['transto']
+        dxnottxarr    = array(dxnottx, dtype=int)
+        birthpops     = [(array(setup['motherpops'], dtype=int), array(setup['childpops'], dtype=int)) for setup in setups]
+
+    # Initialize people array
+    people          = zeros((nbatch, nstates, npops, npts)) # Matrix to hold everything
+    people[:,:,:,startind] = stack('initpeople')
+
+    # Initialize other arrays used for internal calculations
+    allpeople       = zeros((nbatch, npops, npts))   # Population sizes
+
+    # Initialize raw arrays -- reporting annual quantities (so need to divide by dt!)
+    raw_inci            = zeros((nbatch, npops, npts))                 # Total incidence acquired by each population
+    raw_incibypop       = zeros((nbatch, nstates, npops, npts))        # Total incidence caused by each population and each state
+    raw_incionpopbypopmethods = zeros((nbatch, settings.nmethods, npops, nstates, npops, npts))  # Total incidence in each population caused by each population and each state, 2nd axis is method of transmission, 3rd axis is acquired population. 4th axis is caused state, 5th axis is caused population
+    raw_births          = zeros((nbatch, npops, npts))                 # Total number of births to each population
+    raw_mtct            = zeros((nbatch, npops, npts))                 # Number of mother-to-child transmissions to each population
+    raw_hivbirths       = zeros((nbatch, npops, npts))                 # Number of births to HIV+ pregnant women
+    raw_receivepmtct    = zeros((nbatch, npops, npts))                 # Initialise a place to store the number of people in each population receiving PMTCT
+    raw_diagcd4         = zeros((nbatch, ncd4, npops, npts))           # Number diagnosed by CD4 per timestep
+    raw_dxforpmtct      = zeros((nbatch, npops, npts))                 # Number diagnosed to go onto PMTCT per timestep
+    raw_newcare         = zeros((nbatch, npops, npts))                 # Number newly in care per timestep
+    raw_newtreat        = zeros((nbatch, npops, npts))                 # Number initiating ART per timestep
+    raw_newsupp         = zeros((nbatch, npops, npts))                 # Number newly suppressed per timestep
+    raw_death           = zeros((nbatch, nstates, npops, npts))        # Number of deaths per timestep
+    raw_otherdeath      = zeros((nbatch, npops, npts))                 # Number of other deaths per timestep
+    raw_emi             = zeros((nbatch, nstates, npops, npts))        # Number of immigrants by state per year
+    raw_immi            = stack('raw_immi')                            # Number of immigrants by state per year
+    raw_transitpopbypop = zeros((nbatch, npops, nstates, npops, npts)) # Number of ageing AND risk transitions to and from each population and each state
+    raw_popadjustments  = zeros((nbatch, npops, npts))                 # Number of people created or deleted to maintain desired population size
+    if advancedtracking:
+        raw_propsarr = zeros((nbatch, len(propslists[0]), npts, npts)) # 2nd axis is prop, 3rd axis is at which time, 4th axis is the prop array over time
+    snapshots = set(snapshots) if snapshots else set() # Time indices at which to store the epidemic state
+    rawsnapshots = [dict() for b in range(nbatch)] # Keyed by time index, so not odicts
+
+    # These all have the same format, so we put them in tuples of (proptype, data structure for storing output, state below, state in question, states above (including state in question), numerator, denominator, data structure for storing new movers)
+    #                    name,       prop,    lower,       to,    num,     denom,    raw_new,        fixyear
+    propstructs = []
+    for b,setup in enumerate(setups):
+        propdx, propcare, proptx, propsupp, proppmtct = setup['propslist']
+        fixpropdx, fixpropcare, fixproptx, fixpropsupp, fixproppmtct = setup['fixinds']
+        propstructs.append(odict([('propdx',   [propdx,   undx,       dx,    alldx,   allplhiv, raw_diagcd4[b],    fixpropdx]),
+                                  ('propcare', [propcare, dxnotincare,care,  allcare, alldx,    raw_newcare[b],    fixpropcare]),    # Note that dxnotincare has twice as many states as care so we combine people when putting up into care BUT we only put people down into lost
+                                  ('proptx',   [proptx,   care,       alltx, alltx,   allcare,  raw_newtreat[b],   fixproptx]),
+                                  ('propsupp', [propsupp, usvl,       svl,   svl,     alltx,    raw_newsupp[b],    fixpropsupp]),
+                                  ('proppmtct',[proppmtct,None,       None,  None,    None,     None,              fixproppmtct])]))  # Calculation of proppmtct is done in the "Calculate births" section and does not need to be repeated at the end of this file
+
+    def userate(prop,t):
+        if   t==0:             return True # Never force a proportion on the first timestep
+        elif isnan(prop[t-1]): return True # The previous timestep had a rate, so keep the rate here
+        else:                  return False # Neither: use a proportion instead of a rate
 
 
     ##################################################################################################################
     ### Run the model
     ##################################################################################################################
 
-    # Preallocate here -- supposedly the most computationally efficient way to do this
-    alltransmatrices = zeros((npts, transmatrix.shape[0], transmatrix.shape[1], transmatrix.shape[2]))
-    alltransmatrices[:] = transmatrix
-
     for t in range(startind, npts): # Loop over time
         printv('Timestep %i of %i' % (t+1, npts), 4, verbose)
 
@@ -622,28 +848,34 @@ def model(simpars=None, settings=None, version=None, initpeople=None, initprops=
         ## Initial steps
         ###############################################################################
 
-        ## Pull out the transitions for this timestep
-        thistransit = alltransmatrices[t]
+        ## Pull out the transitions and people for this timestep
+        thistransit = transitions.copy()
+        peoplet = people[:,:,:,t] # A view, for indexing states without moving the batch axis
+
+        # Store the epidemic state at the start of this timestep, to start other runs from
+        if t in snapshots:
+            for b in range(nbatch): rawsnapshots[b][t] = odict([('people', people[b,:,:,t].copy()), ('props', [prop.copy() for prop in propslists[b]])])
 
         # Save the proportions to the raw results
-        if advancedtracking: raw_propsarr[:, t, :] = propslist
+        if advancedtracking:
+            for b in range(nbatch): raw_propsarr[b, :, t, :] = propslists[b]
 
         ## Calculate "effective" HIV prevalence -- taking diagnosis and treatment into account
-        allpeople[:,t] = people[:, :, t].sum(axis=0)
-        if debug and not( all(allpeople[:,t]>0)):
-            errormsg = label + 'No people in populations %s at timestep %i (time %0.1f)' % (findinds(allpeople[:,t]<=0), t, tvec[t])
+        allpeople[:,:,t] = people[:,:,:,t].sum(axis=1)
+        if debug and not (allpeople[:,:,t]>0).all():
+            errormsg = label + 'No people in populations %s at timestep %i (time %0.1f)' % (findinds(allpeople[:,:,t].min(axis=0)<=0), t, tvec[t])
             if die: raise OptimaException(errormsg)
             else: printv(errormsg, 1, verbose)
 
-        effallprev = einsum('i,ij->ij',alltrans,people[:,:,t]) / allpeople[:,t]
-        if debug and not((effallprev[:,:]>=0).all()):
+        effallprev = einsum('bi,bij->bij',alltrans,people[:,:,:,t]) / allpeople[:,None,:,t]
+        if debug and not((effallprev>=0).all()):
             errormsg = label + 'HIV prevalence invalid at time %s' % (t)
             if die: raise OptimaException(errormsg)
             else:   printv(errormsg, 1, verbose)
             effallprev = minimum(effallprev,eps)
 
         ## Calculate inhomogeneity in the force-of-infection based on prevalence
-        thisprev = people[allplhiv,:,t].sum(axis=0) / allpeople[:,t]
+        thisprev = peoplet[:,allplhiv,:].sum(axis=1) / allpeople[:,:,t]
         inhomo = (inhomopar+eps) / (exp(inhomopar+eps)-1) * exp(inhomopar*(1-thisprev)) # Don't shift the mean, but make it maybe nonlinear based on prevalence
 
 
@@ -652,104 +884,112 @@ def model(simpars=None, settings=None, version=None, initpeople=None, initprops=
         ###############################################################################
 
         # Probability of getting infected. In the first stage of construction, we actually store this as the probability of NOT getting infected
-        # First dimension: infection acquired by (circumcision status). Second dimension:  infection acquired by (pop). Third dimension: infection caused by (health/treatment state). Fourth dimension: infection caused by (pop)
+        # First dimension: batch. Second dimension: infection acquired by (circumcision status). Third dimension:  infection acquired by (pop). Fourth dimension: infection caused by (health/treatment state). Fifth dimension: infection caused by (pop)
         # forceinffull is the one used to actually calculate infections from both sexual and injection transmission
         # raw_incionpopbypopmethods is the output for advanced tracking
         # all the others are temporary
-        forceinffull  = ones((len(sus), npops, nstates, npops))
-
-        ## Sexual infections
-        pop1 = methodsexpartnerarr[:,1]
-        pop2 = methodsexpartnerarr[:,2]
-
-        forceinffullsex = ones((len(sus), nstates, nallsexacts))
-        # only effallprev[:,:] is time dependent
-        forceinffullsex[:,:,:] *= 1 - minimum(einsum('m,m,m,mi,km->ikm', fracactssexarr[:,t], transsexarr[:,t],
-                                            condarr[:,t], alleff[:,t,:][pop1,:], effallprev[:,pop2]), 1)
-
-        forceinffullsex[:,:,:] *= npow(1 - minimum(einsum('m,m,mi,km,m->ikm', transsexarr[:,t], condarr[:,t], alleff[pop1,t,:], effallprev[:,pop2],
-                            (wholeactssexarr[:,t].astype(int) != 0) ),1), wholeactssexarr[:,t].astype(int))  # If wholeacts[t] == 0, then this will equal one so will not change forceinffull
-
-        for inds in regularityinds:  # Loops over the indices of acts for regular, casual, commercial so we don't overlap with pop1,pop2 pairs
-            forceinffull[:,pop1[inds],:,pop2[inds]] *= swapaxes(swapaxes(forceinffullsex[:,:,inds],1,2),0,1)  # Slicing a more than 2d array puts the pop1,pop2 in the first dimension
-
-        if advancedtracking:
-            forceinffullsexinj = ones((len(nonmtctmethods), len(sus), npops, nstates, npops)) #!! remove hardcoding # -1 is for MTCT # First dimension is method of transmission, everything else moves over one dimension.
-            forceinffullsexinj[methodsexpartnerarr[:,0],:,methodsexpartnerarr[:,1],:,methodsexpartnerarr[:,2]] \
-                = swapaxes(swapaxes(forceinffullsex,1,2),0,1)
-
-            # The following line could replace the "for inds in regularityinds" loop above but easier to keep the main code separate from the advancedtracking
-            # forceinffull[:,methodsexpartnerarr[:,1],:,methodsexpartnerarr[:,2]] = prod(forceinffullsexinj[:,:,methodsexpartnerarr[:,1],:,methodsexpartnerarr[:,2]], axis=1)
-
-        if debug and ( not((forceinffull[:,:,:,:]>=0).all()) or not((forceinffull[:,:,:,:]<=1).all()) ):
-            for m,(_, pop1, pop2) in enumerate(methodsexpartnerarr):
-                if not ( not((forceinffull[:,pop1,:,pop2]>=0).all()) or not((forceinffull[:,pop1,:,pop2]<=1).all()) ):
-                    errormsg = label + 'Sexual force-of-infection is invalid between populations %s and %s, time %0.1f, FOI:\n%s)' % (
-                        popkeys[pop1], popkeys[pop2], tvec[t], forceinffull[:,pop1,:,pop2])
-                    for var in ['m','transsexarr[m,t]','condarr[m,t]','alleff[pop1,t,:]','effallprev[:,pop2]','fracactssexarr[m,t]','wholeactssexarr[m,t]']:
-                        errormsg += '\n%20s = %f' % (var, eval(var))  # Print out extra debugging information
-                    raise OptimaException(errormsg)
-
-        ## Injection-related infections
-        pop1 = injpartnerarr[:, 0]
-        pop2 = injpartnerarr[:, 1]
-        forceinffullinj = ones((len(sus), nstates, len(pop1)))
-
-        forceinffullinj[:,:,:] *= 1 - minimum(einsum(',,m,m,m,km,i->ikm',transinj, osteff[t], sharing[pop1,t], prepeff[pop1,t],
-                                              fracactsinjarr[:,t], effallprev[:,pop2], [1,1]),1) # The [1,1] applies the same risk to both circs and uncircs, as it does not matter
-
-        forceinffullinj[:,:,:] *= npow(1 - minimum(einsum(',,m,m,km,i,m->ikm',transinj, osteff[t], sharing[pop1,t], prepeff[pop1,t],
-                                                      effallprev[:,pop2], [1,1], (wholeactsinjarr[:,t].astype(int) != 0) ),1),
-                                        wholeactsinjarr[:,t].astype(int))   # If wholeacts[t] == 0, then this will equal one so will not change forceinffull
-
-        forceinffull[:,pop1,:,pop2] *= swapaxes(swapaxes(forceinffullinj[:,:,:],1,2),0,1)  # Slicing a more than 2d array puts the pop1,pop2 in the first dimension
-
-        if advancedtracking:
-            forceinffullsexinj[inj,:,:,:,:][:,pop1,:,pop2] = swapaxes(swapaxes(forceinffullinj[:,:,:],1,2),0,1)
-
-        if debug and ( not((forceinffull[:,:,:,:]>=0).all()) or not((forceinffull[:,:,:,:]<=1).all()) ):
-            for m,(pop1, pop2) in enumerate(injpartnerarr):
-                if not ( not((forceinffull[:,pop1,:,pop2]>=0).all()) or not((forceinffull[:,pop1,:,pop2]<=1).all()) ):
-                    errormsg = label + 'Injection force-of-infection is invalid between populations %s and %s, time %0.1f, FOI:\n%s)' % (
-                        popkeys[pop1], popkeys[pop2], tvec[t], forceinffull[:,pop1,:,pop2])
-                    for var in ['m','transinj','osteff[t]','sharing[pop1,t]','prepeff[pop1,t]','effallprev[:,pop2]','fracactsinjarr[m,t]','wholeactsinjarr[m,t]']:
-                        errormsg += '\n%20s = %f' % (var, eval(var))  # Print out extra debugging information
-                    raise OptimaException(errormsg)
-
-        # Probability of getting infected is one minus forceinffull times any scaling factors !! copied below !!
-        forceinffull  = einsum('ijkl,j,j,j->ijkl', 1.-forceinffull, force, inhomo,(1.-background[:,t]))
-        infections_to = forceinffull.sum(axis=(2,3)) # Infections acquired through sex and injecting - by population who gets infected
-        infections_to = minimum(infections_to, 1.0-eps-background[:,t].max()) # Make sure it never exceeds the limit
+        if usejit: # Compiled version of the calculations below -- see modelkernels.foikernel()
+            infections_to = zeros((nbatch, nsus, npops))
+            raw_inci[:,:,t] = 0.
+            raw_incibypop[:,:,:,t] = 0.
+            foikernel(peoplet, sus, effallprev, force, inhomo, background[:,:,t], dt,
+                      sexpop1, sexpop2, fracactssexarr[:,:,t], transsexarr[:,:,t], condarr[:,:,t], alleff[:,:,t,:], wholeactssexarr[:,:,t],
+                      injpop1, injpop2, transinj, osteff[:,t], sharing[:,:,t], prepeff[:,:,t], fracactsinjarr[:,:,t], wholeactsinjarr[:,:,t],
+                      infections_to, raw_inci[:,:,t], raw_incibypop[:,:,:,t])
+        else:
+            forceinffull  = ones((nbatch, nsus, npops, nstates, npops))
+
+            ## Sexual infections
+            pop1 = methodsexpartnerarr[:,1]
+            pop2 = methodsexpartnerarr[:,2]
+            wholeactssex = wholeactssexarr[:,:,t].astype(int)
+
+            forceinffullsex = ones((nbatch, nsus, nstates, len(pop1)))
+            # only effallprev[:,:,:] is time dependent
+            forceinffullsex *= 1 - minimum(einsum('bm,bm,bm,bmi,bkm->bikm', fracactssexarr[:,:,t], transsexarr[:,:,t],
+                                                  condarr[:,:,t], alleff[:,pop1,t,:], effallprev[:,:,pop2]), 1)
+
+            forceinffullsex *= npow(1 - minimum(einsum('bm,bm,bmi,bkm,bm->bikm', transsexarr[:,:,t], condarr[:,:,t], alleff[:,pop1,t,:], effallprev[:,:,pop2],
+                                                       (wholeactssex != 0) ),1), wholeactssex[:,None,None,:])  # If wholeacts[t] == 0, then this will equal one so will not change forceinffull
+
+            for inds in regularityinds:  # Loops over the indices of acts for regular, casual, commercial so we don't overlap with pop1,pop2 pairs
+                forceinffull[:,:,pop1[inds],:,pop2[inds]] *= moveaxis(forceinffullsex[:,:,:,inds],-1,0)  # Slicing a more than 2d array puts the pop1,pop2 in the first dimension
+
+            if advancedtracking:
+                forceinffullsexinj = ones((nbatch, len(nonmtctmethods), nsus, npops, nstates, npops)) # Second dimension is method of transmission, everything else moves over one dimension.
+                forceinffullsexinj[:,methodsexpartnerarr[:,0],:,pop1,:,pop2] = moveaxis(forceinffullsex,-1,0)
+
+            if debug and ( not((forceinffull>=0).all()) or not((forceinffull<=1).all()) ):
+                for b in range(nbatch):
+                    for m,(_, p1, p2) in enumerate(methodsexpartnerarr):
+                        if not((forceinffull[b,:,p1,:,p2]>=0).all()) or not((forceinffull[b,:,p1,:,p2]<=1).all()):
+                            errormsg = label + 'Sexual force-of-infection is invalid between populations %s and %s, time %0.1f, FOI:\n%s)' % (
+                                popkeys[p1], popkeys[p2], tvec[t], forceinffull[b,:,p1,:,p2])
+                            for var,val in [('m',m), ('transsexarr[m,t]',transsexarr[b,m,t]), ('condarr[m,t]',condarr[b,m,t]), ('fracactssexarr[m,t]',fracactssexarr[b,m,t]), ('wholeactssexarr[m,t]',wholeactssexarr[b,m,t])]:
+                                errormsg += '\n%20s = %f' % (var, val)  # Print out extra debugging information
+                            raise OptimaException(errormsg)
+
+            ## Injection-related infections
+            pop1 = injpartnerarr[:, 0]
+            pop2 = injpartnerarr[:, 1]
+            wholeactsinj = wholeactsinjarr[:,:,t].astype(int)
+            forceinffullinj = ones((nbatch, nsus, nstates, len(pop1)))
+
+            forceinffullinj *= 1 - minimum(einsum('b,b,bm,bm,bm,bkm,i->bikm',transinj, osteff[:,t], sharing[:,pop1,t], prepeff[:,pop1,t],
+                                                  fracactsinjarr[:,:,t], effallprev[:,:,pop2], [1,1]),1) # The [1,1] applies the same risk to both circs and uncircs, as it does not matter
+
+            forceinffullinj *= npow(1 - minimum(einsum('b,b,bm,bm,bkm,i,bm->bikm',transinj, osteff[:,t], sharing[:,pop1,t], prepeff[:,pop1,t],
+                                                       effallprev[:,:,pop2], [1,1], (wholeactsinj != 0) ),1),
+                                    wholeactsinj[:,None,None,:])   # If wholeacts[t] == 0, then this will equal one so will not change forceinffull
+
+            forceinffull[:,:,pop1,:,pop2] *= moveaxis(forceinffullinj,-1,0)  # Slicing a more than 2d array puts the pop1,pop2 in the first dimension
+
+            if advancedtracking:
+                forceinffullsexinj[:,inj][:,:,pop1,:,pop2] = moveaxis(forceinffullinj,-1,0)
+
+            if debug and ( not((forceinffull>=0).all()) or not((forceinffull<=1).all()) ):
+                for b in range(nbatch):
+                    for m,(p1, p2) in enumerate(injpartnerarr):
+                        if not((forceinffull[b,:,p1,:,p2]>=0).all()) or not((forceinffull[b,:,p1,:,p2]<=1).all()):
+                            errormsg = label + 'Injection force-of-infection is invalid between populations %s and %s, time %0.1f, FOI:\n%s)' % (
+                                popkeys[p1], popkeys[p2], tvec[t], forceinffull[b,:,p1,:,p2])
+                            for var,val in [('m',m), ('transinj',transinj[b]), ('osteff[t]',osteff[b,t]), ('sharing[pop1,t]',sharing[b,p1,t]), ('prepeff[pop1,t]',prepeff[b,p1,t]), ('fracactsinjarr[m,t]',fracactsinjarr[b,m,t]), ('wholeactsinjarr[m,t]',wholeactsinjarr[b,m,t])]:
+                                errormsg += '\n%20s = %f' % (var, val)  # Print out extra debugging information
+                            raise OptimaException(errormsg)
+
+            # Probability of getting infected is one minus forceinffull times any scaling factors !! copied below !!
+            forceinffull  = einsum('bijkl,bj,bj,bj->bijkl', 1.-forceinffull, force, inhomo,(1.-background[:,:,t]))
+            infections_to = forceinffull.sum(axis=(3,4)) # Infections acquired through sex and injecting - by population who gets infected
+
+            # Calculate infections acquired and transmitted
+            raw_inci[:,:,t]             = einsum('bij,bijkl->bj', peoplet[:,sus,:], forceinffull)/dt
+            raw_incibypop[:,:,:,t]      = einsum('bij,bijkl->bkl',peoplet[:,sus,:], forceinffull)/dt
+
+            if advancedtracking:
+                # Some people (although small) will have gotten infected from both sex and injections, we have to split these intersections. Because the probabilities are all small, it probably would still be a good approximation without this correction
+                forceinffullsexinj = einsum('bmijkl,bj,bj,bj->bmijkl', 1-forceinffullsexinj, force, inhomo, (1.-background[:,:,t]))
+
+                # Now since for independent events Pr(A) + Pr(B) + Pr(C) =/= Pr(A ∪ B ∪ C) we need to adjust the probabilities so that they total the same as the forceinffull
+                # The way we estimate this is to take set Pr(A first) = Pr(A only) + Pr(all the intersections) * Pr(A) / sum(Pr(i)) that is split the intersections proportionally to the original probabilities
+                inds = where(forceinffull > 1e-6)
+                methodsprob = forceinffullsexinj[inds[0],:,inds[1],inds[2],inds[3],inds[4]].T # Methods along the first axis
+                singlemethodonlyprob = methodsprob * (1-methodsprob).prod(axis=0) / (1-methodsprob)
+                distributedmethodsprob = singlemethodonlyprob + (forceinffull[inds] - singlemethodonlyprob.sum(axis=0)) * methodsprob / methodsprob.sum(axis=0)
+                forceinffullsexinj[inds[0],:,inds[1],inds[2],inds[3],inds[4]] = distributedmethodsprob.T
+
+                # Probability of getting infected by each method is probsexinjsortindices times any scaling factors, !! copied from above !!
+                raw_incionpopbypopmethods[...,t][:,nonmtctmethods] = einsum('bij,bmijkl->bmjkl', peoplet[:,sus,:], forceinffullsexinj)/dt
+
+        infections_to = minimum(infections_to, 1.0-eps-background[:,:,t].max(axis=1)[:,None,None]) # Make sure it never exceeds the limit
 
         # Add these transition probabilities to the main array
         si = susreg[0] # susreg is a single element, but needs an index since can't index a list with an array
         pi = progcirc[0] # as above
         ui = undx[0]
-        thistransit[si,si,:] *= (1.-background[:,t]) - infections_to[si] # Index for moving from sus to sus
-        thistransit[si,ui,:] *= infections_to[si] # Index for moving from sus to infection
-        thistransit[pi,pi,:] *= (1.-background[:,t]) - infections_to[pi] # Index for moving from circ to circ
-        thistransit[pi,ui,:] *= infections_to[pi] # Index for moving from circ to infection
-
-        # Calculate infections acquired and transmitted
-        raw_inci[:,t]               = einsum('ij,ijkl->j', people[sus,:,t], forceinffull)/dt
-        raw_incibypop[:,:,t]        = einsum('ij,ijkl->kl',people[sus,:,t], forceinffull)/dt
-
-        if advancedtracking:
-            # Some people (although small) will have gotten infected from both sex and injections, we have to split these intersections. Because the probabilities are all small, it probably would still be a good approximation without this correction
-            forceinffullsexinj = einsum('mijkl,j,j,j->mijkl', 1-forceinffullsexinj, force, inhomo, (1.-background[:,t]))
-
-            # Now since for independent events Pr(A) + Pr(B) + Pr(C) =/= Pr(A ∪ B ∪ C) we need to adjust the probabilities so that they total the same as the forceinffull
-            # The way we estimate this is to take set Pr(A first) = Pr(A only) + Pr(all the intersections) * Pr(A) / sum(Pr(i)) that is split the intersections proportionally to the original probabilities
-            # forceinffullsexinj[:,inds[0],inds[1],inds[2],inds[3]] *= forceinffull[inds] / forceinffullsexinj[:,inds[0],inds[1],inds[2],inds[3]].sum(axis=0)
-
-            inds = where(forceinffull > 1e-6)
-            methodsprob = forceinffullsexinj[:,inds[0],inds[1],inds[2],inds[3]]
-            singlemethodonlyprob = methodsprob * (1-methodsprob).prod(axis=0) / (1-methodsprob)
-            distributedmethodsprob = singlemethodonlyprob + (forceinffull[inds] - singlemethodonlyprob.sum(axis=0)) * methodsprob / methodsprob.sum(axis=0)
-            forceinffullsexinj[:,inds[0],inds[1],inds[2],inds[3]] = distributedmethodsprob
-
-            # Probability of getting infected by each method is probsexinjsortindices times any scaling factors, !! copied from above !!
-            raw_incionpopbypopmethods[nonmtctmethods,:,:,:,t] = einsum('ij,mijkl->mjkl', people[sus,:,t], forceinffullsexinj)/dt
+        thistransit[:,transind[si,si],:] *= (1.-background[:,:,t]) - infections_to[:,si] # Index for moving from sus to sus
+        thistransit[:,transind[si,ui],:] *= infections_to[:,si] # Index for moving from sus to infection
+        thistransit[:,transind[pi,pi],:] *= (1.-background[:,:,t]) - infections_to[:,pi] # Index for moving from circ to circ
+        thistransit[:,transind[pi,ui],:] *= infections_to[:,pi] # Index for moving from circ to infection
 
 
         ##############################################################################################################
@@ -757,116 +997,124 @@ def model(simpars=None, settings=None, version=None, initpeople=None, initprops=
         ##############################################################################################################
 
         # Adjust transition rates
-        thistransit[nsus:,:,:] *= (1.-background[:,t])
+        thistransit[:,sparse['infected'],:] *= (1.-background[:,None,:,t])
 
         # Store deaths
-        raw_death[:,:,t]    = einsum('ij,ij,ij->ij', people[:,:,t], deathprob, transdeathmatrix[:,:,t])/dt
-        raw_emi[:,:,t]      = einsum('ij,j->ij',   people[:,:,t], emiprob[:,t])   /dt
-        raw_otherdeath[:,t] = einsum('ij,j->j',    people[:,:,t], backgrounddeath[:,t])/dt
+        raw_death[:,:,:,t]    = einsum('bij,bij,bij->bij', people[:,:,:,t], deathprob, transdeathmatrix[:,:,:,t])/dt
+        raw_emi[:,:,:,t]      = einsum('bij,bj->bij',   people[:,:,:,t], emiprob[:,:,t])   /dt
+        raw_otherdeath[:,:,t] = einsum('bij,bj->bj',    people[:,:,:,t], backgrounddeath[:,:,t])/dt
 
         ##############################################################################################################
         ### Calculate probabilities of shifting along cascade (if programmatically determined)
         ##############################################################################################################
 
-        def userate(prop,t):
-            if   t==0:             return True # Never force a proportion on the first timestep
-            elif isnan(prop[t-1]): return True # The previous timestep had a rate, so keep the rate here
-            else:                  return False # Neither: use a proportion instead of a rate
+        dxrate   = array([userate(propslist[0],t) for propslist in propslists]) # Whether each simulation uses a rate or a proportion for propdx
+        supprate = array([userate(propslist[3],t) for propslist in propslists]) # Ditto for propsupp
 
         # Undiagnosed to diagnosed
-        if userate(propdx,t): # Need to project forward one year to avoid mismatch
-            dxprobarr = tile(hivtest[:,t], (ncd4,1))
-            dxprobarr[aidsind:,:] =  maximum(aidstest[t],dxprobarr[aidsind:,:])
-        else: dxprobarr = zeros((ncd4,npops))
+        dxprobarr = tile(hivtest[:,None,:,t], (1,ncd4,1)) # Need to project forward one year to avoid mismatch
+        dxprobarr[:,aidsind:,:] =  maximum(aidstest[:,None,None,t],dxprobarr[:,aidsind:,:])
+        dxprobarr[~dxrate] = 0.
         # undx -> undx: thistransit[fromstate,tostate,:] *= (1.-dxprob[cd4]), cd4 state of fromstate
-        thistransit[ix_(undx, undx, arange(npops))]  *= einsum('ik,ij->ijk', (1.-dxprobarr[undx - undx[0],:]), fromtoarr[ix_(undx,undx)])
+        inds,cd4 = blocks['undx','undx'];    thistransit[:,inds,:] *= 1.-dxprobarr[:,cd4,:]
         # undx -> dx: thistransit[fromstate,tostate,:] *=  dxprob[cd4], cd4 state of fromstate
-        thistransit[ix_(undx, alldx, arange(npops))] *= einsum('ik,ij->ijk', dxprobarr[undx - undx[0],:], fromtoarr[ix_(undx,alldx)])
-        raw_diagcd4[:,:,t] += einsum('ij,ij->ij', people[undx,:,t], thistransit[ix_(undx, alldx, arange(npops))].sum(axis=1) ) /dt
+        inds,cd4 = blocks['undx','alldx'];   thistransit[:,inds,:] *= dxprobarr[:,cd4,:]
+        raw_diagcd4[:,:,:,t] += einsum('bij,bij->bij', peoplet[:,undx,:], einsum('bnj,in->bij', thistransit[:,inds,:], sparse['diagsum']) ) /dt
 
 
-        # Diagnosed/lost to care
-        if True: # userate(propcare,t): Put people onto care even if there is propcare set, propcare will adjust after the fact. Otherwise, propcare doesn't link people to care at the rate that people should be (because theres enough in care) and we get too many people diagnosed but not linked.
-            careprobarr   = tile(linktocare[:,t],   (ncd4,1))
-            returnprobarr = tile(returntocare[:,t], (ncd4,1))
-            careprobarr[aidsind:,:] = maximum(aidslinktocare[t], careprobarr[aidsind:,:])  #people with AIDS potentially linked to care faster than people with high CD4 counts (at least historically)
-            returnprobarr[aidsind:,:] = 1. - (1.-aidstest[t])*(1.-returntocare[:,t])  #people with AIDS who are lost to follow-up may be returned to care based on re-testing or return to care adherence, independently
-        else:
-            careprobarr   = zeros((ncd4,npops))
-            returnprobarr = zeros((ncd4,npops))
+        # Diagnosed/lost to care -- put people onto care even if there is propcare set, propcare will adjust after the fact. Otherwise, propcare doesn't link people to care at the rate that people should be (because theres enough in care) and we get too many people diagnosed but not linked.
+        careprobarr   = tile(linktocare[:,None,:,t],   (1,ncd4,1))
+        returnprobarr = tile(returntocare[:,None,:,t], (1,ncd4,1))
+        careprobarr[:,aidsind:,:] = maximum(aidslinktocare[:,None,None,t], careprobarr[:,aidsind:,:])  #people with AIDS potentially linked to care faster than people with high CD4 counts (at least historically)
+        returnprobarr[:,aidsind:,:] = 1. - (1.-aidstest[:,None,None,t])*(1.-returntocare[:,None,:,t])  #people with AIDS who are lost to follow-up may be returned to care based on re-testing or return to care adherence, independently
         # dx -> dx: thistransit[fromstate,tostate,:] *= (1.-careprob[cd4]), cd4 state of fromstate
-        thistransit[ix_(dx, dx, arange(npops))]  *= einsum('ik,ij->ijk', (1.-careprobarr[(dx-dx[0])%ncd4,:]), fromtoarr[ix_(dx,dx)])
+        inds,cd4 = blocks['dx','dx'];        thistransit[:,inds,:] *= 1.-careprobarr[:,cd4,:]
         # dx -> allincare: thistransit[fromstate,tostate,:] *=  careprob[cd4], cd4 state of fromstate
-        thistransit[ix_(dx, allcare, arange(npops))] *= einsum('ik,ij->ijk', careprobarr[(dx-dx[0])%ncd4,:], fromtoarr[ix_(dx,allcare)])
+        inds,cd4 = blocks['dx','allcare'];   thistransit[:,inds,:] *= careprobarr[:,cd4,:]
         # lost -> lost: thistransit[fromstate,tostate,:] *=  (1.-returnprob[cd4]), cd4 state of fromstate
-        thistransit[ix_(lost, lost, arange(npops))]  *= einsum('ik,ij->ijk', (1.-returnprobarr[(lost-lost[0])%ncd4,:]), fromtoarr[ix_(lost,lost)])
+        inds,cd4 = blocks['lost','lost'];    thistransit[:,inds,:] *= 1.-returnprobarr[:,cd4,:]
         # lost -> allincare: thistransit[fromstate,tostate,:] *=  returnprob[cd4], cd4 state of fromstate
-        thistransit[ix_(lost, allcare, arange(npops))] *= einsum('ik,ij->ijk', returnprobarr[(lost-lost[0])%ncd4,:], fromtoarr[ix_(lost,allcare)])
+        inds,cd4 = blocks['lost','allcare']; thistransit[:,inds,:] *= returnprobarr[:,cd4,:]
 
 
-        # Care/USVL/SVL to lost
-        if True: # userate(propcare,t): People get lost to care even if there is propcare set, propcare will adjust after the fact.
-            lossprobarr = tile(leavecare[:,t], (ncd4, 1))
-            lossprobarr[aidsind:, :] = minimum(aidsleavecare[t], lossprobarr[aidsind:, :])
-        else: lossprobarr = zeros((ncd4,npops))
+        # Care/USVL/SVL to lost -- people get lost to care even if there is propcare set, propcare will adjust after the fact.
+        lossprobarr = tile(leavecare[:,None,:,t], (1, ncd4, 1))
+        lossprobarr[:,aidsind:, :] = minimum(aidsleavecare[:,None,None,t], lossprobarr[:,aidsind:, :])
         # allcare -> allcare: thistransit[fromstate,tostate,:] *=  (1.-lossprob[cd4]), cd4 state of fromstate
-        thistransit[ix_(allcare, allcare, arange(npops))]  *= einsum('ik,ij->ijk', (1.-lossprobarr[(allcare-allcare[0])%ncd4,:]), fromtoarr[ix_(allcare,allcare)])
+        inds,cd4 = blocks['allcare','allcare']; thistransit[:,inds,:] *= 1.-lossprobarr[:,cd4,:]
         # allincare -> lost: thistransit[fromstate,tostate,:] *=  lossprob[cd4], cd4 state of fromstate
-        thistransit[ix_(allcare, lost, arange(npops))]  *= einsum('ik,ij->ijk', lossprobarr[(allcare-allcare[0])%ncd4,:], fromtoarr[ix_(allcare,lost)])
+        inds,cd4 = blocks['allcare','lost'];    thistransit[:,inds,:] *= lossprobarr[:,cd4,:]
 
         # SVL to USVL
-        usvlprob = treatfail[t] if userate(propsupp,t) else 0.
+        usvlprob = where(supprate, treatfail[:,t], 0.)
         # svl -> svl: thistransit[fromstate,tostate,:] *=  (1.-usvlprob)
-        thistransit[ix_(svl, svl, arange(npops))]  *= einsum(',k,ij->ijk', (1.-usvlprob), ones(npops), fromtoarr[ix_(svl,svl)])
+        inds,_ = blocks['svl','svl'];   thistransit[:,inds,:] *= (1.-usvlprob)[:,None,None]
         # svl -> usvl: thistransit[fromstate,tostate,:] *=  usvlprob
-        thistransit[ix_(svl, usvl, arange(npops))]  *= einsum(',k,ij->ijk', usvlprob, ones(npops), fromtoarr[ix_(svl,usvl)])
+        inds,_ = blocks['svl','usvl'];  thistransit[:,inds,:] *= usvlprob[:,None,None]
 
         # USVL to SVL
-        svlprob = min(regainvs[t]*numvlmon[t]*dt/(eps+people[alltx,:,t].sum()),1) if userate(propsupp,t) else 0.
+        svlprob = where(supprate, minimum(regainvs[:,t]*numvlmon[:,t]*dt/(eps+peoplet[:,alltx,:].sum(axis=(1,2))),1), 0.)
         # usvl -> usvl: thistransit[fromstate,tostate,:] *=  (1.-svlprob)
-        thistransit[ix_(usvl, usvl, arange(npops))]  *= einsum(',k,ij->ijk', (1.-svlprob), ones(npops), fromtoarr[ix_(usvl,usvl)])
+        inds,_ = blocks['usvl','usvl']; thistransit[:,inds,:] *= (1.-svlprob)[:,None,None]
         # usvl -> svl: thistransit[fromstate,tostate,:] *=  svlprob
-        thistransit[ix_(usvl, svl, arange(npops))]  *= einsum(',k,ij->ijk', svlprob, ones(npops), fromtoarr[ix_(usvl,svl)])
+        inds,_ = blocks['usvl','svl'];  thistransit[:,inds,:] *= svlprob[:,None,None]
 
-        # Check that probabilities all sum to 1
         if debug:
-            transtest = array([(abs(thistransit[j,:,:].sum(axis=0)/(1.-background[:,t])+deathprob[j]*transdeathmatrix[j,:,t]-ones(npops))>eps).any() for j in range(nstates)])
-            if any(transtest):
-                wrongstatesindices = findinds(transtest)
-                wrongstates = [settings.statelabels[j] for j in wrongstatesindices]
-                wrongprobs = array([thistransit[j,:,:].sum(axis=0)/(1.-background[:,t])+deathprob[j]*transdeathmatrix[j,:,t] for j in wrongstatesindices])
-                errormsg = label + 'Transitions do not sum to 1 at time t=%f for states %s: sums are \n%s' % (tvec[t], wrongstates, wrongprobs)
-                raise OptimaException(errormsg)
+            for b in range(nbatch):
+                # Check that probabilities all sum to 1
+                transsums = zeros((nstates, npops))
+                add.at(transsums, transfrom, thistransit[b]) # Sum over the states each state can go to
+                transtest = array([(abs(transsums[j]/(1.-background[b,:,t])+deathprob[b,j]*transdeathmatrix[b,j,:,t]-ones(npops))>eps).any() for j in range(nstates)])
+                if any(transtest):
+                    wrongstatesindices = findinds(transtest)
+                    wrongstates = [settings.statelabels[j] for j in wrongstatesindices]
+                    wrongprobs = array([transsums[j]/(1.-background[b,:,t])+deathprob[b,j]*transdeathmatrix[b,j,:,t] for j in wrongstatesindices])
+                    errormsg = label + 'Transitions do not sum to 1 at time t=%f for states %s: sums are \n%s' % (tvec[t], wrongstates, wrongprobs)
+                    raise OptimaException(errormsg)
 
-        # Check that no probabilities are less than 0
-        if debug and any([(thistransit[k]<0).any() for k in range(nstates)]):
-            wrongstatesindices = [k for k in range(nstates) if (thistransit[k]<0.).any()]
-            wrongstates = [settings.statelabels[j] for j in wrongstatesindices]
-            wrongprobs = array([thistransit[j][1] for j in wrongstatesindices])
-            errormsg = label + 'Transitions are less than 0 at time t=%f for states %s: sums are \n%s' % (tvec[t], wrongstates, wrongprobs)
-            raise OptimaException(errormsg)
+                # Check that no probabilities are less than 0
+                if (thistransit[b]<0).any():
+                    wrongstatesindices = unique(transfrom[(thistransit[b]<0.).any(axis=1)])
+                    wrongstates = [settings.statelabels[j] for j in wrongstatesindices]
+                    wrongprobs = [thistransit[b,transfrom==j] for j in wrongstatesindices]
+                    errormsg = label + 'Transitions are less than 0 at time t=%f for states %s: sums are \n%s' % (tvec[t], wrongstates, wrongprobs)
+                    raise OptimaException(errormsg)
 
         ## Shift people as required
         if t<npts-1:
-            people[:,:,t+1] += einsum('ij,ikj->kj',people[:,:,t],thistransit[:,:,:])  # Assuming that there are no illegal tranfers in thistransit
+            if usejit:
+                flowkernel(peoplet, transfrom, transto, thistransit, people[:,:,:,t+1])
+            else:
+                flows = peoplet[:,transfrom,:]*thistransit # Number of people making each legal transition
+                people[:,:,:,t+1][:,sparse['tostates']] += add.reduceat(flows[:,sparse['toorder'],:], sparse['tostarts'], axis=1) # Sum the flows into each state
 
 
         ##############################################################################################################
         ### Calculate births
         ##############################################################################################################
 
-        undxhivbirths, dxhivbirths, thisproppmtct = do_births(t, npts, dt, eps, birthratesarr, relhivbirth, people, npops, version, undx, dx, alldx, alltx, allplhiv, sus,mtct,nstates,dxnottx,
-              motherpops, childpops, notmotherpops, effmtct, pmtcteff, plhivmap, advancedtracking, settings, mtctgroupmap, tvec,
-              numpmtct, proppmtct, raw_inci, raw_incibypop, raw_diagcd4, raw_incionpopbypopmethods, raw_mtct,
-              raw_births, raw_hivbirths, raw_dxforpmtct, raw_receivepmtct, debug)
+        undxhivbirths = zeros((nbatch, npops))
+        dxhivbirths   = zeros((nbatch, npops))
+        thisproppmtct = zeros(nbatch)
+        for b,setup in enumerate(setups):
+            if usejit and newbirths:
+                motherpops, childpops = birthpops[b]
+                thisproppmtct[b] = birthskernel(t, npts, dt, eps, setup['birthratesarr'], float(setup['relhivbirth']), people[b], undx, dx, dxnottxarr, alltx, motherpops, childpops,
+                                                setup['effmtct'][t], setup['pmtcteff'][t], setup['numpmtct'][t], setup['proppmtct'][t], mtctgroupmap, raw_inci[b], raw_incibypop[b], raw_diagcd4[b], raw_mtct[b],
+                                                raw_births[b], raw_hivbirths[b], raw_dxforpmtct[b], raw_receivepmtct[b], undxhivbirths[b], dxhivbirths[b])
+                continue
+            undxhivbirths[b], dxhivbirths[b], thisproppmtct[b] = do_births(t, npts, dt, eps, setup['birthratesarr'], setup['relhivbirth'], people[b], npops, version, undx, dx, alldx, alltx, allplhiv, sus,mtct,nstates,dxnottx,
+                  setup['motherpops'], setup['childpops'], setup['notmotherpops'], setup['effmtct'], setup['pmtcteff'], plhivmap, advancedtracking, settings, mtctgroupmap, tvec,
+                  setup['numpmtct'], setup['proppmtct'], raw_inci[b], raw_incibypop[b], raw_diagcd4[b], raw_incionpopbypopmethods[b], raw_mtct[b],
+                  raw_births[b], raw_hivbirths[b], raw_dxforpmtct[b], raw_receivepmtct[b], debug)
 
 
         ##############################################################################################################
         ### Check infection consistency
         ##############################################################################################################
 
-        if debug and abs(raw_inci[:,t].sum() - raw_incibypop[:,:,t].sum()) > eps:
-            errormsg = label + 'Number of infections received (%f) is not equal to the number of infections caused (%f) at time %i' % (raw_inci[:,t].sum(), raw_incibypop[:,:,t].sum(), t)
+        if debug and (abs(raw_inci[:,:,t].sum(axis=1) - raw_incibypop[:,:,:,t].sum(axis=(1,2))) > eps).any():
+            errormsg = label + 'Number of infections received (%s) is not equal to the number of infections caused (%s) at time %i' % (raw_inci[:,:,t].sum(axis=1), raw_incibypop[:,:,:,t].sum(axis=(1,2)), t)
             if die: raise OptimaException(errormsg)
             else: printv(errormsg, 1, verbose)
 
@@ -875,82 +1123,88 @@ def model(simpars=None, settings=None, version=None, initpeople=None, initprops=
         ###############################################################################
         if t<npts-1:
             ## Births
-            people[susreg, :, t+1] += raw_births[:,t]*dt - undxhivbirths - dxhivbirths # HIV- babies assigned to uncircumcised compartment
-            people[undx[0],:, t+1] += undxhivbirths # HIV+ babies born to undiagnosed mothers assigned to undiagnosed compartment
-            people[dx[0],  :, t+1] += dxhivbirths   # HIV+ babies born to diagnosed mothers assigned to diagnosed
+            people[:,susreg, :, t+1] += raw_births[:,:,t]*dt - undxhivbirths - dxhivbirths # HIV- babies assigned to uncircumcised compartment
+            people[:,undx[0],:, t+1] += undxhivbirths # HIV+ babies born to undiagnosed mothers assigned to undiagnosed compartment
+            people[:,dx[0],  :, t+1] += dxhivbirths   # HIV+ babies born to diagnosed mothers assigned to diagnosed
 
             ## Immigration
-            people[:,:,t+1] += raw_immi[:,:,t]*dt #unannualise
+            people[:,:,:,t+1] += raw_immi[:,:,:,t]*dt #unannualise
 
             ## Circumcision
-            circppl = minimum(numcirc[:,t+1], people[susreg,:,t+1])
-            people[susreg,:,t+1]   -= circppl
-            people[progcirc,:,t+1] += circppl
+            circppl = minimum(numcirc[:,:,t+1], people[:,susreg,:,t+1])
+            people[:,susreg,:,t+1]   -= circppl
+            people[:,progcirc,:,t+1] += circppl
 
             # The old model here had a small bug: people are moved into the next class, and then some of those will move into the next class, skipping an age group
-            if compareversions(version,"2.12.0") < 0:  # This code is kept in to not change the calibrations for versions 2.11.x and below
-                ## Age-related transitions
-                for p1,p2,thisagetransprob in agetransitlist:
-                    thisagerate = agelist[p1][p2][t]
-                    peopleleaving = people[:, p1, t+1] * thisagerate #thisagetransprob
-                    if debug and (peopleleaving > people[:, p1, t+1]).any():
-                        errormsg = label + 'Age transitions between pops %s and %s at time %i are too high: the age transitions you specified say that %f%% of the population should age in a single time-step.' % (popkeys[p1], popkeys[p2], t+1, agetransit[p1, p2]*100.)
-                        if die: raise OptimaException(errormsg)
-                        else:   printv(errormsg, 1, verbose)
-                        peopleleaving = minimum(peopleleaving, people[:, p1, t]) # Ensure positive
+            if oldageing:  # This code is kept in to not change the calibrations for versions 2.11.x and below
+                for b,setup in enumerate(setups):
+                    thispeople = people[b]
+                    ## Age-related transitions
+                    for p1,p2,thisagetransprob in setup['agetransitlist']:
+                        thisagerate = setup['agelist'][p1][p2][t]
+                        peopleleaving = thispeople[:, p1, t+1] * thisagerate #thisagetransprob
+                        if debug and (peopleleaving > thispeople[:, p1, t+1]).any():
+                            errormsg = label + 'Age transitions between pops %s and %s at time %i are too high: the age transitions you specified say that %f%% of the population should age in a single time-step.' % (popkeys[p1], popkeys[p2], t+1, setup['agetransit'][p1, p2]*100.)
+                            if die: raise OptimaException(errormsg)
+                            else:   printv(errormsg, 1, verbose)
+                            peopleleaving = minimum(peopleleaving, thispeople[:, p1, t]) # Ensure positive
 
-                    people[:, p1, t+1] -= peopleleaving # Take away from pop1...
-                    people[:, p2, t+1] += peopleleaving # ... then add to pop2
+                        thispeople[:, p1, t+1] -= peopleleaving # Take away from pop1...
+                        thispeople[:, p2, t+1] += peopleleaving # ... then add to pop2
 
-                    if advancedtracking:
-                        raw_transitpopbypop[p2,allplhiv,p1, t+1] += peopleleaving[allplhiv]/dt #annualize
+                        if advancedtracking:
+                            raw_transitpopbypop[b][p2,allplhiv,p1, t+1] += peopleleaving[allplhiv]/dt #annualize
 
 
-                ## Risk-related transitions
-                for p1,p2,thisrisktransprob in risktransitlist:
-                    peoplemoving1 = people[:, p1, t+1] * thisrisktransprob  # Number of other people who are moving pop1 -> pop2
-                    peoplemoving2 = people[:, p2, t+1] * thisrisktransprob * (sum(people[:, p1, t+1])/sum(people[:, p2, t+1])) # Number of people who moving pop2 -> pop1, correcting for population size
-                    # Symmetric flow in totality, but the state distribution will ideally change.
-                    people[:, p1, t+1] += peoplemoving2 - peoplemoving1 # NOTE: this should not cause negative people; peoplemoving1 is guaranteed to be strictly greater than 0 and strictly less that people[:, p1, t+1]
-                    people[:, p2, t+1] += peoplemoving1 - peoplemoving2 # NOTE: this should not cause negative people; peoplemoving2 is guaranteed to be strictly greater than 0 and strictly less that people[:, p2, t+1]
+                    ## Risk-related transitions
+                    for p1,p2,thisrisktransprob in setup['risktransitlist']:
+                        peoplemoving1 = thispeople[:, p1, t+1] * thisrisktransprob  # Number of other people who are moving pop1 -> pop2
+                        peoplemoving2 = thispeople[:, p2, t+1] * thisrisktransprob * (sum(thispeople[:, p1, t+1])/sum(thispeople[:, p2, t+1])) # Number of people who moving pop2 -> pop1, correcting for population size
+                        # Symmetric flow in totality, but the state distribution will ideally change.
+                        thispeople[:, p1, t+1] += peoplemoving2 - peoplemoving1 # NOTE: this should not cause negative people; peoplemoving1 is guaranteed to be strictly greater than 0 and strictly less that people[:, p1, t+1]
+                        thispeople[:, p2, t+1] += peoplemoving1 - peoplemoving2 # NOTE: this should not cause negative people; peoplemoving2 is guaranteed to be strictly greater than 0 and strictly less that people[:, p2, t+1]
 
-                    if advancedtracking:
-                        raw_transitpopbypop[p2,allplhiv,p1, t+1] += peoplemoving1[allplhiv]/dt #annualize
-                        raw_transitpopbypop[p1,allplhiv,p2, t+1] += peoplemoving2[allplhiv]/dt #annualize
+                        if advancedtracking:
+                            raw_transitpopbypop[b][p2,allplhiv,p1, t+1] += peoplemoving1[allplhiv]/dt #annualize
+                            raw_transitpopbypop[b][p1,allplhiv,p2, t+1] += peoplemoving2[allplhiv]/dt #annualize
+            elif usejit: # Compiled version of the ageing and risk transitions below
+                transitkernel(people[:,:,:,t+1], agearr[:,:,:,t], risktransitarr)
             else: # This version below is quicker and more accurate but produces results that are 0.5% different
                 ## Age-related transitions
-                peoplefromto = einsum('ki,ij->kij', people[:,:,t+1], agearr[:,:,t])
+                peoplefromto = einsum('bki,bij->bkij', people[:,:,:,t+1], agearr[:,:,:,t])
 
-                if debug and (peoplefromto.sum(axis=2) > people[:,:,t+1]).any():
-                    errormsg = label + f'Age transitions at time {t+1} are too high: the age transitions you specified say that {agearr[:,:,t]*100}% of the population should age in a single time-step.'
+                if debug and (peoplefromto.sum(axis=3) > people[:,:,:,t+1]).any():
+                    errormsg = label + f'Age transitions at time {t+1} are too high: the age transitions you specified say that {agearr[:,:,:,t]*100}% of the population should age in a single time-step.'
                     if die: raise OptimaException(errormsg)
                     else:   printv(errormsg, 1, verbose)
-                    peoplefromto = einsum('ki,ij->kij', people[:,:,t+1], minimum(agearr[:,:,t],1) ) # Only shift 100%
+                    peoplefromto = einsum('bki,bij->bkij', people[:,:,:,t+1], minimum(agearr[:,:,:,t],1) ) # Only shift 100%
 
-                people[:,:,t+1] -= peoplefromto.sum(axis=2)  # sum over popto    # Ageing from a population
-                people[:,:,t+1] += peoplefromto.sum(axis=1)  # sum over popfrom  # Ageing to a population
+                people[:,:,:,t+1] -= peoplefromto.sum(axis=3)  # sum over popto    # Ageing from a population
+                people[:,:,:,t+1] += peoplefromto.sum(axis=2)  # sum over popfrom  # Ageing to a population
                 if advancedtracking:
-                    raw_transitpopbypop[:,allplhiv,:,t+1] += swapaxes(peoplefromto[allplhiv,:,:],1,2) / dt  # annualize
+                    for b in range(nbatch): raw_transitpopbypop[b][:,allplhiv,:,t+1] += swapaxes(peoplefromto[b][allplhiv,:,:],1,2) / dt  # annualize
 
                 # ## Risk-related transitions
-                # peoplefromto1: statetofrom, popfrom, popto
-                peoplefromto1 = einsum('ki,ij->kij', people[:,:,t+1], risktransitarr[:,:]) # Number of other people who are moving pop1 -> pop2
-                peoplefromto2 = einsum('kj,ij,i,j->kij', people[:,:,t+1], risktransitarr[:,:], people[:,:,t+1].sum(axis=0), 1/people[:,:,t+1].sum(axis=0)) # Number of people who moving pop2 -> pop1, correcting for population size
+                # peoplefromto1: batch, statetofrom, popfrom, popto
+                popsizes = people[:,:,:,t+1].sum(axis=1)
+                peoplefromto1 = einsum('bki,bij->bkij', people[:,:,:,t+1], risktransitarr) # Number of other people who are moving pop1 -> pop2
+                peoplefromto2 = einsum('bkj,bij,bi,bj->bkij', people[:,:,:,t+1], risktransitarr, popsizes, 1/popsizes) # Number of people who moving pop2 -> pop1, correcting for population size
 
-                if debug and ( (peoplefromto1.sum(axis=2) > people[:,:,t+1]).any() or (swapaxes(peoplefromto2,1,2).sum(axis=2) > people[:,:,t+1]).any() ):
+                if debug and ( (peoplefromto1.sum(axis=3) > people[:,:,:,t+1]).any() or (swapaxes(peoplefromto2,2,3).sum(axis=3) > people[:,:,:,t+1]).any() ):
                     errormsg = label + f'Risk transitions at time {t+1} are too high: the age transitions you specified say that {risktransitarr*100}% of the population should transfer in a single time-step.'
                     if die: raise OptimaException(errormsg)
                     else:   printv(errormsg, 1, verbose)
-                    peoplefromto1 = einsum('ki,ij->kij', people[:,:,t+1], minimum(risktransitarr[:,:], 1)) # Only shift 100%
-                    peoplefromto2 = einsum('kj,ij,i,j->kij', people[:,:,t+1], minimum(risktransitarr[:,:], 1), people[:,:,t+1].sum(axis=0), 1/people[:,:,t+1].sum(axis=0)) # Only shift 100%
+                    peoplefromto1 = einsum('bki,bij->bkij', people[:,:,:,t+1], minimum(risktransitarr, 1)) # Only shift 100%
+                    peoplefromto2 = einsum('bkj,bij,bi,bj->bkij', people[:,:,:,t+1], minimum(risktransitarr, 1), popsizes, 1/popsizes) # Only shift 100%
 
-                people[:,:,t+1] -= peoplefromto1.sum(axis=2)
-                people[:,:,t+1] += peoplefromto1.sum(axis=1) # Symmetric flow in totality, but the state distribution will ideally change.
-                people[:,:,t+1] -= swapaxes(peoplefromto2,1,2).sum(axis=2)
-                people[:,:,t+1] += swapaxes(peoplefromto2,1,2).sum(axis=1)
+                people[:,:,:,t+1] -= peoplefromto1.sum(axis=3)
+                people[:,:,:,t+1] += peoplefromto1.sum(axis=2) # Symmetric flow in totality, but the state distribution will ideally change.
+                people[:,:,:,t+1] -= swapaxes(peoplefromto2,2,3).sum(axis=3)
+                people[:,:,:,t+1] += swapaxes(peoplefromto2,2,3).sum(axis=2)
                 if advancedtracking:
-                    raw_transitpopbypop[:,allplhiv,:,t+1] += swapaxes(peoplefromto1[allplhiv,:,:],1,2)/dt #annualize
-                    raw_transitpopbypop[:,allplhiv,:,t+1] += peoplefromto2[allplhiv,:,:]/dt #annualize
+                    for b in range(nbatch):
+                        raw_transitpopbypop[b][:,allplhiv,:,t+1] += swapaxes(peoplefromto1[b][allplhiv,:,:],1,2)/dt #annualize
+                        raw_transitpopbypop[b][:,allplhiv,:,t+1] += peoplefromto2[b][allplhiv,:,:]/dt #annualize
 
 
             ###############################################################################
@@ -958,162 +1212,265 @@ def model(simpars=None, settings=None, version=None, initpeople=None, initprops=
             ###############################################################################
 
             # Reconcile population sizes for populations with no inflows
-            thissusreg = people[susreg,noinflows,t+1] # WARNING, will break if susreg is not a scalar index!
-            thisprogcirc = people[progcirc,noinflows,t+1]
+            thissusreg = people[:,susreg,noinflows,t+1] # WARNING, will break if susreg is not a scalar index!
+            thisprogcirc = people[:,progcirc,noinflows,t+1]
             allsus = thissusreg+thisprogcirc
-            if debug and not all(allsus>0):
-                errormsg = label + '100%% prevalence detected (t=%f, pop=%s)' % (t+1, array(popkeys)[findinds(allsus>0)][0])
+            if debug and not (allsus>0).all():
+                errormsg = label + '100%% prevalence detected (t=%f, pop=%s)' % (t+1, array(popkeys)[noinflows][findinds(allsus.min(axis=0)<=0)][0])
                 raise OptimaException(errormsg)
-            newpeople = popsize[noinflows,t+1] - people[:,:,t+1][:,noinflows].sum(axis=0) # Number of people to add according to simpars['popsize'] (can be negative)
-            people[susreg,noinflows,t+1]   += newpeople*thissusreg/allsus # Add new people
-            people[progcirc,noinflows,t+1] += newpeople*thisprogcirc/allsus # Add new people
-            raw_popadjustments[noinflows,t+1] += newpeople #track how many new people we added (or removed)
+            newpeople = popsize[:,noinflows,t+1] - people[:,:,:,t+1][:,:,noinflows].sum(axis=1) # Number of people to add according to simpars['popsize'] (can be negative)
+            people[:,susreg,noinflows,t+1]   += newpeople*thissusreg/allsus # Add new people
+            people[:,progcirc,noinflows,t+1] += newpeople*thisprogcirc/allsus # Add new people
+            raw_popadjustments[:,noinflows,t+1] += newpeople #track how many new people we added (or removed)
 
             # Check population sizes are correct
-            actualpeople = people[:,:,t+1][:,noinflows].sum()
-            wantedpeople = popsize[noinflows,t+1].sum()
-            if debug and abs(actualpeople-wantedpeople)>1.0: # Nearest person is fiiiiine
-                errormsg = label + 'Population size inconsistent at time t=%f: %f vs. %f' % (tvec[t+1], actualpeople, wantedpeople)
-                raise OptimaException(errormsg)
+            if debug:
+                actualpeople = people[:,:,:,t+1][:,:,noinflows].sum(axis=(1,2))
+                wantedpeople = popsize[:,noinflows,t+1].sum(axis=1)
+                if (abs(actualpeople-wantedpeople)>1.0).any(): # Nearest person is fiiiiine
+                    errormsg = label + 'Population size inconsistent at time t=%f: %s vs. %s' % (tvec[t+1], actualpeople, wantedpeople)
+                    raise OptimaException(errormsg)
 
-            # If required, scale population sizes to exactly match the parameters
-            if forcepopsize:
-                relerr = 0.1 # Set relative error tolerance
-                for p in range(npops):
-                    susnotonart = cat([sus,notonart])
-                    actualpeople = people[susnotonart,p,t+1].sum()
-                    wantedpeople = popsize[p,t+1] - people[alltx,p,t+1].sum()
-                    if actualpeople==0: raise Exception("ERROR: no people.")
-                    ratio = wantedpeople/actualpeople
-                    if abs(ratio-1)>relerr: # It's not OK
-                        errormsg = label + 'Warning, expected population size is nowhere near calculated population size (t=%f, pop=%s, wanted=%f, actual=%f, ratio=%f)' % (t, popkeys[p], wantedpeople, actualpeople, ratio)
-                        if die: raise OptimaException(errormsg)
-                        else: printv(errormsg, 1, verbose=verbose)
-                    
-                    raw_popadjustments[p,t+1] += wantedpeople - actualpeople
-                    people[susnotonart,p,t+1] *= ratio # It's OK, so scale to match
+            for b,setup in enumerate(setups):
+                thispeople = people[b]
+
+                # If required, scale population sizes to exactly match the parameters
+                if setup['forcepopsize']:
+                    relerr = 0.1 # Set relative error tolerance
+                    for p in range(npops):
+                        susnotonart = cat([sus,notonart])
+                        actualpeople = thispeople[susnotonart,p,t+1].sum()
+                        wantedpeople = popsize[b,p,t+1] - thispeople[alltx,p,t+1].sum()
+                        if actualpeople==0: raise Exception("ERROR: no people.")
+                        ratio = wantedpeople/actualpeople
+                        if abs(ratio-1)>relerr: # It's not OK
+                            errormsg = label + 'Warning, expected population size is nowhere near calculated population size (t=%f, pop=%s, wanted=%f, actual=%f, ratio=%f)' % (t, popkeys[p], wantedpeople, actualpeople, ratio)
+                            if die: raise OptimaException(errormsg)
+                            else: printv(errormsg, 1, verbose=verbose)
+
+                        raw_popadjustments[b,p,t+1] += wantedpeople - actualpeople
+                        thispeople[susnotonart,p,t+1] *= ratio # It's OK, so scale to match
+
+                ## Proportions -- these happen after the Euler step, which is why it's t+1 instead of t
+                do_props(t, npts, dt, eps, ncd4, thispeople, propstructs[b], thisproppmtct[b], setup['numtx'], setup['treatvs'], tvec, setup['allcd4eligibletx'], care, usvl, svl, lost)
+
+                if debug: checkfornegativepeople(thispeople, tvec=tvec, popkeys=popkeys, settings=settings, label=label, die=die, verbose=verbose, tind=t+1) # If debugging, check for negative people on every timestep
+
+    rawlist = []
+    for b in range(nbatch):
+        raw                   = odict()    # Sim output structure
+        raw['tvec']           = tvec
+        raw['popkeys']        = popkeys
+        raw['people']         = people[b]
+        raw['inci']           = raw_inci[b]
+        raw['incibypop']      = raw_incibypop[b]
+        raw['mtct']           = raw_mtct[b]
+        raw['births']         = raw_births[b]
+        raw['hivbirths']      = raw_hivbirths[b]
+        raw['immi']           = raw_immi[b]
+        raw['pmtct']          = raw_receivepmtct[b]
+        raw['diag']           = raw_diagcd4[b].sum(axis=0) # Sum over cd4 count
+        raw['diagpmtct']      = raw_dxforpmtct[b]
+        raw['newtreat']       = raw_newtreat[b]
+        raw['death']          = raw_death[b]
+        raw['otherdeath']     = raw_otherdeath[b]
+        raw['emigration']     = raw_emi[b]
+        if advancedtracking:
+            raw['diagcd4']         = raw_diagcd4[b]
+            raw['incimethods']     = flatten_unflatten_func(raw_incionpopbypopmethods[b], axes_flatten=(0, 1, 2, 3), doflatten=flattenraw) # Axis 0 is method, 1 is acquired pop, 2-3 is cd4 state and pop of from pop
+            raw['transitpopbypop'] = flatten_unflatten_func(raw_transitpopbypop[b], axes_flatten=(0, 1, 2), doflatten=flattenraw)
+            raw['props']           = raw_propsarr[b]
+            raw['popadjustments']  = raw_popadjustments[b]
+        if snapshots:
+            raw['snapshots']       = rawsnapshots[b]
 
+        checkfornegativepeople(people[b], tvec=tvec, popkeys=popkeys, settings=settings, label=label, die=die, verbose=verbose) # Check only once for negative people, right before finishing
+        rawlist.append(raw)
 
-            #######################################################################################
-            ## Proportions -- these happen after the Euler step, which is why it's t+1 instead of t
-            #######################################################################################
+    return rawlist # Return raw results
 
-            for name,proplist in propstruct.items():
-                prop, lowerstate, tostate, numer, denom, raw_new, fixyear = proplist
 
-                if fixyear==t: # Fixing the proportion from this timepoint
-                    if not name == 'proppmtct':
-                        calcprop = people[numer,:,t].sum()/(eps+people[denom,:,t].sum()) # This is the value we fix it at
-                    else:
-                        calcprop = thisproppmtct  # proppmtct is calculated earlier in the timestep so we don't need to recalc
-                    naninds    = findinds(isnan(prop)) # Find the indices that are nan -- to be replaced by current values
-                    infinds    = findinds(isinf(prop)) # Find indices that are infinite -- to be scaled up/down to a target value
-                    finiteinds = findinds(isfinite(prop)) # Find indices that are defined
-                    finiteind = npts-1 if not len(finiteinds) else finiteinds[0] # Get first finite index, or else just last point -- latter should not actually matter
-                    naninds = naninds[naninds>t] # Trim ones that are less than the current point
-                    infinds = infinds[infinds>t] # Trim ones that are less than the current point
-                    ninterppts = len(infinds) # Number of points to interpolate over
-                    if len(naninds): prop[naninds] = calcprop # Replace nans with current proportion
-                    if len(infinds): prop[infinds] = interp(range(ninterppts), [0,ninterppts-1], [calcprop,prop[finiteind]]) # Replace infinities with scale-up/down
-
-                if name == 'proppmtct':
-                    continue  # There are no explicit states for pmtct, so no need to move people around, just fix the proportion if needed
-
-                # Figure out how many people we currently have...
-                actual    = people[numer,:,t+1].sum() # ... in the higher cascade state
-                available = people[denom,:,t+1].sum() # ... waiting to move up
-
-                # Move the people who started treatment last timestep from usvl to svl
-                if ~isfinite(prop[t+1]):
-                    if name == 'proptx': wanted = numtx[t+1] # If proptx is nan, we use numtx
-                    else:                wanted = None # If a proportion or number isn't specified, skip this
-                else: # If the prop value is finite, we use it
-                    wanted = prop[t+1]*available
-
-                # Reconcile the differences between the number we have and the number we want
-                if wanted is not None:
-                    diff = wanted - actual # Wanted number minus actual number
-                    if diff>eps: # We need to move people forwards along the cascade
-                        ppltomoveup = people[lowerstate,:,t+1]
-                        totalppltomoveup = ppltomoveup.sum()
-                        if totalppltomoveup>eps:
-                            diff = min(diff, totalppltomoveup-eps) # Make sure we don't move more people than are available
-                            if name == 'proptx': # For treatment, we move people in lower CD4 states first
-                                if simpars['tvec'][t] < allcd4eligibletx: #If this is during or before the final year of prioritized treatment by CD4 count in the country
-                                    tmpdiff = diff
-                                    newmovers = zeros((ncd4,npops))
-                                    for cd4 in reversed(range(ncd4)): # Going backwards so that lower CD4 counts move up the cascade first
-                                        if tmpdiff>eps: # Move people until you have the right proportions
-                                            ppltomoveupcd4 = ppltomoveup[cd4,:]
-                                            totalppltomoveupcd4 = ppltomoveupcd4.sum()
-                                            if totalppltomoveupcd4>eps:
-                                                tmpdiffcd4 = min(tmpdiff, totalppltomoveupcd4-eps)
-                                                newmovers[cd4,:] = tmpdiffcd4*ppltomoveupcd4/totalppltomoveupcd4 # Pull out evenly from each population
-                                                tmpdiff -= newmovers[cd4,:].sum() # Adjust the number of available spots
-                                else:
-                                    newmovers = diff*ppltomoveup/totalppltomoveup
-                                # Need to handle USVL and SVL separately
-                                people[care,:,t+1] -= newmovers # Shift people out of care
-                                people[usvl,:,t+1]  += newmovers*(1.0-treatvs) # ... and onto treatment, according to existing proportions
-                                people[svl,:,t+1]   += newmovers*treatvs # Likewise for SVL
-                            else: # For everything else, we use a distribution based on the distribution of people waiting to move up the cascade
-                                newmovers = diff*ppltomoveup/totalppltomoveup
-                                people[lowerstate,:,t+1] -= newmovers # Shift people out of the less progressed state...
-                                if name == 'propcare':
-                                    newmoversfromdx = newmovers[:ncd4,:]    # First group of movers are from dx
-                                    newmoversfromlost = newmovers[ncd4:, :] # Second group of movers are from lost
-                                    newmovers = newmoversfromdx + newmoversfromlost  # we sum people in corresponding cd4 states
-                                people[tostate,:,t+1]    += newmovers # ... and into the more progressed state
-
-                            if name == 'propdx':  raw_new[:,:,t+1] += newmovers/dt # propdx is split by cd4 into raw_diagcd4
-                            else:                 raw_new[:,t+1] += newmovers.sum(axis=0)/dt # Save new movers
-                    elif diff<-eps: # We need to move people backwards along the cascade
-                        ppltomovedown = people[tostate,:,t+1]
-                        totalppltomovedown = ppltomovedown.sum()
-                        if totalppltomovedown>eps: # To avoid having to add eps
-                            diff = min(-diff, totalppltomovedown-eps) # Flip it around so we have positive people
-                            newmovers = diff*ppltomovedown/totalppltomovedown
-                            if name == 'proptx': # Handle SVL and USVL separately
-                                newmoversusvl = newmovers[:ncd4,:] # First group of movers are from USVL
-                                newmoverssvl  = newmovers[ncd4:,:] # Second group is SVL
-                                people[usvl,:,t+1] -= newmoversusvl # Shift people out of USVL treatment
-                                people[svl,:,t+1]  -= newmoverssvl  # Shift people out of SVL treatment
-                                people[care,:,t+1] += newmoversusvl+newmoverssvl # Add both groups of movers into care
-                            else:
-                                people[tostate,:,t+1]    -= newmovers # Shift people out of the more progressed state...
-                                if name == 'propcare': lowerstate = lost  # Note the asymmetry, care moves people from dx and lost, but down into only lost
-                                people[lowerstate,:,t+1] += newmovers # ... and into the less progressed state
-                            if name == 'propdx': raw_new[:,:,t+1] -= newmovers / dt  # propdx is split by cd4 into raw_diagcd4
-                            else:                raw_new[:,t+1]   -= newmovers.sum(axis=0) / dt  # Save new movers, inverting again
-            if debug: checkfornegativepeople(people, tind=t+1) # If debugging, check for negative people on every timestep
-
-    raw                   = odict()    # Sim output structure
-    raw['tvec']           = tvec
-    raw['popkeys']        = popkeys
-    raw['people']         = people
-    raw['inci']           = raw_inci
-    raw['incibypop']      = raw_incibypop
-    raw['mtct']           = raw_mtct
-    raw['births']         = raw_births
-    raw['hivbirths']      = raw_hivbirths
-    raw['immi']           = raw_immi
-    raw['pmtct']          = raw_receivepmtct
-    raw['diag']           = raw_diagcd4.sum(axis=0) # Sum over cd4 count
-    raw['diagpmtct']      = raw_dxforpmtct
-    raw['newtreat']       = raw_newtreat
-    raw['death']          = raw_death
-    raw['otherdeath']     = raw_otherdeath
-    raw['emigration']     = raw_emi
-    if advancedtracking:
-        raw['diagcd4']         = raw_diagcd4
-        raw['incimethods']     = flatten_unflatten_func(raw_incionpopbypopmethods, axes_flatten=(0, 1, 2, 3), doflatten=flattenraw) # Axis 0 is method, 1 is acquired pop, 2-3 is cd4 state and pop of from pop
-        raw['transitpopbypop'] = flatten_unflatten_func(raw_transitpopbypop, axes_flatten=(0, 1, 2), doflatten=flattenraw)
-        raw['props']           = raw_propsarr
-        raw['popadjustments'] = raw_popadjustments
+propkeys = ['propdx', 'propcare', 'proptx', 'propsupp', 'proppmtct'] # The cascade proportions, in the order of propslist and initprops
 
-    checkfornegativepeople(people) # Check only once for negative people, right before finishing
 
-    return raw # Return raw results
+def findfixinds(simpars):
+    ''' Find the index at which each cascade proportion gets fixed, in the order of propkeys -- nan if it isn't '''
+    tvec = simpars['tvec']
+    fixinds = []
+    for key in propkeys:
+        fixyearpar = simpars['fix'+key]
+        if fixyearpar is None or isnan(fixyearpar): fixind = nan # It's not defined, skip
+        elif fixyearpar > tvec[-1]: fixind = nan # It's after the end, skip
+        elif fixyearpar < tvec[0]:  fixind = 0 # It's before the beginning, set to beginning
+        else:                       fixind = findinds(tvec>=fixyearpar)[0] # Main usage case
+        fixinds.append(fixind)
+    return fixinds
+
+
+def stitchraw(raw, refraw, ind):
+    '''
+    Copy the results up to and including time index ind from refraw into raw, e.g. for a model run that was started
+    from a snapshot of refraw at ind -- values at ind also have flows from the timestep before, which only refraw has.
+    Not for runs with advanced tracking.
+    '''
+    npts = len(raw['tvec'])
+    for key,val in raw.items():
+        if key!='tvec' and hasattr(val, 'shape') and val.ndim and val.shape[-1]==npts:
+            val[...,:ind+1] = refraw[key][...,:ind+1]
+    return raw
+
+
+def checkfornegativepeople(people, tvec=None, popkeys=None, settings=None, label='', die=False, verbose=None, tind=None):
+    ''' Check for negative people, raising an error or resetting them to zero '''
+    nstates, npops = people.shape[:2]
+    if tind is None: tind = Ellipsis
+    if not((people[:,:,tind]>=0).all()): # If not every element is a real number >0, throw an error
+        for t in range(len(tvec)):
+            for errstate in range(nstates): # Loop over all heath states
+                for errpop in range(npops): # Loop over all populations
+                    if not(people[errstate,errpop,t]>=0):
+                        errlines = ['WARNING, Non-positive people found (more people leaving compartment than exist in that compartment)!',
+                                    'people[%i, %i, %i] = people[%s, %s, %s] = %s' % (errstate, errpop, t, settings.statelabels[errstate], popkeys[errpop], tvec[t], people[errstate,errpop,t]),
+                                    'Possible reasons include unrealistic numbers of deaths or infection rates in population %s.'%(popkeys[errpop]),
+                                    'Check for mortality rates or other inputs that might be missing a decimal point or try lowering force of infection']
+
+                        errormsg = label + str.join('\n',errlines)
+                        if die: raise OptimaException(errormsg)
+                        else:   printv(errormsg, 1, verbose=verbose)
+                        people[errstate,errpop,t] = 0.0 # Reset
+
+
+def sparsetransitions(fromtoarr, settings):
+    '''
+    Precompile the sparse structure of the transition matrix from fromtoarr, so that the time loop only touches legal
+    transitions. Transition n goes from state transfrom[n] to state transto[n], in the row-major order of fromtoarr;
+    transind[fromstate,tostate] gives n, or -1 if the transition is illegal. blocks holds the cascade transitions
+    that get scaled each timestep, as the transition indices plus the CD4 index of the state they're from.
+    '''
+    ncd4 = settings.ncd4
+    transfrom, transto = fromtoarr.nonzero()
+    transind = -ones(fromtoarr.shape, dtype=int)
+    transind[transfrom,transto] = arange(len(transfrom))
+
+    sparse = odict()
+    sparse['transfrom'] = transfrom
+    sparse['transto']   = transto
+    sparse['transind']  = transind
+    sparse['infected']  = findinds(transfrom>=settings.nsus) # Transitions from infected states, which are affected by background death
+
+    # For summing the flows into each state: group transitions by the state they go to
+    sparse['toorder']   = argsort(transto, kind='stable')
+    sparse['tostates'], sparse['tostarts'] = unique(transto[sparse['toorder']], return_index=True)
+
+    # Cascade transitions
+    sparse['blocks'] = odict()
+    for fromname,toname in [('undx','undx'), ('undx','alldx'), ('dx','dx'), ('dx','allcare'), ('lost','lost'), ('lost','allcare'),
+                            ('allcare','allcare'), ('allcare','lost'), ('svl','svl'), ('svl','usvl'), ('usvl','usvl'), ('usvl','svl')]:
+        fromstates, tostates = getattr(settings, fromname), getattr(settings, toname)
+        inds = transind[ix_(fromstates, tostates)]
+        cd4 = tile((fromstates-fromstates[0])[:,None]%ncd4, (1,len(tostates)))
+        legal = inds>=0
+        sparse['blocks'][(fromname,toname)] = (inds[legal], cd4[legal])
+
+    # For summing the probability of being diagnosed by CD4 count
+    inds,cd4 = sparse['blocks'][('undx','alldx')]
+    sparse['diagsum'] = zeros((ncd4, len(inds)))
+    sparse['diagsum'][cd4, arange(len(inds))] = 1.
+
+    return sparse
+
+
+def do_props(t, npts, dt, eps, ncd4, people, propstruct, thisproppmtct, numtx, treatvs, tvec, allcd4eligibletx, care, usvl, svl, lost):
+    ''' Fix and apply the cascade proportions (propdx, propcare, etc) for a single simulation after the Euler step at time t '''
+
+    for name,proplist in propstruct.items():
+        prop, lowerstate, tostate, numer, denom, raw_new, fixyear = proplist
+
+        if fixyear==t: # Fixing the proportion from this timepoint
+            if not name == 'proppmtct':
+                calcprop = people[numer,:,t].sum()/(eps+people[denom,:,t].sum()) # This is the value we fix it at
+            else:
+                calcprop = thisproppmtct  # proppmtct is calculated earlier in the timestep so we don't need to recalc
+            naninds    = findinds(isnan(prop)) # Find the indices that are nan -- to be replaced by current values
+            infinds    = findinds(isinf(prop)) # Find indices that are infinite -- to be scaled up/down to a target value
+            finiteinds = findinds(isfinite(prop)) # Find indices that are defined
+            finiteind = npts-1 if not len(finiteinds) else finiteinds[0] # Get first finite index, or else just last point -- latter should not actually matter
+            naninds = naninds[naninds>t] # Trim ones that are less than the current point
+            infinds = infinds[infinds>t] # Trim ones that are less than the current point
+            ninterppts = len(infinds) # Number of points to interpolate over
+            if len(naninds): prop[naninds] = calcprop # Replace nans with current proportion
+            if len(infinds): prop[infinds] = interp(range(ninterppts), [0,ninterppts-1], [calcprop,prop[finiteind]]) # Replace infinities with scale-up/down
+
+        if name == 'proppmtct':
+            continue  # There are no explicit states for pmtct, so no need to move people around, just fix the proportion if needed
+
+        # Figure out how many people we currently have...
+        actual    = people[numer,:,t+1].sum() # ... in the higher cascade state
+        available = people[denom,:,t+1].sum() # ... waiting to move up
+
+        # Move the people who started treatment last timestep from usvl to svl
+        if ~isfinite(prop[t+1]):
+            if name == 'proptx': wanted = numtx[t+1] # If proptx is nan, we use numtx
+            else:                wanted = None # If a proportion or number isn't specified, skip this
+        else: # If the prop value is finite, we use it
+            wanted = prop[t+1]*available
+
+        # Reconcile the differences between the number we have and the number we want
+        if wanted is not None:
+            diff = wanted - actual # Wanted number minus actual number
+            if diff>eps: # We need to move people forwards along the cascade
+                ppltomoveup = people[lowerstate,:,t+1]
+                totalppltomoveup = ppltomoveup.sum()
+                if totalppltomoveup>eps:
+                    diff = min(diff, totalppltomoveup-eps) # Make sure we don't move more people than are available
+                    if name == 'proptx': # For treatment, we move people in lower CD4 states first
+                        if tvec[t] < allcd4eligibletx: #If this is during or before the final year of prioritized treatment by CD4 count in the country
+                            tmpdiff = diff
+                            newmovers = zeros((ncd4,people.shape[1]))
+                            for cd4 in reversed(range(ncd4)): # Going backwards so that lower CD4 counts move up the cascade first
+                                if tmpdiff>eps: # Move people until you have the right proportions
+                                    ppltomoveupcd4 = ppltomoveup[cd4,:]
+                                    totalppltomoveupcd4 = ppltomoveupcd4.sum()
+                                    if totalppltomoveupcd4>eps:
+                                        tmpdiffcd4 = min(tmpdiff, totalppltomoveupcd4-eps)
+                                        newmovers[cd4,:] = tmpdiffcd4*ppltomoveupcd4/totalppltomoveupcd4 # Pull out evenly from each population
+                                        tmpdiff -= newmovers[cd4,:].sum() # Adjust the number of available spots
+                        else:
+                            newmovers = diff*ppltomoveup/totalppltomoveup
+                        # Need to handle USVL and SVL separately
+                        people[care,:,t+1] -= newmovers # Shift people out of care
+                        people[usvl,:,t+1]  += newmovers*(1.0-treatvs) # ... and onto treatment, according to existing proportions
+                        people[svl,:,t+1]   += newmovers*treatvs # Likewise for SVL
+                    else: # For everything else, we use a distribution based on the distribution of people waiting to move up the cascade
+                        newmovers = diff*ppltomoveup/totalppltomoveup
+                        people[lowerstate,:,t+1] -= newmovers # Shift people out of the less progressed state...
+                        if name == 'propcare':
+                            newmoversfromdx = newmovers[:ncd4,:]    # First group of movers are from dx
+                            newmoversfromlost = newmovers[ncd4:, :] # Second group of movers are from lost
+                            newmovers = newmoversfromdx + newmoversfromlost  # we sum people in corresponding cd4 states
+                        people[tostate,:,t+1]    += newmovers # ... and into the more progressed state
+
+                    if name == 'propdx':  raw_new[:,:,t+1] += newmovers/dt # propdx is split by cd4 into raw_diagcd4
+                    else:                 raw_new[:,t+1] += newmovers.sum(axis=0)/dt # Save new movers
+            elif diff<-eps: # We need to move people backwards along the cascade
+                ppltomovedown = people[tostate,:,t+1]
+                totalppltomovedown = ppltomovedown.sum()
+                if totalppltomovedown>eps: # To avoid having to add eps
+                    diff = min(-diff, totalppltomovedown-eps) # Flip it around so we have positive people
+                    newmovers = diff*ppltomovedown/totalppltomovedown
+                    if name == 'proptx': # Handle SVL and USVL separately
+                        newmoversusvl = newmovers[:ncd4,:] # First group of movers are from USVL
+                        newmoverssvl  = newmovers[ncd4:,:] # Second group is SVL
+                        people[usvl,:,t+1] -= newmoversusvl # Shift people out of USVL treatment
+                        people[svl,:,t+1]  -= newmoverssvl  # Shift people out of SVL treatment
+                        people[care,:,t+1] += newmoversusvl+newmoverssvl # Add both groups of movers into care
+                    else:
+                        people[tostate,:,t+1]    -= newmovers # Shift people out of the more progressed state...
+                        if name == 'propcare': lowerstate = lost  # Note the asymmetry, care moves people from dx and lost, but down into only lost
+                        people[lowerstate,:,t+1] += newmovers # ... and into the less progressed state
+                    if name == 'propdx': raw_new[:,:,t+1] -= newmovers / dt  # propdx is split by cd4 into raw_diagcd4
+                    else:                raw_new[:,t+1]   -= newmovers.sum(axis=0) / dt  # Save new movers, inverting again
+    return None
 
 
 def return_original(arr, indices=None):
@@ -0,0 +1,271 @@
+"""
+Compiled kernels for the busiest stages of the model's time loop: force of infection, transitions between health
+states, ageing and risk transitions, and births. Each kernel does with plain loops what runbatch() otherwise does with
+many small NumPy operations, so once compiled with Numba it avoids paying Python's overhead at every timestep.
+
+Numba is optional: if it isn't installed, hasjit is False and the model uses its NumPy code instead. Select the engine
+with settings.engine or model(engine=...).
+
+Version: 2026oct18
+"""
+
+from numpy import zeros, isnan
+
+try:
+    from numba import njit # Optional: only needed for engine='jit'
+    hasjit = True
+except ImportError:
+    njit = None
+    hasjit = False
+
+__all__ = ['hasjit', 'engines', 'checkengine']
+
+engines = ['numpy', 'jit']
+
+
+def jit(func):
+    ''' Compile a kernel if Numba is available; error_model='numpy' so dividing by zero gives inf/nan as it does in the NumPy code '''
+    if hasjit: return njit(cache=True, nogil=True, error_model='numpy')(func)
+    else:      return func
+
+
+def checkengine(engine=None, settings=None):
+    ''' Work out which engine to use: 'jit' if it was asked for (here or in settings) and Numba is available, else 'numpy' '''
+    if engine is None: engine = getattr(settings, 'engine', None) # Settings from older projects may not have it
+    if engine is None: engine = 'numpy'
+    if engine not in engines:
+        from optima import OptimaException
+        raise OptimaException('Model engine "%s" not understood: choices are %s' % (engine, engines))
+    if engine=='jit' and not hasjit: engine = 'numpy' # Fall back to NumPy
+    return engine
+
+
+@jit
+def foikernel(peoplet, sus, effallprev, force, inhomo, backgroundt, dt,
+              sexpop1, sexpop2, fracactssex, transsex, cond, alleff, wholeactssex,
+              injpop1, injpop2, transinj, osteff, sharing, prepeff, fracactsinj, wholeactsinj,
+              infectionsto, inci, incibypop):
+    '''
+    Probability of infection for each susceptible state (infectionsto, shape nbatch x nsus x npops), and the
+    infections acquired by each population (inci, nbatch x npops) and caused by each state and population (incibypop,
+    nbatch x nstates x npops), for one timestep. The outputs must be zeroed beforehand. Time-dependent inputs are for
+    this timestep only, e.g. alleff is nbatch x npops x nsus.
+    '''
+    nbatch, nsus, npops = infectionsto.shape
+    nstates = effallprev.shape[1]
+    notinfected = zeros((nsus, npops, nstates, npops)) # Probability of NOT getting infected: acquiring circ, acquiring pop, causing state, causing pop
+    for b in range(nbatch):
+        notinfected[:] = 1.0
+
+        # Sexual infections
+        for m in range(len(sexpop1)):
+            p1 = sexpop1[m]
+            p2 = sexpop2[m]
+            wholeacts = wholeactssex[b,m]
+            for i in range(nsus):
+                risk = transsex[b,m]*cond[b,m]*alleff[b,p1,i]
+                for k in range(nstates):
+                    peract = risk*effallprev[b,k,p2]
+                    prob = 1.0 - min(fracactssex[b,m]*peract, 1.0)
+                    if wholeacts != 0: prob *= (1.0 - min(peract, 1.0))**wholeacts
+                    notinfected[i,p1,k,p2] *= prob
+
+        # Injection-related infections -- the same for circs and uncircs
+        for m in range(len(injpop1)):
+            p1 = injpop1[m]
+            p2 = injpop2[m]
+            wholeacts = wholeactsinj[b,m]
+            risk = transinj[b]*osteff[b]*sharing[b,p1]*prepeff[b,p1]
+            for k in range(nstates):
+                peract = risk*effallprev[b,k,p2]
+                prob = 1.0 - min(fracactsinj[b,m]*peract, 1.0)
+                if wholeacts != 0: prob *= (1.0 - min(peract, 1.0))**wholeacts
+                for i in range(nsus):
+                    notinfected[i,p1,k,p2] *= prob
+
+        # Probability of getting infected, with scaling factors, and the infections it gives
+        for j in range(npops):
+            scale = force[b,j]*inhomo[b,j]*(1.0-backgroundt[b,j])
+            for i in range(nsus):
+                npeople = peoplet[b,sus[i],j]
+                total = 0.0
+                for k in range(nstates):
+                    for l in range(npops):
+                        prob = (1.0-notinfected[i,j,k,l])*scale
+                        total += prob
+                        incibypop[b,k,l] += npeople*prob/dt
+                infectionsto[b,i,j] = total
+                inci[b,j] += npeople*total/dt
+    return None
+
+
+@jit
+def flowkernel(peoplet, transfrom, transto, transitions, peoplenext):
+    ''' Move people along each legal transition: peoplenext[:,transto[n],:] += peoplet[:,transfrom[n],:]*transitions[:,n,:] '''
+    nbatch, ntrans, npops = transitions.shape
+    for b in range(nbatch):
+        for n in range(ntrans):
+            fromstate = transfrom[n]
+            tostate = transto[n]
+            for p in range(npops):
+                peoplenext[b,tostate,p] += peoplet[b,fromstate,p]*transitions[b,n,p]
+    return None
+
+
+@jit
+def transitkernel(peoplenext, agerates, riskrates):
+    '''
+    Age transitions (agerates, nbatch x frompop x topop, for this timestep), then risk transitions, which move people
+    both ways between two populations in proportion to their sizes. Changes peoplenext (nbatch x nstates x npops).
+    '''
+    nbatch, nstates, npops = peoplenext.shape
+    moved = zeros((nstates, npops))
+    popsizes = zeros(npops)
+    for b in range(nbatch):
+        # Ageing
+        moved[:] = 0.0
+        for p1 in range(npops):
+            for p2 in range(npops):
+                rate = agerates[b,p1,p2]
+                if rate != 0:
+                    for k in range(nstates):
+                        flow = peoplenext[b,k,p1]*rate
+                        moved[k,p1] -= flow
+                        moved[k,p2] += flow
+        for k in range(nstates):
+            for p in range(npops):
+                peoplenext[b,k,p] += moved[k,p]
+
+        # Risk transitions
+        moved[:] = 0.0
+        for p in range(npops):
+            popsizes[p] = 0.0
+            for k in range(nstates):
+                popsizes[p] += peoplenext[b,k,p]
+        for p1 in range(npops):
+            for p2 in range(npops):
+                rate = riskrates[b,p1,p2]
+                if rate != 0:
+                    ratio = popsizes[p1]*(1.0/popsizes[p2])
+                    for k in range(nstates):
+                        flow1 = peoplenext[b,k,p1]*rate # People moving p1 -> p2...
+                        flow2 = peoplenext[b,k,p2]*rate*ratio # ...and p2 -> p1, correcting for population size
+                        moved[k,p1] += flow2 - flow1
+                        moved[k,p2] += flow1 - flow2
+        for k in range(nstates):
+            for p in range(npops):
+                peoplenext[b,k,p] += moved[k,p]
+    return None
+
+
+@jit
+def birthskernel(t, npts, dt, eps, birthratesarr, relhivbirth, people, undx, dx, dxnottx, alltx, motherpops, childpops,
+                 effmtct, pmtcteff, numpmtct, proppmtct, mtctgroupmap, raw_inci, raw_incibypop, raw_diagcd4, raw_mtct,
+                 raw_births, raw_hivbirths, raw_dxforpmtct, raw_receivepmtct, undxhivbirths, dxhivbirths):
+    '''
+    Births, mother-to-child transmission and PMTCT for one simulation at one timestep: the same as do_births() for
+    versions 2.12.2 and later, without advanced tracking or debugging. effmtct, pmtcteff, numpmtct and proppmtct are
+    for this timestep; undxhivbirths and dxhivbirths must be zeroed beforehand. Returns the proportion of HIV+
+    pregnant women on PMTCT.
+    '''
+    nmothers = len(motherpops)
+    nchildren = len(childpops)
+    if nmothers==0 or nchildren==0: return 0.0
+    timestepsonpmtct = 1.0/dt
+
+    # Numbers of mothers giving birth in this timestep
+    birthrates = zeros(nmothers)
+    mothersall = zeros(nmothers)
+    mothersundx = zeros(nmothers)
+    mothersdxnottx = zeros(nmothers)
+    mothersalltx = zeros(nmothers)
+    for a in range(nmothers):
+        mp = motherpops[a]
+        for c in range(birthratesarr.shape[1]): birthrates[a] += birthratesarr[mp,c,t]
+        for s in range(people.shape[0]): mothersall[a] += people[s,mp,t]
+        for s in undx:    mothersundx[a]    += people[s,mp,t]
+        for s in dxnottx: mothersdxnottx[a] += people[s,mp,t]
+        for s in alltx:   mothersalltx[a]   += people[s,mp,t]
+        mothersall[a]     *= birthrates[a]
+        mothersundx[a]    *= birthrates[a]
+        mothersdxnottx[a] *= birthrates[a]*relhivbirth
+        mothersalltx[a]   *= birthrates[a]*relhivbirth
+
+    # Proportion on PMTCT, whether numpmtct or proppmtct is used
+    if isnan(proppmtct): thisnumpmtct = numpmtct/timestepsonpmtct
+    else:                thisnumpmtct = proppmtct*(mothersundx.sum() + mothersdxnottx.sum() + mothersalltx.sum())
+    proppmtctoftx = min(thisnumpmtct/(eps*dt + mothersalltx.sum()), 1.0)
+    proppmtctofdxnottx = max(thisnumpmtct - proppmtctoftx*mothersalltx.sum(), 0.0)/(eps*dt + mothersdxnottx.sum())
+
+    if proppmtctofdxnottx > 1: # Need more on PMTCT than we have available diagnosed, so diagnose pregnant women
+        alldxsum = mothersdxnottx.sum() + mothersalltx.sum()
+        numtobedx = thisnumpmtct - alldxsum
+        thisnumpmtct = eps*dt + alldxsum
+        proptobedx = min(numtobedx/(eps + mothersundx.sum()), 1-eps)
+        for a in range(nmothers):
+            mp = motherpops[a]
+            newdx = 0.0
+            for s in range(len(undx)):
+                tobedx = people[undx[s],mp,t]*birthrates[a]*proptobedx
+                if t<npts-1:
+                    people[undx[s],mp,t+1] -= tobedx
+                    people[dx[s],mp,t+1]   += tobedx
+                raw_diagcd4[s,mp,t] += tobedx/dt
+                newdx += tobedx
+            raw_dxforpmtct[mp,t] += newdx/dt
+            mothersundx[a]    -= newdx # Assuming all diagnosed by ANC will go onto PMTCT
+            mothersdxnottx[a] += newdx
+            thisnumpmtct      += newdx
+
+    # thisnumpmtct is now the number we are actually reaching
+    proppmtctoftx = min(thisnumpmtct/(eps*dt + mothersalltx.sum()), 1.0)
+    proppmtctofdxnottx = max(thisnumpmtct - proppmtctoftx*mothersalltx.sum(), 0.0)/(eps*dt + mothersdxnottx.sum())
+    proppmtctofplhiv = min(thisnumpmtct/(eps*dt + mothersundx.sum() + mothersdxnottx.sum() + mothersalltx.sum()), 1.0)
+
+    # Actual births, MTCT and PMTCT, splitting each mother population's births between the child populations
+    births = zeros(nchildren)
+    mtct = zeros(nchildren)
+    mtctgroups = zeros((3, nmothers)) # MTCT from undiagnosed, diagnosed but not treated, and treated mothers
+    for a in range(nmothers):
+        mp = motherpops[a]
+        rowsum = 0.0
+        for c in range(nchildren): rowsum += birthratesarr[mp,childpops[c],t]
+        hivbirths = 0.0
+        received = 0.0
+        for c in range(nchildren):
+            cp = childpops[c]
+            split = birthratesarr[mp,cp,t]/rowsum
+            fromundx = split*mothersundx[a]
+            fromdxnottx = split*mothersdxnottx[a]
+            fromalltx = split*mothersalltx[a]
+            mtctfromundx = fromundx*effmtct
+            mtctfromdxnottx = fromdxnottx*(proppmtctofdxnottx*pmtcteff + (1-proppmtctofdxnottx)*effmtct)
+            mtctfromalltx = fromalltx*pmtcteff
+            births[c] += split*mothersall[a]
+            hivbirths += split*(mothersundx[a] + mothersdxnottx[a] + mothersalltx[a])
+            received += fromdxnottx*proppmtctofdxnottx + fromalltx*proppmtctoftx
+            undxhivbirths[cp] += mtctfromundx
+            dxhivbirths[cp] += mtctfromdxnottx + mtctfromalltx
+            mtct[c] += mtctfromundx + mtctfromdxnottx + mtctfromalltx
+            mtctgroups[0,a] += mtctfromundx
+            mtctgroups[1,a] += mtctfromdxnottx
+            mtctgroups[2,a] += mtctfromalltx
+        raw_hivbirths[mp,t] = hivbirths/dt
+        raw_receivepmtct[mp,t] = received*timestepsonpmtct # Convert from births to pregnant women
+
+    for c in range(nchildren):
+        cp = childpops[c]
+        raw_births[cp,t] = births[c]/dt
+        raw_mtct[cp,t] += mtct[c]/dt
+        raw_inci[cp,t] += raw_mtct[cp,t]
+
+    # Infections caused, split over each mother population's states in each group
+    for a in range(nmothers):
+        mp = motherpops[a]
+        for g in range(3):
+            groupsize = 0.0
+            for s in range(people.shape[0]): groupsize += people[s,mp,t]*mtctgroupmap[g,s]
+            if groupsize != 0:
+                for s in range(people.shape[0]):
+                    raw_incibypop[s,mp,t] += mtctgroups[g,a]*people[s,mp,t]*mtctgroupmap[g,s]/groupsize/dt
+    return proppmtctofplhiv
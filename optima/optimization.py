@@ -4,12 +4,12 @@ Functions for running optimizations.
 Version: 2019dec02
 """
 
-from optima import OptimaException, Link, Multiresultset, ICER, asd, getresults # Main functions
+from optima import OptimaException, Link, Multiresultset, ICER, asd, getresults, objectiveoutcomekeys, model, makesimpars # Main functions
 from optima import printv, dcp, odict, findinds, today, getdate, uuid, objrepr, promotetoarray, findnearest, sanitize, \
     inclusiverange, sigfig, compareversions, cpu_count # Utilities
 
-from numpy import zeros, ones, empty, arange, array, inf, isfinite, argmin, argsort, nan, floor, concatenate, exp, sqrt, logical_and, ceil, array_equal
-from numpy.random import random, seed, randint
+from numpy import zeros, ones, arange, array, inf, isfinite, argmin, argsort, nan, floor, concatenate, exp, sqrt, logical_and, ceil, array_equal
+from numpy.random import random, seed, randint, RandomState
 from time import time
 import optima as op # Used by minmoney, at some point should make syntax consistent
 import sciris as sc
@@ -17,7 +17,13 @@ from hashlib import md5
 from traceback import print_exc
 
 # Import dependencies here so no biggie if they fail
-from multiprocessing import Process, Queue
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+import pickle
+import io
+import os
+from functools import partial
 
 import six
 if six.PY3:
@@ -26,6 +32,9 @@ if six.PY3:
 
 __all__ = [
     'Optim',
+    'Outcomecache',
+    'Snapshotcache',
+    'Optimcheckpoint',
     'defaultobjectives',
     'defaultconstraints',
     'defaultabsconstraints',
@@ -34,6 +43,9 @@ __all__ = [
     'multioptimize',
     'tvoptimize',
     'outcomecalc',
+    'batchoutcomecalc',
+    'batchevaluator',
+    'makeoptimpool',
     'icers',
     'tvfunction'
 ]
@@ -142,6 +154,230 @@ class Optim(object):
                     constr['max'][progname] = None
 
 
+class Outcomecache(object):
+    '''
+    A size-bounded, least-recently-used cache of objective values calculated by outcomecalc(), keyed on the constrained
+    budget (rounded to the nearest quantum, e.g. 1 cent) and on everything else that determines the outcome. It can be
+    shared between the chains of a multi-chain optimization: when it's pickled (e.g. to send to a worker process), only its
+    UID is sent, and each process keeps its own copy, which lasts as long as the process does. The hits and misses of the
+    copies in other processes are added to this one's as their asd() runs finish (see runasd()), but the entries aren't.
+    '''
+    def __init__(self, maxsize=10000, quantum=0.01, uid=None):
+        self.uid = uid if uid is not None else uuid()
+        self.maxsize = maxsize # Maximum number of objective values to store
+        self.quantum = quantum # Budgets that round to the same multiple of this are treated as the same
+        self.cache = odict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+        outcomecaches[self.uid] = self
+        while len(outcomecaches)>maxoutcomecaches: outcomecaches.pop(outcomecaches.keys()[0]) # Forget about old caches
+    
+    def __repr__(self):
+        return 'Outcomecache: %i entries, %i hits, %i misses' % (len(self.cache), self.hits, self.misses)
+    
+    def __reduce__(self):
+        ''' Only send the UID and settings, and reuse the cache of that UID if this process already has it '''
+        return (getoutcomecache, (self.uid, self.maxsize, self.quantum))
+    
+    def makekey(self, budget=None, **kwargs):
+        ''' Make the cache key from the budget (rounded to the quantum) and the other inputs that affect the outcome '''
+        quantized = (array(budget, dtype=float)/self.quantum).round().astype('int64')
+        return md5(quantized.tobytes() + pickle.dumps(sorted(kwargs.items()), protocol=-1)).hexdigest()
+    
+    def get(self, key=None):
+        ''' Return the stored value, or None if it's not there '''
+        with self.lock:
+            if key in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(key) # Mark it as recently used
+                return self.cache[key]
+            else:
+                self.misses += 1
+                return None
+    
+    def store(self, key=None, value=None):
+        ''' Store a value, removing the least recently used ones if the cache is full '''
+        with self.lock:
+            self.cache[key] = value
+            self.cache.move_to_end(key)
+            while len(self.cache)>self.maxsize: self.cache.popitem(last=False)
+        return None
+    
+    def addstats(self, cachestats=None):
+        ''' Add the hits and misses of another process's copy of this cache, as returned by runasd() '''
+        if cachestats is None or cachestats[0] == os.getpid(): return None # Already counted here
+        with self.lock:
+            self.hits += cachestats[1]
+            self.misses += cachestats[2]
+        return None
+    
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.hits = 0
+            self.misses = 0
+        return None
+
+
+outcomecaches = odict() # The Outcomecache objects in this process, so that pickled caches can find them again
+maxoutcomecaches = 10 # Maximum number of caches to keep
+
+def getoutcomecache(uid=None, maxsize=10000, quantum=0.01):
+    ''' Get the Outcomecache with this UID from this process, or make a new one '''
+    if uid in outcomecaches: return outcomecaches[uid]
+    else:                    return Outcomecache(maxsize=maxsize, quantum=quantum, uid=uid)
+
+
+class Snapshotcache(object):
+    '''
+    The epidemic state (people and cascade proportions) at every timestep of a model run of a parset, for starting
+    runs part way through -- e.g. the runs of optimizations, BOCs and ICERs, which only differ from the start year.
+    Runs are keyed on the parset's UID and contents, the time vector and the settings, so a changed parset is rerun.
+    Up to maxsize runs are kept, and none are saved with the project. Use via Project.getsnapshot().
+    '''
+    def __init__(self, maxsize=5):
+        self.maxsize = maxsize # Maximum number of runs to store
+        self.cache = odict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+    
+    def __repr__(self):
+        return 'Snapshotcache: %i runs, %i hits, %i misses' % (len(self.cache), self.hits, self.misses)
+    
+    def __reduce__(self):
+        ''' Don't save or copy the stored runs '''
+        return (Snapshotcache, (self.maxsize,))
+    
+    def makekey(self, project=None, parsetname=None, **kwargs):
+        ''' Make the cache key from everything that the model run depends on '''
+        parset = project.parsets[parsetname]
+        contents = pickle.dumps([parset.pars, project.settings, project.version, sorted(kwargs.items())], protocol=-1)
+        return '%s-%s' % (parset.uid, md5(contents).hexdigest())
+    
+    def get(self, project=None, parsetname=None, year=None, tvec=None, start=None, end=None):
+        '''
+        Get the time index nearest to year, and the people and proportions at the start of that timestep, for passing
+        to the model as startind, initpeople and initprops. The parset is run (with the same start, end and tvec as
+        Project.runsim()) if it hasn't been already.
+        '''
+        parset = project.parsets[parsetname]
+        if start is None: start = parset.start
+        if end is None:   end   = parset.end
+        key = self.makekey(project=project, parsetname=parsetname, tvec=None if tvec is None else array(tvec).tobytes(), start=start, end=end)
+        with self.lock:
+            if key in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(key)
+                snapshots = self.cache[key]
+            else:
+                self.misses += 1
+                snapshots = None
+        if snapshots is None:
+            simpars = makesimpars(parset.pars, projectversion=project.version, start=start, end=end, dt=project.settings.dt, tvec=tvec, settings=project.settings, name=parsetname)
+            raw = model(simpars, settings=project.settings, version=project.version, verbose=0, die=True, label=project.name, snapshots=range(len(simpars['tvec'])))
+            snapshots = odict([('tvec', raw['tvec']), ('snapshots', raw['snapshots'])])
+            with self.lock:
+                self.cache[key] = snapshots
+                while len(self.cache)>self.maxsize: self.cache.popitem(last=False)
+        startind = findnearest(snapshots['tvec'], year)
+        snapshot = snapshots['snapshots'][startind]
+        return odict([('startind', startind), ('initpeople', snapshot['people'].copy()), ('initprops', array(snapshot['props']))])
+    
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.hits = 0
+            self.misses = 0
+        return None
+
+
+class Optimcheckpoint(object):
+    '''
+    Where the state of each asd() run of an optimization is saved while it runs, so that the optimization can be continued
+    after it's interrupted (e.g. by a restarted worker, or by the finish time), via Project.optimize(resume=True). Runs that
+    finished aren't redone, and the others carry on from their last saved state.
+    
+    The store is a folder, with a file for each run, or an object with get(), set() and delete() methods, such as a Redis
+    connection. The state of each run is saved at most every interval seconds, and when the run stops. A folder can also
+    be written to from worker processes; other stores are only written to from this process, so runs in parallel are saved
+    once they finish. With resume=False, any saved states are ignored (and overwritten).
+    '''
+    def __init__(self, store=None, prefix='', interval=60, resume=False):
+        if store is None: raise OptimaException('An optimization checkpoint needs a folder or store to save to')
+        self.store = store
+        self.prefix = prefix # Added to the start of each key, e.g. to keep different optimizations apart
+        self.interval = interval
+        self.resume = resume
+        self.lastsaved = {}
+        self.keys = set() # The keys used, to be able to clear them
+    
+    def __repr__(self):
+        return 'Optimcheckpoint: %s (%i runs)' % (self.store if self.isfolder() else type(self.store).__name__, len(self.keys))
+    
+    def isfolder(self):
+        return isinstance(self.store, six.string_types)
+    
+    def makekey(self, label=None):
+        key = self.prefix + label
+        if self.isfolder(): key = os.path.join(self.store, sc.sanitizefilename(key)+'.chk')
+        return key
+    
+    def load(self, label=None):
+        ''' Return the saved state of a run, or None if there isn't one (or not resuming) '''
+        key = self.makekey(label)
+        self.keys.add(key)
+        if not self.resume: return None
+        if self.isfolder():
+            if not os.path.exists(key): return None
+            with open(key, 'rb') as f: blob = f.read()
+        else:
+            blob = self.store.get(key)
+            if blob is None: return None
+        return pickle.loads(blob)
+    
+    def save(self, label=None, state=None):
+        ''' Save the state of a run, if it's been long enough since it was last saved or the run has stopped '''
+        now = time()
+        if not state.get('stopped') and now-self.lastsaved.get(label, -inf) < self.interval: return None
+        self.lastsaved[label] = now
+        key = self.makekey(label)
+        self.keys.add(key)
+        blob = pickle.dumps(state, protocol=-1)
+        if self.isfolder():
+            if not os.path.exists(self.store): os.makedirs(self.store, exist_ok=True)
+            tmpkey = '%s.%s.tmp' % (key, uuid().hex) # Write then rename, so a saved state is never half-written
+            with open(tmpkey, 'wb') as f: f.write(blob)
+            os.replace(tmpkey, key)
+        else:
+            self.store.set(key, blob)
+        return None
+    
+    def saver(self, label=None):
+        ''' The function for asd() to save its state with '''
+        return partial(self.save, label)
+    
+    def getrandseed(self, randseed=None):
+        ''' The random seed must be the same when resuming, so the same starting budgets are used: save it or get it back '''
+        saved = self.load('randseed')
+        if saved is not None: return saved['randseed']
+        if randseed is None: randseed = randint(2**31)
+        self.save('randseed', {'randseed':randseed, 'stopped':True})
+        return randseed
+    
+    def clear(self):
+        ''' Remove the saved states, e.g. once the optimization has finished '''
+        for key in self.keys:
+            if self.isfolder():
+                if os.path.exists(key): os.remove(key)
+            else:
+                self.store.delete(key)
+        self.keys = set()
+        self.lastsaved = {}
+        return None
+
+
 ################################################################################################################################################
 ### Helper functions
 ################################################################################################################################################
@@ -604,8 +840,16 @@ def separatetv(inputvec=None, optiminds=None, optimkeys=None):
 def outcomecalc(budgetvec=None, which=None, project=None, parsetname=None, progsetname=None, scaleupmethod='multiply',
                 objectives=None, absconstraints=None, totalbudget=None, optiminds=None, optimkeys=None, origbudget=None,
                 tvec=None, initpeople=None, initprops=None, startind=None, outputresults=False, verbose=2, ccsample='best',
-                doconstrainbudget=True, tvsettings=None, tvcontrolvec=None, origoutcomes=None, penalty=1e9, warn=True, printdone=None, **kwargs):
-    ''' Function to evaluate the objective for a given budget vector (note, not time-varying) '''
+                doconstrainbudget=True, tvsettings=None, tvcontrolvec=None, origoutcomes=None, penalty=1e9, warn=True, printdone=None, deferrun=False, outcomecache=None, **kwargs):
+    '''
+    Function to evaluate the objective for a given budget vector (note, not time-varying)
+    
+    If deferrun=True, the model isn't run: instead, the arguments for project.runsim() are returned along
+    with a function that calculates the objective from its output. This is used by batchoutcomecalc().
+    
+    If an Outcomecache is supplied, objective values are looked up in it by constrained budget before running
+    the model, and stored in it afterwards. It's not used when outputting results or sampling cost-coverage curves.
+    '''
 
     # Set up defaults
     if which is None: 
@@ -665,9 +909,22 @@ def outcomecalc(budgetvec=None, which=None, project=None, parsetname=None, progs
                 constrainedbudget = constrainbudget(origbudget=origbudget, budgetvec=budgetvec, totalbudget=totalbudget, absconstraints=absconstraints, optimkeys=optimkeys, outputtype='odict', scaleupmethod=scaleupmethod, warn=warn)
                 budgetarray.toeach(ind=y, val=constrainedbudget[:])
     
+    # Check whether the objective has already been calculated for this budget
+    cachekey = None
+    if outcomecache and not outputresults and ccsample in [False, None, 'best']:
+        cachekey = outcomecache.makekey(budget=array(budgetarray[:], dtype=float), which=which, paryears=promotetoarray(paryears).tolist(),
+                                        parset=(parset.uid, parset.modified), progset=(progset.uid, progset.modified), objectives=objectives,
+                                        ccsample=ccsample, startind=startind, initpeople=None if initpeople is None else array(initpeople).tobytes(),
+                                        origoutcomes=getattr(origoutcomes, 'rawoutcomes', None), penalty=penalty, kwargs=kwargs)
+        cached = outcomecache.get(cachekey)
+        if cached is not None:
+            if printdone: printv(printdone,2,verbose)
+            if deferrun: return None, lambda results: cached # Nothing to run
+            else:        return cached
+    
     # Get coverage and actual dictionary, in preparation for running
     thiscoverage = progset.getprogcoverage(budget=budgetarray, t=paryears, parset=parset, sample=ccsample)
-    thisparsdict = progset.getpars(coverage=thiscoverage, t=paryears, parset=parset, sample=ccsample)
+    thisparsdict = progset.getpars(coverage=thiscoverage, t=paryears, parset=parset, sample=ccsample, delta=not outputresults) # Unless the results are needed, only get the parameters changed by the programs
     
     # Figure out which indices to run for and actually run the model
     tvec       = project.settings.maketvec(end=objectives['end'])
@@ -675,117 +932,267 @@ def outcomecalc(budgetvec=None, which=None, project=None, parsetname=None, progs
     if initpeople is None: startind = None
     elif startind is None: raise Exception('initpeople is set but startind is not! Do not know when to start from!') # startind = findnearest(tvec, objectives['start']) # Assume initpeople is from the start of the optimization
     else: pass      # Assume initpeople and startind are corresponding to the same time
-    results = project.runsim(pars=thisparsdict, parsetname=parsetname, progsetname=progsetname, coverage=thiscoverage, budget=budgetarray, budgetyears=paryears, tvec=tvec, initpeople=initpeople, initprops=initprops, startind=startind, verbose=0, label=project.name+'-optim-outcomecalc', doround=False, addresult=False, advancedtracking=False, **kwargs)
-
-    # Figure out which indices to use
-    initialind = findnearest(results.tvec, objectives['start'])
-    finalind   = findnearest(results.tvec, objectives['end'])
-    if which=='money': baseind = findnearest(results.tvec, objectives['base']) # Only used for money minimization
-    if which=='outcomes': indices = arange(initialind, finalind) # Only used for outcomes minimization
     
-    ## Here, we split depending on whether it's a outcomes or money minimization:
-    if which=='outcomes':
-        # Calculate outcome
-        outcome = 0 # Preallocate objective value
-        rawoutcomes = odict()
-
-        # Calculate the outcome
-        for key in objectives['keys']:
-            thisweight = objectives[key+'weight'] # e.g. objectives['inciweight'] #CKCHANGE
-
-            if key == 'undiag': # don't have numundiag as a result so just do plhiv - diag
-                thisoutcome = results.main['numplhiv'].tot[0][indices].sum() - results.main['numdiag'].tot[0][indices].sum()
-            else: # just extract the key from results.main
-                thisoutcome = results.main['num'+key].tot[0][indices].sum() # The instantaneous outcome e.g. main['numdeath'] -- 0 is since best
-
-            rawoutcomes['num'+key] = thisoutcome*results.dt
-            outcome += thisoutcome*thisweight*results.dt # Calculate objective
-            if origoutcomes and penalty and thisweight>0:
-                if rawoutcomes['num'+key]>origoutcomes.rawoutcomes['num'+key]:
-                    outcome += penalty # Impose a large penalty if the solution is worse
-        
-        # Include cascade values
-        for key in objectives['cascadekeys']:
-            thisweight = objectives[key] # e.g. objectives['proptreat']
-            thisoutcome = 1.0 - results.main[key].tot[0][-1] # e.g. main['proptreat'] -- 0 is since best, subtract from 1 to invert, use final value
-            rawoutcomes[key] = thisoutcome
-            outcome += thisoutcome*thisweight # Calculate objective
-            if origoutcomes and penalty and thisweight>0:
-                if rawoutcomes[key]>origoutcomes.rawoutcomes[key]:
-                    outcome += penalty # Impose a large penalty if the solution is worse
-
-        # Output results
-        if outputresults:
-            results.outcome = outcome
-            results.rawoutcomes = rawoutcomes
-            results.budgetyears = [objectives['start']] # Use the starting year
-            results.budget = constrainedbudget # Convert to budget
-            results.budgets = odict({'outcomecalc':constrainedbudget}) # For plotting
-            results.outcomesettings = odict([('objectives', objectives), ('absconstraints', absconstraints), ('tvsettings', tvsettings)])
-            
-            # Store time-varying part
-            if tvsettings and tvsettings['timevarying']:
-                results.timevarying = odict() # One-liner: multires.timevarying = odict().makefrom(locals(), ['tvyears', 'tvpars', 'tvbudgets'])
-                results.timevarying['tvyears'] = dcp(paryears)
-                results.timevarying['tvpars'] = dcp(tvcontrolvec)
-                results.timevarying['tvbudgets'] = dcp(budgetarray)
-                
-            output = results
+    # Work out which outcomes are needed -- if we don't need to output the results, skip making a full Resultset
+    outcomekeys = []
+    for key in objectives['keys']:
+        if key == 'undiag': outcomekeys += ['numplhiv', 'numdiag'] # don't have numundiag as a result so just do plhiv - diag
+        else:               outcomekeys += ['num'+key]
+    outcomekeys += list(objectives['cascadekeys'])
+    leanrun = not outputresults and all([key in objectiveoutcomekeys for key in outcomekeys])
+    if deferrun and not leanrun:
+        errormsg = 'outcomecalc() can only defer running the model when calculating the objective, not when outputting results'
+        raise OptimaException(errormsg)
+    if outputresults: runpars, deltapars = thisparsdict, None
+    else:             runpars, deltapars = parset.pars, thisparsdict
+    runkwargs = dict(pars=runpars, deltapars=deltapars, parsetname=parsetname, progsetname=progsetname, coverage=thiscoverage, budget=budgetarray, budgetyears=paryears, tvec=tvec, initpeople=initpeople, initprops=initprops, startind=startind, verbose=0, label=project.name+'-optim-outcomecalc', doround=False, addresult=False, advancedtracking=False, outcomekeys=outcomekeys if leanrun else None, **kwargs)
+    
+    def calcoutcome(results):
+        ''' Calculate the objective (or output the results) from the Resultset, or from the odict of outcomes if not making one '''
+        if leanrun:
+            outcomes = results # Just an odict of the annual totals
+            restvec = outcomes['tvec']
         else:
-            output = outcome
+            outcomes = odict([(key, results.main[key].tot[0]) for key in outcomekeys]) # 0 is since best
+            restvec = results.tvec
+        resdt = restvec[1] - restvec[0]
+
+        # Figure out which indices to use
+        initialind = findnearest(restvec, objectives['start'])
+        finalind   = findnearest(restvec, objectives['end'])
+        if which=='money': baseind = findnearest(restvec, objectives['base']) # Only used for money minimization
+        if which=='outcomes': indices = arange(initialind, finalind) # Only used for outcomes minimization
+
+        ## Here, we split depending on whether it's a outcomes or money minimization:
+        if which=='outcomes':
+            # Calculate outcome
+            outcome = 0 # Preallocate objective value
+            rawoutcomes = odict()
+
+            # Calculate the outcome
+            for key in objectives['keys']:
+                thisweight = objectives[key+'weight'] # e.g. objectives['inciweight'] #CKCHANGE
+
+                if key == 'undiag': # don't have numundiag as a result so just do plhiv - diag
+                    thisoutcome = outcomes['numplhiv'][indices].sum() - outcomes['numdiag'][indices].sum()
+                else: # just extract the key from the outcomes
+                    thisoutcome = outcomes['num'+key][indices].sum() # The instantaneous outcome e.g. main['numdeath']
+
+                rawoutcomes['num'+key] = thisoutcome*resdt
+                outcome += thisoutcome*thisweight*resdt # Calculate objective
+                if origoutcomes and penalty and thisweight>0:
+                    if rawoutcomes['num'+key]>origoutcomes.rawoutcomes['num'+key]:
+                        outcome += penalty # Impose a large penalty if the solution is worse
+
+            # Include cascade values
+            for key in objectives['cascadekeys']:
+                thisweight = objectives[key] # e.g. objectives['proptreat']
+                thisoutcome = 1.0 - outcomes[key][-1] # e.g. main['proptreat'] -- subtract from 1 to invert, use final value
+                rawoutcomes[key] = thisoutcome
+                outcome += thisoutcome*thisweight # Calculate objective
+                if origoutcomes and penalty and thisweight>0:
+                    if rawoutcomes[key]>origoutcomes.rawoutcomes[key]:
+                        outcome += penalty # Impose a large penalty if the solution is worse
+
+            # Output results
+            if outputresults:
+                results.outcome = outcome
+                results.rawoutcomes = rawoutcomes
+                results.budgetyears = [objectives['start']] # Use the starting year
+                results.budget = constrainedbudget # Convert to budget
+                results.budgets = odict({'outcomecalc':constrainedbudget}) # For plotting
+                results.outcomesettings = odict([('objectives', objectives), ('absconstraints', absconstraints), ('tvsettings', tvsettings)])
+
+                # Store time-varying part
+                if tvsettings and tvsettings['timevarying']:
+                    results.timevarying = odict() # One-liner: multires.timevarying = odict().makefrom(locals(), ['tvyears', 'tvpars', 'tvbudgets'])
+                    results.timevarying['tvyears'] = dcp(paryears)
+                    results.timevarying['tvpars'] = dcp(tvcontrolvec)
+                    results.timevarying['tvbudgets'] = dcp(budgetarray)
+
+                output = results
+            else:
+                output = outcome
+
+        ## It's money
+        elif which=='money':
+            # Calculate outcome
+            targetsmet = True # Assume success until proven otherwise (since operator is AND, not OR)
+            baseline = odict()
+            final = odict()
+            target = odict()
+            targetfrac = odict([(key,objectives[key+'frac']) for key in objectives['keys']]) # e.g. {'inci':objectives['incifrac']} = 0.4 = 40% reduction in incidence
+            for key in objectives['keys']:
+                if key == 'undiag': # don't have numundiag as a result so just do plhiv - diag
+                    thisresult = outcomes['numplhiv'] - outcomes['numdiag']
+                else: # just extract the key from the outcomes
+                    thisresult = outcomes['num'+key] # the instantaneous outcome e.g. objectives['numdeath'] #CKCHANGE
+
+                baseline[key] = float(thisresult[baseind])
+                final[key] = float(thisresult[finalind])
+                if targetfrac[key] is not None:
+                    target[key] = float(baseline[key]*(1-targetfrac[key]))
+                    if final[key] > target[key]: targetsmet = False # Targets are NOT met #CKCHANGE
+                else: pass # Used to make target[key] = -1, but it is more robust to not add a target when there is not one
+
+            targetprops = odict([(key,objectives[key]) for key in objectives['cascadekeys']])
+            for key in objectives['cascadekeys']:
+                thisresult = 1 - outcomes[key] # the instantaneous outcome e.g. objectives['numdeath'] #CKCHANGE
+                final[key] = float(thisresult[finalind])
+                if objectives[key] is not None:
+                    target[key] = 1 - objectives[key]
+                    if final[key] > target[key]: targetsmet = False # Targets are NOT met #CKCHANGE
+                else: pass # Used to make target[key] = -1, but it is more robust to not add a target when there is not one
+
+            # Output results
+            if outputresults:
+                results.outcomes = odict([('baseline',baseline), ('final',final), ('target',target), ('targetfrac',targetfrac), ('targetprop',targetprops)])
+                results.budgetyears = [objectives['start']] # Use the starting year
+                results.budget = constrainedbudget # Convert to budget
+                results.targetsmet = targetsmet
+                results.target = target
+                results.rawoutcomes = final
+                output = results
+            else:
+                summary = 'Baseline: %0.0f %0.0f %0.0f | Target: %0.0f %0.0f %0.0f | Final: %0.0f %0.0f %0.0f' % tuple(baseline.values()+target.values()+final.values())
+                output = (targetsmet, summary)
 
-    ## It's money
-    elif which=='money':
-        # Calculate outcome
-        targetsmet = True # Assume success until proven otherwise (since operator is AND, not OR)
-        baseline = odict()
-        final = odict()
-        target = odict()
-        targetfrac = odict([(key,objectives[key+'frac']) for key in objectives['keys']]) # e.g. {'inci':objectives['incifrac']} = 0.4 = 40% reduction in incidence
-        for key in objectives['keys']:
-            if key == 'undiag': # don't have numundiag as a result so just do plhiv - diag
-                thisresult = results.main['numplhiv'].tot[0] - results.main['numdiag'].tot[0]
-            else: # just extract the key from results.main
-                thisresult = results.main['num'+key].tot[0] # the instantaneous outcome e.g. objectives['numdeath'] -- 0 is since best #CKCHANGE
-
-            baseline[key] = float(thisresult[baseind])
-            final[key] = float(thisresult[finalind])
-            if targetfrac[key] is not None:
-                target[key] = float(baseline[key]*(1-targetfrac[key]))
-                if final[key] > target[key]: targetsmet = False # Targets are NOT met #CKCHANGE
-            else: pass # Used to make target[key] = -1, but it is more robust to not add a target when there is not one
-        
-        targetprops = odict([(key,objectives[key]) for key in objectives['cascadekeys']])
-        for key in objectives['cascadekeys']:
-            thisresult = 1 - results.main[key].tot[0] # the instantaneous outcome e.g. objectives['numdeath'] -- 0 is since best #CKCHANGE
-            final[key] = float(thisresult[finalind])
-            if objectives[key] is not None:
-                target[key] = 1 - objectives[key]
-                if final[key] > target[key]: targetsmet = False # Targets are NOT met #CKCHANGE
-            else: pass # Used to make target[key] = -1, but it is more robust to not add a target when there is not one
-
-        # Output results
-        if outputresults:
-            results.outcomes = odict([('baseline',baseline), ('final',final), ('target',target), ('targetfrac',targetfrac), ('targetprop',targetprops)])
-            results.budgetyears = [objectives['start']] # Use the starting year
-            results.budget = constrainedbudget # Convert to budget
-            results.targetsmet = targetsmet
-            results.target = target
-            results.rawoutcomes = final
-            output = results
-        else:
-            summary = 'Baseline: %0.0f %0.0f %0.0f | Target: %0.0f %0.0f %0.0f | Final: %0.0f %0.0f %0.0f' % tuple(baseline.values()+target.values()+final.values())
-            output = (targetsmet, summary)
+        if printdone: printv(printdone,2,verbose)
+        if cachekey is not None: outcomecache.store(cachekey, output)
+        return output
+    
+    if deferrun: return runkwargs, calcoutcome # Leave it to the caller to run the model, e.g. batchoutcomecalc()
+    return calcoutcome(project.runsim(**runkwargs))
+
+
+def batchoutcomecalc(budgetvecs=None, project=None, **kwargs):
+    '''
+    Evaluate the objective for several budget vectors, running the model for all of them together with batchmodel()
+    rather than one at a time. Takes the same arguments as outcomecalc(), and returns a list of objective values.
+    '''
+    deferred = [outcomecalc(budgetvec=budgetvec, project=project, deferrun=True, **kwargs) for budgetvec in budgetvecs]
+    torun = [ind for ind,(thisrunkwargs,calcoutcome) in enumerate(deferred) if thisrunkwargs is not None] # Skip any found in the cache
+    outcomeslist = [None]*len(deferred)
+    if torun:
+        runkwargs = dict(deferred[torun[0]][0])
+        runkwargs['deltapars'] = [deferred[ind][0]['deltapars'] for ind in torun] # Everything else is the same
+        runkwargs['budget'] = runkwargs['coverage'] = None # Not used without a Resultset
+        for ind,outcomes in zip(torun, project.runsim(**runkwargs)): outcomeslist[ind] = outcomes
+    return [calcoutcome(outcomes) for (thisrunkwargs,calcoutcome),outcomes in zip(deferred, outcomeslist)]
+
+
+def batchevaluator(function, xlist, args):
+    ''' Evaluator for asd() that runs the models for all candidate budgets together, for use with popsize>1 '''
+    if function is not outcomecalc:
+        errormsg = 'batchevaluator() can only be used with outcomecalc(), not %s' % function
+        raise OptimaException(errormsg)
+    return batchoutcomecalc(budgetvecs=xlist, **args)
+
+
+
+
+
+################################################################################################################################################
+### Persistent worker pool
+################################################################################################################################################
+
+optimworkercache = odict() # Projects held by each worker process, keyed by UID
+
+class Projectpickler(pickle.Pickler):
+    ''' Pickler that replaces the project (e.g. in Link objects) with its UID, so it doesn't get sent to the workers every time '''
+    def __init__(self, file, project=None):
+        pickle.Pickler.__init__(self, file, protocol=-1)
+        self.project = project
+    
+    def persistent_id(self, obj):
+        if self.project is not None and obj is self.project: return ('project', self.project.uid)
+        else: return None
+
+
+class Projectunpickler(pickle.Unpickler):
+    ''' Unpickler that puts back the project from the cache of projects the worker has already received '''
+    def __init__(self, file, projects=None):
+        pickle.Unpickler.__init__(self, file)
+        self.projects = projects if projects is not None else optimworkercache
+    
+    def persistent_load(self, pid):
+        typename, uid = pid
+        if uid not in self.projects:
+            errormsg = 'Project %s has not been sent to this worker' % uid
+            raise OptimaException(errormsg)
+        return self.projects[uid]
 
-    if printdone: printv(printdone,2,verbose)
-    return output
 
+def initoptimworker(projectdata=None):
+    ''' Run once by each worker in the pool: unpickle the project and store it '''
+    project = pickle.loads(projectdata)
+    optimworkercache[project.uid] = project
+    return None
 
 
+def runasd(**kwargs):
+    '''
+    Run asd(), and also return the process and the numbers of hits and misses of the Outcomecache in its args while it
+    ran, so that if it ran in another process, they can be added to the original cache with gatherasd()
+    '''
+    outcomecache = kwargs.get('args', {}).get('outcomecache')
+    if outcomecache: hits, misses = outcomecache.hits, outcomecache.misses
+    output = asd(**kwargs)
+    cachestats = (os.getpid(), outcomecache.hits-hits, outcomecache.misses-misses) if outcomecache else None
+    return output, cachestats
+
+
+def gatherasd(allargs=None, rawoutputs=None):
+    ''' Get the outputs of runasd() for each set of keyword arguments in allargs, adding up the cache statistics '''
+    outputs = []
+    for thisargs, (output, cachestats) in zip(allargs, rawoutputs):
+        outcomecache = thisargs.get('args', {}).get('outcomecache')
+        if outcomecache: outcomecache.addstats(cachestats)
+        outputs.append(output)
+    return outputs
+
+
+def runoptimtask(taskdata=None):
+    ''' Run a single asd() call in a worker, using the cached project '''
+    kwargs = Projectunpickler(io.BytesIO(taskdata)).load()
+    return runasd(**kwargs)
+
+
+def makeoptimpool(project=None, ncpus=None):
+    '''
+    Start a pool of worker processes for running optimizations. Each worker receives the project once, when it
+    starts, and afterwards only the arguments to asd() (the budget vector, seed, etc.) are sent. Use with
+    runoptimpool(), and call pool.terminate() when finished.
+    '''
+    if ncpus is None: ncpus = int(ceil( cpu_count()/2 ))
+    projectdata = pickle.dumps(project, protocol=-1)
+    pool = Pool(processes=int(ncpus), initializer=initoptimworker, initargs=(projectdata,))
+    return pool
+
+
+def runoptimpool(pool=None, project=None, allargs=None, stoppingfunc=None, verbose=2):
+    '''
+    Run asd() for each set of keyword arguments in allargs using a pool made by makeoptimpool(), in the same order. The
+    stopping function is checked here rather than in the workers, since it often can't be pickled.
+    '''
+    tasks = []
+    for thisargs in allargs:
+        thisargs = dict(thisargs, stoppingfunc=None)
+        output = io.BytesIO()
+        Projectpickler(output, project=project).dump(thisargs)
+        tasks.append(output.getvalue())
+    printv('Sending %i tasks to the optimization pool (%0.1f kB each)' % (len(tasks), sum([len(task) for task in tasks])/1e3/max(1,len(tasks))), 3, verbose)
+    asyncresults = pool.map_async(runoptimtask, tasks)
+    while not asyncresults.ready():
+        asyncresults.wait(0.5)
+        if stoppingfunc and stoppingfunc():
+            raise op.CancelException
+    return gatherasd(allargs=allargs, rawoutputs=asyncresults.get())
+
 
 
 def optimize(optim=None, maxiters=None, maxtime=None, finishtime=None, verbose=2, stoppingfunc=None, die=False, origbudget=None,
-             randseed=None, mc=None, label=None, outputqueue=None, ncpus=None, parallel=True, *args, **kwargs):
+             randseed=None, mc=None, label=None, outputqueue=None, ncpus=None, parallel=True, pool=None, outcomecache=None, *args, **kwargs):
     '''
     The standard Optima optimization function: minimize outcomes for a fixed total budget.
     
@@ -802,6 +1209,8 @@ def optimize(optim=None, maxiters=None, maxtime=None, finishtime=None, verbose=2
         randseed = optionally reset the seed
         mc = how many Monte Carlo seeds to run for (if negative, randomize the start location as well)
         label = a string to append to error messages to make it clear where things went wrong
+        pool = a pool made by makeoptimpool() to run the optimizations in (outcomes only)
+        outcomecache = an Outcomecache to store the objective values in, e.g. to share between chains (outcomes only; False to not use one)
 
     Version: 1.4 (2017apr01)
     '''
@@ -856,7 +1265,7 @@ def optimize(optim=None, maxiters=None, maxtime=None, finishtime=None, verbose=2
     if which=='outcomes':
         multires = minoutcomes(project=project, optim=optim, tvec=tvec, verbose=verbose, maxtime=maxtime, finishtime=finishtime,
                                maxiters=maxiters, absconstraints=absconstraints, origbudget=origbudget, randseed=randseed,
-                               mc=mc, label=label, parallel=parallel, ncpus=ncpus,die=die, stoppingfunc=stoppingfunc, **kwargs)
+                               mc=mc, label=label, parallel=parallel, ncpus=ncpus,die=die, stoppingfunc=stoppingfunc, pool=pool, outcomecache=outcomecache, **kwargs)
 
     # Run money minimization
     elif which=='money':
@@ -876,10 +1285,11 @@ def optimize(optim=None, maxiters=None, maxtime=None, finishtime=None, verbose=2
 
 def multioptimize(optim=None, nchains=None, nblocks=None, blockiters=None, mc=None, randseed=None,
                   maxiters=None, maxtime=None, finishtime=None, verbose=2, ncpus=None, parallel=None,
-                  stoppingfunc=None, die=False, origbudget=None, label=None, tol=1e-3, budgettol=100, **kwargs):
+                  stoppingfunc=None, die=False, origbudget=None, label=None, tol=1e-3, budgettol=100, progressfunc=None, **kwargs):
     '''
     Run a multi-chain optimization. See project.optimize() for usage examples, and optimize()
-    for kwarg explanation.
+    for kwarg explanation. The progress given to progressfunc (see minoutcomes()) also has the
+    block, nblocks, chain and nchains.
 
     Small usage example:
         import optima as op
@@ -921,79 +1331,87 @@ def multioptimize(optim=None, nchains=None, nblocks=None, blockiters=None, mc=No
     bestfvalval = inf
 
     printv('Starting a parallel optimization with %i chains (%i cpu threads) for %i iterations each for %i blocks' % (nchains, ncpus, maxiters, nblocks), 2, verbose)
-    # Loop over the optimization blocks
-    for block in range(nblocks):
-        printv(f'\nStarting block {block+1}/{nblocks} with {thischains} chains\n', 2, verbose)
-
-        # Set up the parallel process
-        outputqueue = Queue()
-        outputlist = empty(thischains, dtype=object)
-        processes = []
-
-        # Loop over the threads, starting the processes
-        for thread in range(thischains):
-            blockrand = (block+1)*(2**6-1) # Pseudorandom seeds
-            threadrand = (thread+1)*(2**10-1)
-            randtime = int((time()-floor(time()))*1e4)
-            if randseed is None: thisseed = (blockrand+threadrand)*randtime # Get a random number based on both the time and the thread
-            else:                thisseed = randseed + blockrand+threadrand
-            optim._threadindex = thread # Store the thread index
-            optimargs = (optim, maxiters, maxtime, finishtime, verbose, stoppingfunc, die, thisorigbudget[thread], thisseed, thismc[thread], label, outputqueue, chaincpus, parallel, kwargs)
-            prc = Process(target=optimize, args=optimargs)
-            prc.start()
-            processes.append(prc)
-
-        # Tidy up: close the threads and gather the results
-        for i in range(thischains):
-            result = outputqueue.get() # This is needed or else the process never finishes
-            threadindex = result.optim._threadindex # To ensure a robust ordering
-            outputlist[threadindex] = result
-            if block==0 and threadindex==0: origresults = dcp(result) # Copy the original results from the first optimization
-        for prc in processes:
-            prc.join() # Wait for them to finish
-
-        # Figure out which one did best
-        lastfvalval = bestfvalval if bestfvalval < inf else outputlist[0].improvement[0][0]
-        lastbestbudget = thisorigbudget[0]
-        bestfvalval = inf
-        bestfvalind = None
-        bestfvalvalarr = zeros(totalmc)
-        originalindarr = zeros(totalmc,dtype=int)
-        allbudgets = [None] * totalmc
-        j = 0
-        for i in range(thischains):
-            if block==0 and i==0: fvalarray[:,0] = outputlist[i].improvement[0][0] # Store the initial value
-            thischain = outputlist[i].improvement[0][1:] # The chain to store the improvement of -- NB, improvement is an odict
-            leftbound = block * maxiters + 1
-            rightbound = block * maxiters + len(thischain) + 1
-            fvalarray[i,leftbound:rightbound] = thischain
-            for key in outputlist[i].fullruninfo[0].keys():
-                allbudgets[j]     = outputlist[i].fullruninfo[0][key]['budget']
-                bestfvalvalarr[j] = outputlist[i].fullruninfo[0][key]['fvals'][-1]
-                originalindarr[j] = i
-                j += 1
-
-        sortedbestfvalinds = argsort(bestfvalvalarr)
-        bestfvalind = sortedbestfvalinds[0]
-        bestfvalval = bestfvalvalarr[bestfvalind]
-
-        if block == 0:  # After the first block we switch to no mc
-            thischains = newchains
-            thismc = newmc
-            chaincpus = int(ceil(ncpus / thischains))
-
-        thisorigbudget = [allbudgets[sortedbestfvalinds[i]] for i in range(thischains)]  # Update original budgets to choose the best in order, one for each chain
-
-        printv(f'\nFinished block {block+1}/{nblocks}. Outcome improved from {lastfvalval} to {bestfvalval}. Ratio: {bestfvalval / lastfvalval}.\n', 2, verbose)
-        printv(f'Last block to this budget difference: {sum(abs(lastbestbudget[:] - thisorigbudget[0][:]))}: {lastbestbudget[:] - thisorigbudget[0][:]}\n', 2, verbose)
-
-        # Check if we should skip the rest of the blocks, because this block gave the same budget and outcomes back
-        if lastfvalval - bestfvalval <= tol and all(abs(lastbestbudget[:] - thisorigbudget[0][:]) < budgettol) and block+1 < nblocks:
-            printv(f'\nSkipping the last {nblocks-(block+1)}/{nblocks} blocks as we got the same budget and outcomes back from this block as the last!\n',2, verbose)
-            break
-        if finishtime is not None and time() > finishtime and block+1 < nblocks:
-            printv(f'\nSkipping the last {nblocks-(block+1)}/{nblocks} blocks as we are {time()-finishtime:.2f} seconds past the finish time!\n',2, verbose)
-            break
+
+    # Start the worker pool, which gets sent the project once and is reused for every block
+    project = optim.projectref()
+    absconstraints = optim.getabsconstraints()
+    if absconstraints is not None: project.progsets[optim.progsetname].reorderprograms(absconstraints['name'].keys()) # Do this before the chains start so they don't all do it at once
+    pool = makeoptimpool(project=project, ncpus=ncpus) if parallel else None
+    outcomecache = kwargs.pop('outcomecache', None)
+    if outcomecache is None: outcomecache = Outcomecache() # Shared by all the chains, so budgets already tried by one chain aren't rerun by another
+
+    def runchain(thread):
+        ''' Run one chain of this block: the setup runs in this thread, and the calls to asd() run in the pool '''
+        blockrand = (block+1)*(2**6-1) # Pseudorandom seeds
+        threadrand = (thread+1)*(2**10-1)
+        randtime = int((time()-floor(time()))*1e4)
+        if randseed is None: thisseed = (blockrand+threadrand)*randtime # Get a random number based on both the time and the thread
+        else:                thisseed = randseed + blockrand+threadrand
+        if progressfunc:
+            def chainprogress(info, block=block, nchains=thischains):
+                info.update(block=block+1, nblocks=nblocks, chain=thread+1, nchains=nchains)
+                progressfunc(info)
+        else:
+            chainprogress = None
+        return optimize(optim=optim, maxiters=maxiters, maxtime=maxtime, finishtime=finishtime, verbose=verbose, stoppingfunc=stoppingfunc, die=die,
+                        origbudget=thisorigbudget[thread], randseed=thisseed, mc=thismc[thread], label=label, ncpus=chaincpus, parallel=parallel, pool=pool,
+                        outcomecache=outcomecache, progressfunc=chainprogress, checkpointlabel='block%i-chain%i-' % (block+1, thread+1), **kwargs)
+
+    try:
+        # Loop over the optimization blocks
+        for block in range(nblocks):
+            printv(f'\nStarting block {block+1}/{nblocks} with {thischains} chains\n', 2, verbose)
+
+            # Run the chains, each in its own thread, and gather the results in order
+            threadpool = ThreadPool(thischains if parallel else 1)
+            try:     outputlist = threadpool.map(runchain, range(thischains))
+            finally: threadpool.terminate()
+            if block==0: origresults = dcp(outputlist[0]) # Copy the original results from the first optimization
+
+            # Figure out which one did best
+            lastfvalval = bestfvalval if bestfvalval < inf else outputlist[0].improvement[0][0]
+            lastbestbudget = thisorigbudget[0]
+            bestfvalval = inf
+            bestfvalind = None
+            bestfvalvalarr = zeros(totalmc)
+            originalindarr = zeros(totalmc,dtype=int)
+            allbudgets = [None] * totalmc
+            j = 0
+            for i in range(thischains):
+                if block==0 and i==0: fvalarray[:,0] = outputlist[i].improvement[0][0] # Store the initial value
+                thischain = outputlist[i].improvement[0][1:] # The chain to store the improvement of -- NB, improvement is an odict
+                leftbound = block * maxiters + 1
+                rightbound = block * maxiters + len(thischain) + 1
+                fvalarray[i,leftbound:rightbound] = thischain
+                for key in outputlist[i].fullruninfo[0].keys():
+                    allbudgets[j]     = outputlist[i].fullruninfo[0][key]['budget']
+                    bestfvalvalarr[j] = outputlist[i].fullruninfo[0][key]['fvals'][-1]
+                    originalindarr[j] = i
+                    j += 1
+
+            sortedbestfvalinds = argsort(bestfvalvalarr)
+            bestfvalind = sortedbestfvalinds[0]
+            bestfvalval = bestfvalvalarr[bestfvalind]
+
+            if block == 0:  # After the first block we switch to no mc
+                thischains = newchains
+                thismc = newmc
+                chaincpus = int(ceil(ncpus / thischains))
+
+            thisorigbudget = [allbudgets[sortedbestfvalinds[i]] for i in range(thischains)]  # Update original budgets to choose the best in order, one for each chain
+
+            printv(f'\nFinished block {block+1}/{nblocks}. Outcome improved from {lastfvalval} to {bestfvalval}. Ratio: {bestfvalval / lastfvalval}.\n', 2, verbose)
+            printv(f'Last block to this budget difference: {sum(abs(lastbestbudget[:] - thisorigbudget[0][:]))}: {lastbestbudget[:] - thisorigbudget[0][:]}\n', 2, verbose)
+
+            # Check if we should skip the rest of the blocks, because this block gave the same budget and outcomes back
+            if lastfvalval - bestfvalval <= tol and all(abs(lastbestbudget[:] - thisorigbudget[0][:]) < budgettol) and block+1 < nblocks:
+                printv(f'\nSkipping the last {nblocks-(block+1)}/{nblocks} blocks as we got the same budget and outcomes back from this block as the last!\n',2, verbose)
+                break
+            if finishtime is not None and time() > finishtime and block+1 < nblocks:
+                printv(f'\nSkipping the last {nblocks-(block+1)}/{nblocks} blocks as we are {time()-finishtime:.2f} seconds past the finish time!\n',2, verbose)
+                break
+    finally:
+        if pool is not None: pool.terminate() # Stop the workers even if the optimization was cancelled
 
     bestfvalind = originalindarr[bestfvalind] # Convert from individual run index to chain index
 
@@ -1013,7 +1431,7 @@ def multioptimize(optim=None, nchains=None, nblocks=None, blockiters=None, mc=No
 
 
 def tvoptimize(project=None, optim=None, tvec=None, verbose=None, maxtime=None, finishtime=None, maxiters=5000, origbudget=None,
-               ccsample='best', randseed=None, mc=None, label=None, die=False, ncpus=None, parallel=True, keepzeroinfresults=False, **kwargs):
+               ccsample='best', randseed=None, mc=None, label=None, die=False, ncpus=None, parallel=True, keepzeroinfresults=False, checkpoint=None, **kwargs):
     '''
     Run a time-varying optimization. See project.optimize() for usage examples, and optimize()
     for kwarg explanation.
@@ -1038,7 +1456,7 @@ def tvoptimize(project=None, optim=None, tvec=None, verbose=None, maxtime=None,
     optim.tvsettings['timevarying'] = False # Turn off for the first run
     prelim = optimize(optim=optim, maxtime=maxtime, finishtime=finishtime, maxiters=maxiters, verbose=verbose, origbudget=origbudget,
                 ccsample=ccsample, randseed=randseed, mc=mc, ncpus=ncpus, parallel=parallel, label=label, die=die, keepraw=True,
-                keepzeroinfresults=keepzeroinfresults, **kwargs)
+                keepzeroinfresults=keepzeroinfresults, checkpoint=checkpoint, checkpointlabel='prelim-', **kwargs)
     rawresults = prelim.raw['Baseline'][0] # Store the raw results; "Baseline" vs. "Optimized" shouldn't matter, and [0] is the first/best run -- not sure if there is a more robut way
 
     # Add in the time-varying component
@@ -1121,6 +1539,7 @@ def tvoptimize(project=None, optim=None, tvec=None, verbose=None, maxtime=None,
     # Now run the optimization
     origoutcomes = outcomecalc(outputresults=True, **args) # Calculate the initial outcome and pass it back in
     args['origoutcomes'] = origoutcomes
+    if checkpoint: kwargs.update(checkpoint=checkpoint.saver('timevarying'), resumestate=checkpoint.load('timevarying'))
     res = asd(outcomecalc, tvvec, args=args, xmin=xmin, xmax=xmax, sinitial=sinitial, maxtime=maxtime, finishtime=finishtime, maxiters=maxiters, verbose=verbose, randseed=randseed, label=thislabel, **kwargs)
     tvvecnew, fvals = res.x, res.details.fvals
     budgetvec, tvcontrolvec = separatetv(inputvec=tvvecnew, optimkeys=optimkeys)
@@ -1155,8 +1574,16 @@ def tvoptimize(project=None, optim=None, tvec=None, verbose=None, maxtime=None,
 
 def minoutcomes(project=None, optim=None, tvec=None, absconstraints=None, verbose=None, maxtime=None, finishtime=None,
                 maxiters=None, ncpus=None, parallel=True, origbudget=None, ccsample='best', randseed=None, mc=None, label=None,
-                die=False, timevarying=None, keepraw=False, stoppingfunc=None, rejectfactor=None, keepzeroinfresults=False, **kwargs):
+                die=False, timevarying=None, keepraw=False, stoppingfunc=None, rejectfactor=None, keepzeroinfresults=False, pool=None, outcomecache=None,
+                progressfunc=None, checkpoint=None, checkpointlabel='', **kwargs):
     ''' Split out minimize outcomes.
+        pool: optionally, a pool made by makeoptimpool() to run the optimizations in, instead of starting new processes
+        progressfunc: optionally, a function called with the progress from asd() (see there), plus the run (its key), runind, nruns
+             and the constrained budget; when running in parallel, each run is instead reported once it finishes
+        checkpoint: optionally, an Optimcheckpoint to save the state of each run to, and to resume them from
+        checkpointlabel: added to the start of each run's label in the checkpoint, e.g. to tell the chains of multioptimize() apart
+        outcomecache: optionally, an Outcomecache to look up objective values in (by default a new one is used; False to not use one)
+        popsize: passed to asd(), along with the other kwargs; if more than 1, the candidate budgets are run together with batchevaluator()
         mc: (baselines, randoms, progbaselines) counts the number of optimizations to start with each of:
              baselines start from the origbudget (rescaled and constrained)
              randoms start from a randomized (constrained) budget
@@ -1174,7 +1601,6 @@ def minoutcomes(project=None, optim=None, tvec=None, absconstraints=None, verbos
     elif mc is None or sum(mc) == 0: mc = (1,0,0) # Default to just running from Optimization baseline
     printv(f'Running minoutcomes with mc: {mc}',2,verbose)
 
-    parset  = project.parsets[optim.parsetname] # Link to the original parameter set
     progset = project.progsets[optim.progsetname] # Link to the original program set
 
     # Reorder the programs to match the order of the constraints, and get optiminds and optimkeys
@@ -1198,10 +1624,8 @@ def minoutcomes(project=None, optim=None, tvec=None, absconstraints=None, verbos
     if label is None: label = ''
 
     # Calculate the initial people distribution
-    results = project.runsim(pars=parset.pars, parsetname=optim.parsetname, progsetname=optim.progsetname, tvec=tvec, keepraw=True, verbose=0, label=project.name+'-minoutcomes', addresult=False, advancedtracking=True)
-    startind = findnearest(results.raw[0]['tvec'], optim.objectives['start']-1) ## !!! -1 is because of parameter interpolation / smoothing from the current parameters to the budget parameters, we have to start a year before the budget starts
-    initpeople = results.raw[0]['people'][:,:,startind] # Pull out the people array corresponding to the start of the optimization -- there shouldn't be multiple raw arrays here
-    initprops  = results.raw[0]['props'][:,startind,:]  # Need initprops if running with initpeople
+    snapshot = project.getsnapshot(parsetname=optim.parsetname, year=optim.objectives['start']-1, tvec=tvec) ## !!! -1 is because of parameter interpolation / smoothing from the current parameters to the budget parameters, we have to start a year before the budget starts
+    startind, initpeople, initprops = snapshot['startind'], snapshot['initpeople'], snapshot['initprops'] # Need initprops if running with initpeople
 
     if stoppingfunc and stoppingfunc():
         raise op.CancelException
@@ -1227,6 +1651,8 @@ def minoutcomes(project=None, optim=None, tvec=None, absconstraints=None, verbos
             'initprops':  initprops,
             'keepraw':    keepraw,
             }
+    if outcomecache is None: outcomecache = Outcomecache() # Don't rerun budgets that have already been tried
+    if outcomecache: args['outcomecache'] = outcomecache
 
     # Set up extremes
     extremebudgets = odict()
@@ -1329,7 +1755,7 @@ def minoutcomes(project=None, optim=None, tvec=None, absconstraints=None, verbos
                 hashed = int(md5(key.encode()).hexdigest(), 16) % maxseed
                 return int(randseed + scalefactorrand + hashed) % maxseed
 
-            seed(pseudorandomseed('Seed before creating the random budgets'))
+            budgetrng = RandomState(pseudorandomseed('Seed before creating the random budgets')) # Not the global random state, since chains may run in threads
 
             # Add baseline budgets, then random budgets, then progbaselines
             for i in range(mc[0]):
@@ -1338,7 +1764,7 @@ def minoutcomes(project=None, optim=None, tvec=None, absconstraints=None, verbos
 
             randbudgets = 0
             for i in range(mc[1]):
-                randbudget = random(noptimprogs)
+                randbudget = budgetrng.random_sample(noptimprogs)
                 randbudget = randbudget / randbudget.sum() * constrainedbudgetvec.sum()
                 allbudgetvecs['Random %s' % (i+1)] = randbudget
                 randbudgets += 1
@@ -1350,16 +1776,19 @@ def minoutcomes(project=None, optim=None, tvec=None, absconstraints=None, verbos
 
             # Fill out the rest with extra random budgets if needed
             for i in range( sum(mc) - len(allbudgetvecs.keys()) ):
-                randbudget = random(noptimprogs)
+                randbudget = budgetrng.random_sample(noptimprogs)
                 randbudget = randbudget / randbudget.sum() * constrainedbudgetvec.sum()
                 allbudgetvecs['Random %s' % (randbudgets+i+1)] = randbudget
 
             allseeds = [pseudorandomseed(key) for key in allbudgetvecs.keys()]
 
             # Actually run the optimizations
+            runstart = time()
             bestfval = inf # Value of outcome
             asdresults = odict()
             allargs = [None] * len(allbudgetvecs.keys())
+            if kwargs.get('popsize') and kwargs['popsize']>1 and kwargs.get('evaluator') is None:
+                kwargs['evaluator'] = batchevaluator # Run the models for the candidate budgets on each asd() iteration together
             for k,key in enumerate(allbudgetvecs.keys()):
 
                 if stoppingfunc and stoppingfunc():
@@ -1369,16 +1798,32 @@ def minoutcomes(project=None, optim=None, tvec=None, absconstraints=None, verbos
                 if label: thislabel = '"'+label+'-'+key+'"'
                 else: thislabel = '"'+key+'"'
                 allargs[k] = {'function':outcomecalc, 'x':allbudgetvecs[key], 'args':args, 'xmin':xmin, 'maxtime':maxtime, 'finishtime':finishtime, 'maxiters':maxiters, 'verbose':verbose, 'randseed':allseeds[k], 'label':thislabel, 'stoppingfunc':stoppingfunc, **kwargs }
+                if progressfunc and pool is None and not parallel: # Otherwise asd() runs in other processes, so the runs are reported as they finish
+                    def runprogress(info, key=key, k=k):
+                        info.update(run=key, runind=k+1, nruns=len(allbudgetvecs))
+                        info['budget'] = constrainbudget(origbudget=origbudget, budgetvec=dcp(info.x), totalbudget=totalbudget, absconstraints=absconstraints, optimkeys=optimkeys, outputtype='full', verbose=0)[0]
+                        progressfunc(info)
+                    allargs[k]['progressfunc'] = runprogress
+                if checkpoint:
+                    runlabel = '%s%s-%s' % (checkpointlabel, scalefactor, key)
+                    allargs[k]['resumestate'] = checkpoint.load(runlabel)
+                    if checkpoint.isfolder() or (pool is None and not parallel): # Otherwise, the run is saved once it finishes
+                        allargs[k]['checkpoint'] = checkpoint.saver(runlabel)
 
             # Run the optimizations in parallel
-            if parallel: printv(f'\nRunning {len(allargs)} optimizations in parallel using {int(min(ncpus,len(allargs)))} cpu threads',2,verbose)
+            if pool is not None: printv(f'\nRunning {len(allargs)} optimizations in the optimization pool',2,verbose)
+            elif parallel: printv(f'\nRunning {len(allargs)} optimizations in parallel using {int(min(ncpus,len(allargs)))} cpu threads',2,verbose)
             else: printv(f'\nRunning {len(allargs)} optimizations in serial',2,verbose)
 
             # Need different settings for older than sciris 2.0.2
             if compareversions(sc.__version__, '2.0.2') < 0 or compareversions(sc.__version__, '3.0.0') >= 0:  not_parsettings = {'serial':True}
             else: not_parsettings = {'parallelizer':'serial-nocopy'}
 
-            try: asdrawresults = sc.parallelize(asd, iterkwargs=allargs, ncpus=int(ncpus), **(not_parsettings if not parallel else {}))
+            try:
+                if pool is not None: asdrawresults = runoptimpool(pool=pool, project=project, allargs=allargs, stoppingfunc=stoppingfunc, verbose=verbose)
+                else:                asdrawresults = gatherasd(allargs, sc.parallelize(runasd, iterkwargs=allargs, ncpus=int(ncpus), **(not_parsettings if not parallel else {})))
+            except op.CancelException:
+                raise
             except Exception as e:
                 parallel = False
                 if isinstance(e, AssertionError):
@@ -1386,8 +1831,9 @@ def minoutcomes(project=None, optim=None, tvec=None, absconstraints=None, verbos
                 else:
                     print_exc()
                     printv('\nWARNING: Could not run in parallel from some unknown error: Trying in serial...',1,verbose)
-                asdrawresults = sc.parallelize(asd, iterkwargs=allargs, ncpus=int(ncpus), **not_parsettings)
+                asdrawresults = gatherasd(allargs, sc.parallelize(runasd, iterkwargs=allargs, ncpus=int(ncpus), **not_parsettings))
 
+            if outcomecache: printv('Objective values: %s' % outcomecache, 2, verbose)
             if verbose >=3: print(f'\nasd returned best outcomes {list(zip(allbudgetvecs.keys(),[res["fval"] for res in asdrawresults]))}\n')
 
             for k, key in enumerate(allbudgetvecs.keys()):
@@ -1396,6 +1842,11 @@ def minoutcomes(project=None, optim=None, tvec=None, absconstraints=None, verbos
                 budgetvecnew, fvals = res.x, res.details.fvals
                 constrainedbudgetnew, constrainedbudgetvecnew, lowerlim, upperlim = constrainbudget(origbudget=origbudget, budgetvec=budgetvecnew, totalbudget=totalbudget, absconstraints=absconstraints, optimkeys=optimkeys, outputtype='full')
                 asdresults[key] = {'budget':constrainedbudgetnew, 'fvals':fvals}
+                if checkpoint and 'checkpoint' not in allargs[k]:
+                    checkpoint.save('%s%s-%s' % (checkpointlabel, scalefactor, key), res.details.state)
+                if progressfunc and 'progressfunc' not in allargs[k]:
+                    progressfunc(sc.objdict(iteration=len(fvals)-1, maxiters=maxiters, fval=fvals[-1], fvalorig=fvals[0], elapsed=time()-runstart, x=budgetvecnew,
+                                            label=allargs[k]['label'], run=key, runind=k+1, nruns=len(allbudgetvecs), budget=constrainedbudgetnew))
                 if fvals[-1]<bestfval: 
                     bestkey = key # Reset key
                     bestfval = fvals[-1] # Reset fval
@@ -1461,17 +1912,19 @@ def minoutcomes(project=None, optim=None, tvec=None, absconstraints=None, verbos
 
 def minmoney(project=None, optim=None, tvec=None, verbose=None, maxtime=None, finishtime=None, maxiters=1000, absconstraints=None,
              fundingchange=1.2, tolerance=1e-2, ccsample='best', randseed=None, keepraw=False, die=False, keepzeroinfresults=False,
-             n_throws=None, n_success=None, n_refine=None, schedule=None, parallel=True, ncpus=None, stoppingfunc=None, **kwargs):
+             n_throws=None, n_success=None, n_refine=None, schedule=None, parallel=True, ncpus=None, stoppingfunc=None, progressfunc=None, **kwargs):
     '''
     A function to minimize money for a fixed objective.
     Note: maxtime and finishtime does nothing at the moment.
 
-    Version: 2019oct14
+    progressfunc: optionally, a function called after the binary search, each round of throws and each
+        local search step, with the same progress as from asd() but with the total budget as the fval
+
+    Version: 2026oct18
     '''
     
     ## Handle budget and remove fixed costs
     if project is None or optim is None: raise OptimaException('An optimization requires both a project and an optimization object to run')
-    parset = project.parsets[optim.parsetname] # Original parameter set
     # parset.fixprops(False) # It doesn't really make sense to minimize money with these fixed ... This shouldn't be handled here
     progset = project.progsets[optim.progsetname] # Link to the original program set
     if absconstraints is None: absconstraints = optim.getabsconstraints()
@@ -1542,6 +1995,17 @@ def minmoney(project=None, optim=None, tvec=None, verbose=None, maxtime=None, fi
         elif dist == 0: return True
         else:           raise Exception('Distance should never be negative, but it is %s' % dist)
     
+    def reportprogress(stage, totalbudget, budgetvec=None):
+        ''' Report the total budget found so far, and the allocation if there is one, to progressfunc '''
+        if not progressfunc: return None
+        info = sc.objdict(iteration=stage, maxiters=1+len(schedule)+len(refine_steps), fval=totalbudget, fvalorig=origtotalbudget,
+                          elapsed=time()-start, x=dcp(budgetvec), label='money')
+        if budgetvec is not None:
+            info['budget'] = dcp(origbudget)
+            info['budget'][optiminds] = budgetvec
+        progressfunc(info)
+        return None
+
     def outcome_met(budgetvec=None, totalbudget=None, args=None, target=None, scaleupmethod='multiply'):
         ''' Run an outcome calculation and determine if it meets the targets '''
         res = op.outcomecalc(budgetvec, totalbudget=totalbudget, outputresults=True,scaleupmethod=scaleupmethod, **args)
@@ -1560,10 +2024,8 @@ def minmoney(project=None, optim=None, tvec=None, verbose=None, maxtime=None, fi
     movie = []
 
     # Calculate initial people distribution
-    results = project.runsim(pars=parset.pars, parsetname=optim.parsetname, progsetname=optim.progsetname, tvec=tvec, keepraw=True, verbose=0, label=project.name+'-minoutcomes', addresult=False, advancedtracking=True)
-    startind = findnearest(results.raw[0]['tvec'], min(optim.objectives['base'], optim.objectives['start']) -1) ## !!! -1 is because of parameter interpolation / smoothing from the current parameters to the budget parameters, we have to start a year before the budget starts
-    initpeople = results.raw[0]['people'][:,:,startind] # Pull out the people array corresponding to the start of the optimization -- there shouldn't be multiple raw arrays here
-    initprops  = results.raw[0]['props'][:,startind,:]  # Need initprops if running with initpeople
+    snapshot = project.getsnapshot(parsetname=optim.parsetname, year=min(optim.objectives['base'], optim.objectives['start'])-1, tvec=tvec) ## !!! -1 is because of parameter interpolation / smoothing from the current parameters to the budget parameters, we have to start a year before the budget starts
+    startind, initpeople, initprops = snapshot['startind'], snapshot['initpeople'], snapshot['initprops'] # Need initprops if running with initpeople
     args.update({'startind':startind, 'initpeople':initpeople, 'initprops':initprops})
 
     # Run current budget (constrained)
@@ -1739,6 +2201,7 @@ def minmoney(project=None, optim=None, tvec=None, verbose=None, maxtime=None, fi
         totalbudget,b_list,r_list = binary_search(budgetvec=budgetvec, totalbudget=origtotalbudget, args=args, target=res_targ, curr_met=curr_met)
         for bud,res in zip(b_list,r_list):
             movie.append(res)
+        reportprogress(0, totalbudget) # No allocation yet, just the current budget scaled up
             
         #%% Throw n_throws points at current budget level
         printv('\n\n', 2, verbose)
@@ -1808,6 +2271,7 @@ def minmoney(project=None, optim=None, tvec=None, verbose=None, maxtime=None, fi
             this_allocation = prop*budgetvec
             allocated_budget[:] = this_allocation # This includes the previous allocation, so we can use = instead of +=
             printv('Total allocated after round %s: %s\nAllocation:\n%s' % (p+1, this_allocation.sum()/factor, this_allocation/factor), 2, verbose)
+            reportprogress(1+p, totalbudget, budgetvec)
         
         op.toc(start)
         
@@ -1859,6 +2323,7 @@ def minmoney(project=None, optim=None, tvec=None, verbose=None, maxtime=None, fi
                     else:
                         printv('   Target not met, rejecting...', 2, verbose)
                         refine_vec[ind] = 0
+            reportprogress(1+len(schedule)+r_s, totalbudget, budgetvec)
             
     
     #%% Tidy up
@@ -2052,10 +2517,8 @@ def icers(name=None, project=None, parsetname=None, progsetname=None, objective=
             defaultbudget[key] = minbudget
     
     # Calculate the initial people distribution
-    initresults = project.runsim(parsetname=parsetname, progsetname=progsetname, keepraw=True, verbose=0, label=project.name+'-minoutcomes', addresult=False, advancedtracking=True, end=objectives['end'])
-    startind = findnearest(initresults.raw[0]['tvec'], objectives['start']-1) ## !!! -1 is because of parameter interpolation / smoothing from the current parameters to the budget parameters, we have to start a year before the budget starts
-    initpeople = initresults.raw[0]['people'][:,:,startind] # Pull out the people array corresponding to the start of the optimization -- there shouldn't be multiple raw arrays here
-    initprops  = initresults.raw[0]['props'][:,startind,:]  # Need initprops if running with initpeople
+    snapshot = project.getsnapshot(parsetname=parsetname, year=objectives['start']-1, end=objectives['end']) ## !!! -1 is because of parameter interpolation / smoothing from the current parameters to the budget parameters, we have to start a year before the budget starts
+    startind, initpeople, initprops = snapshot['startind'], snapshot['initpeople'], snapshot['initprops'] # Need initprops if running with initpeople
 
     # Define arguments that don't change in the loop
     defaultargs = {'which':'outcomes', 'project':project, 'parsetname':parsetname, 'progsetname':progsetname, 'objectives':objectives, 
@@ -8,16 +8,20 @@ Version: 2.1 (2017apr04)
 
 from numpy import array, nan, isnan, isfinite, zeros, ones, argmax, mean, log, polyfit, exp, maximum, minimum, inf, linspace, median, shape, append, logical_and, isin, multiply, frombuffer
 from numpy.random import uniform, normal, seed, default_rng
-from optima import OptimaException, compareversions, Link, LinkException, standard_dcp, odict, odict_custom, dataframe, printv, sanitize, uuid, today, getdate, makefilepath, smoothinterp, dcp, defaultrepr, isnumber, findinds, findnearest, getvaliddata, promotetoarray, promotetolist, inclusiverange # Utilities
+from optima import OptimaException, compareversions, Link, LinkException, standard_dcp, odict, odict_custom, dataframe, printv, sanitize, uuid, today, getdate, makefilepath, smoothinterp, smoothinterprows, dcp, defaultrepr, isnumber, findinds, findnearest, getvaliddata, promotetoarray, promotetolist, inclusiverange # Utilities
 from optima import Settings, getresults, convertlimits, gettvecdt, loadpartable, loadtranstable # Heftier functions
 import optima as op
 from sciris import cp
 import hashlib
+import pickle
 from scipy.stats import truncnorm
 
 defaultsmoothness = 1.0 # The number of years of smoothing to do by default
 generalkeys = ['male', 'female', 'popkeys', 'injects', 'fromto', 'transmatrix'] # General parameter keys that are just copied
 staticmatrixkeys = ['birthtransit','agetransit','risktransit'] # Static keys that are also copied, but differently :)
+actskeys = ['actsreg', 'actscas', 'actscom'] # Keys whose receptive acts are calculated from the insertive acts and the population size
+simparscache = odict() # Cache of baseline simpars used by overlaysimpars(), keyed by parset and time vector
+simparscachesize = 4 # Maximum number of baseline simpars to keep in the cache
 
 # WARNING: the parameters that override one another are hardcoded here.
 # If more parameters are added that override others or if model.py is changed, they should be added here
@@ -43,6 +47,8 @@ __all__ = [
     'Parameterset',
     'makepars',
     'makesimpars',
+    'overlaysimpars',
+    'clearsimparscache',
     'applylimits',
     'comparepars',
     'comparesimpars',
@@ -737,12 +743,11 @@ class Metapar(Par):
         else: output = odict()
         meta = self.m if usemeta else 1.0
 
-        for pop,key in enumerate(outkeys): # Loop over each population, always returning an [npops x npts] array
-            if key in self.keys(): yval = y[key]*meta
-            else:                  yval = 0. # Population not present, set to zero
-            yinterp = applylimits(par=self, y=yval, limits=self.limits, dt=dt) 
-            if asarray: output[pop] = yinterp
-            else:       output[key] = yinterp
+        yvals = array([y[key]*meta if key in self.keys() else 0. for key in outkeys], dtype=float) # Populations not present are set to zero
+        yinterps = applylimits(par=self, y=yvals, limits=self.limits, dt=dt) # Apply the limits to all populations together
+        for pop,key in enumerate(outkeys):
+            if asarray: output[pop] = yinterps[pop]
+            else:       output[key] = yinterps[pop]
         return output
     
 
@@ -825,12 +830,12 @@ class Timepar(Par):
         if asarray: output = zeros((npops,len(tvec)))
         else:       output = odict()
 
+        keys = [key for key in outkeys if key in self.keys()] # Populations not present are set to zero
+        yinterps = meta * smoothinterprows(tvec, [self.t[key] for key in keys], [self.y[key] for key in keys], smoothness=smoothness) # Interpolate all populations together
+        yinterps = applylimits(par=self, y=yinterps, limits=self.limits, dt=dt)
         for pop,key in enumerate(outkeys): # Loop over each population, always returning an [npops x npts] array
-            if key in self.keys():
-                yinterp = meta * smoothinterp(tvec, self.t[key], self.y[key], smoothness=smoothness) # Use interpolation
-                yinterp = applylimits(par=self, y=yinterp, limits=self.limits, dt=dt)
-            else:
-                yinterp = zeros(len(tvec)) # Population not present, just set to zero
+            if key in keys: yinterp = yinterps[keys.index(key)]
+            else:           yinterp = zeros(len(tvec))
             if asarray: output[pop,:] = yinterp
             else:       output[key]   = yinterp
         if npops==1 and self.by=='tot' and asarray: return output[0,:] # npops should always be 1 if by==tot, but just be doubly sure
@@ -1541,8 +1546,9 @@ def makesimpars(pars, name=None, keys=None, start=None, end=None, dt=None, tvec=
         return default_rng(frombuffer(thishash.digest(), dtype='uint32'))
 
     # Loop over requested keys
+    directionalacts = compareversions(projectversion, "2.12.0") >= 0
     for key in keys: # Loop over all keys
-        if compareversions(projectversion, "2.12.0") >= 0 and key in ['actsreg', 'actscas', 'actscom', 'actsreginsertive', 'actscasinsertive', 'actscominsertive', 'actsregreceptive', 'actscasreceptive', 'actscomreceptive']:
+        if directionalacts and key in ['actsreg', 'actscas', 'actscom', 'actsreginsertive', 'actscasinsertive', 'actscominsertive', 'actsregreceptive', 'actscasreceptive', 'actscomreceptive']:
             par = pars[key[0:7]]
             if hasattr(par, 'insertiveonly') and par.insertiveonly:
                 continue  # New behaviour, the insertiveonly pars are handled in the next loop
@@ -1550,7 +1556,8 @@ def makesimpars(pars, name=None, keys=None, start=None, end=None, dt=None, tvec=
             thissample = sample # Make a copy of it to check it against the list of things we are sampling
             if tosample and tosample[0] is not None and key not in tosample: thissample = False # Don't sample from unselected parameters -- tosample[0] since it's been promoted to a list
             try:
-                simpars[key] = pars[key].interp(tvec=simpars['tvec'], dt=dt, popkeys=popkeys, smoothness=smoothness, asarray=asarray, sample=thissample, rng_sampler=rng(randseed, key), projectversion=projectversion)
+                rng_sampler = rng(randseed, key) if thissample else None # Only used for sampling
+                simpars[key] = pars[key].interp(tvec=simpars['tvec'], dt=dt, popkeys=popkeys, smoothness=smoothness, asarray=asarray, sample=thissample, rng_sampler=rng_sampler, projectversion=projectversion)
             except OptimaException as E:
                 errormsg = 'Could not figure out how to interpolate parameter "%s"' % key
                 errormsg += 'Error: "%s"' % repr(E)
@@ -1605,6 +1612,56 @@ def makesimpars(pars, name=None, keys=None, start=None, end=None, dt=None, tvec=
 
 
 
+def overlaysimpars(pars=None, deltapars=None, parsetuid=None, name=None, start=None, end=None, dt=None, tvec=None, settings=None,
+                   smoothness=None, asarray=True, verbose=2, projectversion=None):
+    '''
+    Make simpars for a set of parameters in which only a few parameters have changed, e.g. the parameters targeted
+    by programs during an optimization. The unchanged parameters are interpolated once and stored in a cache keyed
+    on the parset uid, the contents of pars, the time vector and the smoothness; the parameters in deltapars (an
+    odict of Par objects, as returned by Programset.getpars(delta=True)) are then interpolated and overlaid onto
+    a copy of the cached simpars. The result is the same as makesimpars() on the full set of parameters, without
+    sampling.
+    '''
+    
+    # Work out the time vector and the cache key
+    if tvec is None:
+        if settings is not None: tvec = settings.maketvec(start=start, end=end, dt=dt)
+        else:                    tvec = inclusiverange(start=start, stop=end, step=dt)
+    if deltapars is None: deltapars = odict()
+    fingerprint = hashlib.md5(pickle.dumps(pars, protocol=-1)).hexdigest() # Catches parameters that have been changed in place
+    cachekey = (parsetuid, fingerprint, array(tvec).tobytes(), smoothness, projectversion, asarray)
+    
+    # Make the baseline simpars if required
+    if cachekey in simparscache:
+        printv('Using cached simpars for parset "%s"' % name, 4, verbose)
+        basesimpars = simparscache[cachekey]
+    else:
+        printv('Making baseline simpars for parset "%s"' % name, 4, verbose)
+        basesimpars = makesimpars(pars, name=name, tvec=tvec, settings=settings, smoothness=smoothness, asarray=asarray, verbose=verbose, projectversion=projectversion)
+        simparscache[cachekey] = basesimpars
+        while len(simparscache)>simparscachesize: simparscache.pop(simparscache.keys()[0]) # Remove the oldest entries
+    
+    # Interpolate the changed parameters and overlay them -- the receptive acts depend on the population size as well as on the acts
+    simpars = odict(basesimpars) # Shallow copy: the model does not modify simpars in place
+    if len(deltapars):
+        fullpars = odict(pars)
+        fullpars.update(deltapars)
+        keys = list(deltapars.keys())
+        if 'popsize' in keys: keys += [key for key in actskeys if key not in keys]
+        deltasimpars = makesimpars(fullpars, name=name, keys=keys, tvec=tvec, settings=settings, smoothness=smoothness, asarray=asarray, verbose=verbose, projectversion=projectversion)
+        for key in deltasimpars.keys():
+            if key not in generalkeys+staticmatrixkeys+['parsetname','tvec','dt']: simpars[key] = deltasimpars[key]
+    
+    return simpars
+
+
+def clearsimparscache():
+    ''' Empty the cache of baseline simpars used by overlaysimpars() '''
+    simparscache.clear()
+    return None
+
+
+
 def applylimits(y, par=None, limits=None, dt=None, warn=True, verbose=2):
     ''' 
     A function to intelligently apply limits (supplied as [low, high] list or tuple) to an output.
@@ -1645,7 +1702,7 @@ def applylimits(y, par=None, limits=None, dt=None, warn=True, verbose=2):
         newy[newy<limits[0]] = limits[0]
         newy[newy>limits[1]] = limits[1]
         newy[infiniteinds] = infinitevals # And stick them back in
-        if warn and any(newy!=array(y)) and verbose >= 3:
+        if warn and verbose >= 3 and (newy!=array(y)).any():
             printv('Note, parameter "%s" value reset from:\n%s\nto:\n%s' % (parname, y, newy), 3, verbose)
     else:
         if warn: raise OptimaException('Data type "%s" not understood for applying limits for parameter "%s"' % (type(y), parname))
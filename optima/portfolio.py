@@ -1,6 +1,7 @@
 from optima import OptimaException, Link, gitinfo, tic, toc, odict, getdate, today, uuid, dcp, objrepr, makefilepath, printv, findnearest, saveobj, loadproj, promotetolist # Import utilities
 from optima import version, defaultobjectives, Project, pchip, getfilelist, batchBOC, reoptimizeprojects
 from numpy import arange, argsort, zeros, nonzero, linspace, log, exp, inf, argmax, array
+from heapq import heappush, heappop
 from xlsxwriter import Workbook
 from xlsxwriter.utility import xl_rowcol_to_cell as rc
 from xlrd import open_workbook
@@ -236,43 +237,8 @@ class Portfolio(object):
             relimprovevecs.append(bocyvecs[b][withinbudget[1:]])
             costeffvecs.append(relimprovevecs[b]/relspendvecs[b])
         
-        # Iterate over vectors, finding best option
-        maxgaiters = int(1e6) # This should be a lot -- just not infinite, but should break first
-        spendperproject = zeros(nbocs)
-        runningtotal = grandtotal
-        oldpercentcomplete = 0.0 # Keep track of progress
-        for i in range(maxgaiters):
-            bestval = -inf
-            bestboc = None
-            for b in range(nbocs):
-                if len(costeffvecs[b]):
-                    tmpbestind = argmax(costeffvecs[b])
-                    tmpbestval = costeffvecs[b][tmpbestind]
-                    if tmpbestval>bestval:
-                        bestval = tmpbestval
-                        bestind = tmpbestind
-                        bestboc = b
-            
-            # Update everything
-            if bestboc is not None:
-                money = relspendvecs[bestboc][bestind]
-                runningtotal -= money
-                relspendvecs[bestboc] -= money
-                spendperproject[bestboc] += money
-                relimprovevecs[bestboc] -= relimprovevecs[bestboc][bestind]
-                relspendvecs[bestboc]   = relspendvecs[bestboc][bestind+1:]
-                relimprovevecs[bestboc] = relimprovevecs[bestboc][bestind+1:]
-                for b in range(nbocs):
-                    withinbudget = nonzero(relspendvecs[b]<=runningtotal)[0]
-                    relspendvecs[b] = relspendvecs[b][withinbudget]
-                    relimprovevecs[b] = relimprovevecs[b][withinbudget]
-                    costeffvecs[b] = relimprovevecs[b]/relspendvecs[b]
-                newpercentcomplete = (grandtotal-runningtotal)/float(grandtotal)*100
-                if not(i%100) or (newpercentcomplete-oldpercentcomplete)>1.0:
-                    printv('  Allocated %0.1f%% of the portfolio budget...' % newpercentcomplete, 2, verbose)
-                    oldpercentcomplete = newpercentcomplete
-            else:
-                break # We're done, there's nothing more to allocate
+        # Allocate the money, a step at a time, to whichever region gives the best improvement per dollar
+        spendperproject = gaallocate(relspendvecs=relspendvecs, relimprovevecs=relimprovevecs, grandtotal=grandtotal, verbose=verbose)
         
         # Scale to make sure budget is correct
         spendperproject = (array(spendperproject)/array(spendperproject.sum())*grandtotal).tolist()
@@ -534,7 +500,73 @@ class Portfolio(object):
 
 
 
-   
+#######################################################################################################
+## Geospatial allocation
+#######################################################################################################
+
+def gaallocate(relspendvecs=None, relimprovevecs=None, grandtotal=None, verbose=2):
+    '''
+    Greedily allocate the grand total between regions. On each step, the region and amount with the best improvement per
+    dollar get the money, and that region's BOC is shifted to start from the new spend. The best option for each region is
+    kept in a priority queue, so only the region that received the money (or one whose best option is no longer affordable)
+    is recalculated. Gives the same allocation as comparing every point of every BOC on every step.
+    
+    Arguments:
+        relspendvecs   -- list of arrays of spending for each region's BOC (increasing, within the grand total, excluding 0)
+        relimprovevecs -- list of arrays of the corresponding improvement in outcome
+    
+    Returns an array of the spending for each region.
+    '''
+    nbocs = len(relspendvecs)
+    relspendvecs = [dcp(vec) for vec in relspendvecs]
+    relimprovevecs = [dcp(vec) for vec in relimprovevecs]
+    spendperproject = zeros(nbocs)
+    runningtotal = grandtotal
+    oldpercentcomplete = 0.0 # Keep track of progress
+    
+    # Each entry is (-cost-effectiveness, region, version, index), so the best option (the first region, for ties) is first
+    queue = []
+    versions = zeros(nbocs, dtype=int) # Entries with an old version are out of date
+    def addbest(b):
+        ''' Remove points that are no longer affordable from this region's BOC, and queue its best option '''
+        withinbudget = nonzero(relspendvecs[b]<=runningtotal)[0]
+        relspendvecs[b] = relspendvecs[b][withinbudget]
+        relimprovevecs[b] = relimprovevecs[b][withinbudget]
+        versions[b] += 1
+        if len(relspendvecs[b]):
+            costeffvec = relimprovevecs[b]/relspendvecs[b]
+            bestind = argmax(costeffvec)
+            if costeffvec[bestind]>-inf: heappush(queue, (-costeffvec[bestind], b, versions[b], bestind))
+        return None
+    
+    for b in range(nbocs): addbest(b)
+    i = 0
+    while queue:
+        negbestval, bestboc, version, bestind = heappop(queue)
+        if version!=versions[bestboc]: continue # Out of date
+        if relspendvecs[bestboc][bestind]>runningtotal: # No longer affordable, so find this region's next best option
+            addbest(bestboc)
+            continue
+        
+        # Update everything -- other regions' points are only removed as they become the best option
+        withinbudget = nonzero(relspendvecs[bestboc]<=runningtotal)[0]
+        bestind = withinbudget.tolist().index(bestind)
+        money = relspendvecs[bestboc][withinbudget][bestind]
+        runningtotal -= money
+        spendperproject[bestboc] += money
+        relspendvecs[bestboc]   = relspendvecs[bestboc][withinbudget][bestind+1:] - money
+        relimprovevecs[bestboc] = relimprovevecs[bestboc][withinbudget]
+        relimprovevecs[bestboc] = relimprovevecs[bestboc][bestind+1:] - relimprovevecs[bestboc][bestind]
+        addbest(bestboc)
+        newpercentcomplete = (grandtotal-runningtotal)/float(grandtotal)*100
+        if not(i%100) or (newpercentcomplete-oldpercentcomplete)>1.0:
+            printv('  Allocated %0.1f%% of the portfolio budget...' % newpercentcomplete, 2, verbose)
+            oldpercentcomplete = newpercentcomplete
+        i += 1
+    
+    return spendperproject
+
+
 
 
 def makegeospreadsheet(project=None, filename=None, folder=None, parsetname=None, copies=None, refyear=None, verbose=2, names=None):
@@ -7,8 +7,10 @@ Version: 2019jan09
 """
 
 from optima import OptimaException, Link, printv, uuid, today, sigfig, getdate, dcp, promotetolist, smoothinterp, findinds, odict, Settings, sanitize, defaultrepr, isnumber, promotetoarray, vec2obj, asd, convertlimits, Timepar, Yearpar, checkifparsoverridepars, createwarningforoverride, standard_dcp, standard_cp, odict_custom
-from numpy import ones, prod, array, zeros, exp, log, append, nan, isnan, maximum, minimum, sort, concatenate as cat, transpose, mean, argsort
+from numpy import ones, prod, array, zeros, exp, log, append, nan, isnan, maximum, minimum, sort, concatenate as cat, transpose, mean, argsort, absolute, where, take_along_axis, errstate
 from random import uniform
+import hashlib
+import pickle
 import six
 if six.PY3:
 	basestring = str
@@ -20,6 +22,9 @@ __all__ = [
     'checkifparsetoverridesprogset'
 ]
 
+compiledprogsets = odict() # Compiled cost-coverage curves and program effects, keyed by a fingerprint of everything they depend on -- see Programset.compilekey()
+maxcompiledprogsets = 20 # Maximum number of compiled programs to keep
+
 class Programset(object):
 
     def __init__(self, name='default', programs=None, default_interaction='additive', project=None):
@@ -538,7 +543,26 @@ class Programset(object):
         if parset is None:
             if results and results.parset: parset = results.parset
             else: raise OptimaException('Please provide either a parset or a resultset that contains a parset')
-        defaultinitpopsizes = parset.pars['popsize'].interp(tvec=t)
+        
+        # If there is one spending amount per year for each program, evaluate all the cost-coverage curves at once
+        nyrs = len(t)
+        progkeys = [key for key,prog in self.programs.items() if prog.optimizable() and prog.costcovfn.ccopars]
+        reached = odict()
+        if progkeys and all([budget[key] is not None and len(promotetoarray(budget[key]))==nyrs for key in progkeys]):
+            engine = self.compilecoverage(t=t, parset=parset, sample=sample)
+            ccopar = odict([('unitcost', engine['unitcost'].flatten()), ('saturation', engine['saturation'].flatten()), ('popfactor', ones(len(progkeys)*nyrs))]) # Population factors are already in the population sizes
+            spending = array([promotetoarray(budget[key]) for key in progkeys], dtype=float).flatten()
+            costcovfn = self.programs[progkeys[0]].costcovfn
+            allreached = costcovfn.function(x=spending, ccopar=ccopar, popsize=engine['popsize'].flatten(), eps=engine['eps'], saturationlower=engine['saturationlower'].flatten(), saturationupper=engine['saturationupper'].flatten()).reshape(len(progkeys), nyrs)
+            if proportion: allreached = allreached/engine['popsize']
+            for i,key in enumerate(progkeys): reached[key] = allreached[i]
+        
+        # Otherwise, evaluate them one by one
+        else:
+            defaultinitpopsizes = parset.pars['popsize'].interp(tvec=t)
+            for key in progkeys:
+                spending = budget[key] # Get the amount of money spent on this program
+                reached[key] = self.programs[key].getcoverage(x=spending, t=t, parset=parset, results=results, proportion=proportion, sample=sample, defaultinitpopsizes=defaultinitpopsizes)
 
         # Get program-level coverage for each program
         for thisprog in self.programs.keys():
@@ -547,8 +571,7 @@ class Programset(object):
                     printv('WARNING: no cost-coverage function defined for optimizable program, setting coverage to None...', 1, verbose)
                     coverage[thisprog] = None
                 else:
-                    spending = budget[thisprog] # Get the amount of money spent on this program
-                    coverage[thisprog] = self.programs[thisprog].getcoverage(x=spending, t=t, parset=parset, results=results, proportion=proportion, sample=sample, defaultinitpopsizes=defaultinitpopsizes)
+                    coverage[thisprog] = reached[thisprog]
             else: coverage[thisprog] = None
 
         return coverage
@@ -605,6 +628,135 @@ class Programset(object):
         return popcoverage
 
 
+    def compilekey(self, kind, t, parset, sample='best'):
+        '''
+        Key for the compiled cost-coverage curves and program effects used by getprogcoverage() and getoutcomes(): a
+        hash of everything they depend on -- the programs, the cost-coverage and coverage-outcome functions and the
+        parset's population sizes -- so they are rebuilt whenever any of these change, even in place. Random samples
+        are never cached, so this returns None for them.
+        '''
+        if sample in ['random','rand','r']: return None
+        progdefs = [(prog.short, prog.targetpars, prog.targetpops, prog.costcovfn.ccopars) for prog in self.programs.values()]
+        contents = [promotetoarray(t), sample, parset.getcovpars(), self.targetpartypes, self.covout, progdefs, parset.pars['popkeys'], parset.pars['popsize']]
+        return (kind, hashlib.md5(pickle.dumps(contents, protocol=-1)).hexdigest())
+
+
+    def compilecoverage(self, t, parset, sample='best'):
+        '''
+        Precompute the cost-coverage curve in each year of each optimizable program with a cost-coverage function: its
+        unit cost, saturation limits and target population size, as arrays with one row per program. Cached by
+        compilekey().
+        '''
+        t = promotetoarray(t)
+        cachekey = self.compilekey(kind='coverage', t=t, parset=parset, sample=sample)
+        if cachekey in compiledprogsets: return compiledprogsets[cachekey]
+
+        progkeys = [key for key,prog in self.programs.items() if prog.optimizable() and prog.costcovfn.ccopars]
+        defaultinitpopsizes = parset.pars['popsize'].interp(tvec=t)
+        engine = odict()
+        engine['progkeys'] = progkeys
+        for key in ['unitcost', 'saturation', 'saturationlower', 'saturationupper', 'popsize']:
+            engine[key] = zeros((len(progkeys), len(t)))
+        for i,key in enumerate(progkeys):
+            thisprog = self.programs[key]
+            engine['popsize'][i] = sum(list(thisprog.gettargetpopsize(t=t, parset=parset, total=False, defaultinitpopsizes=defaultinitpopsizes).values()))
+            ccopar = thisprog.costcovfn.getccopar(t=t, sample=sample)
+            engine['unitcost'][i] = ccopar['unitcost']
+            engine['saturation'][i] = ccopar['saturation']
+            engine['saturationlower'][i] = thisprog.costcovfn.getccopar(t=t, sample='lower')['saturation']
+            engine['saturationupper'][i] = thisprog.costcovfn.getccopar(t=t, sample='upper')['saturation']
+        engine['eps'] = Settings().eps
+        
+        if cachekey is not None:
+            compiledprogsets[cachekey] = engine
+            while len(compiledprogsets)>maxcompiledprogsets: compiledprogsets.pop(compiledprogsets.keys()[0]) # Remove the oldest entries
+        return engine
+
+
+    def compileoutcomes(self, t, parset, results=None, sample='best'):
+        '''
+        Precompute everything getoutcomes() needs apart from the coverage, with one row per targeted parameter type and
+        population: the coverage-outcome intercepts, the programs targeting each row (as indices into the programs, padded
+        with a dummy program with no coverage or effect), their effects in each year -- the change from the intercept, or
+        for coverage parameters the target composition -- and the interaction type. Cached by compilekey().
+        '''
+        t = promotetoarray(t)
+        nyrs = len(t)
+        coveragepars = parset.getcovpars() # Get list of coverage-only parameters
+        cachekey = self.compilekey(kind='outcomes', t=t, parset=parset, sample=sample)
+        if cachekey in compiledprogsets: return compiledprogsets[cachekey]
+
+        # Set up internal variables
+        progkeys = [prog.short for prog in self.programs.values()]
+        nprogs = len(progkeys) # Also the index of the dummy program
+        progind = odict([(key,i) for i,key in enumerate(progkeys)])
+        targetpopsizes = ones((nprogs+1, nyrs))
+        for i,popsize in enumerate(self.gettargetpopsizes(t=t, parset=parset).values()): targetpopsizes[i] = popsize
+        progs_by_targetpar = self.progs_by_targetpar()
+
+        # Gather the rows: partype, pop, intercept, program indices, and effects
+        rows, covrows, outrows, codes = [], [], [], []
+        for thispartype in self.targetpartypes:
+            for thispop,progs in progs_by_targetpar[thispartype].items():
+                thiscovout = self.covout[thispartype][thispop]
+                ccopar = thiscovout.getccopar(t=t, sample=sample)
+                
+                # Coverage parameters: the outcome is the intercept plus the number covered in this population
+                if thispartype in coveragepars:
+                    effects = odict()
+                    for thisprog in progs:
+                        effects[thisprog.short] = ones(nyrs) if thispop == 'tot' else thisprog.gettargetcomposition(t=t, parset=parset, results=results)[thispop]
+                    rows.append((thispartype, thispop, 'coverage', len(covrows)))
+                    covrows.append((ccopar['intercept'], effects))
+                
+                # Outcome parameters: the outcome is the intercept plus the change from each program, weighted by the proportion covered
+                else:
+                    effects = odict()
+                    isnone = False
+                    for thisprog in progs:
+                        if not thiscovout.ccopars[thisprog.short]:
+                            print('WARNING: no coverage-outcome function defined for optimizable program  "%s", skipping over... ' % (thisprog.short))
+                            isnone = True
+                        else:
+                            isnone = False
+                            effects[thisprog.short] = ccopar[thisprog.short] - ccopar['intercept']
+                    if isnone:
+                        rows.append((thispartype, thispop, None, None))
+                        continue
+                    if   thiscovout.interaction == 'additive' or len(progs)==1: codes.append(0)
+                    elif thiscovout.interaction == 'nested':                     codes.append(1)
+                    elif thiscovout.interaction == 'random':                     codes.append(2)
+                    else: raise OptimaException('Unknown reachability type "%s"' % thiscovout.interaction)
+                    rows.append((thispartype, thispop, 'outcome', len(outrows)))
+                    outrows.append((ccopar['intercept'], effects))
+        
+        # Convert to arrays
+        engine = odict()
+        engine['nyrs'] = nyrs
+        engine['progkeys'] = progkeys
+        engine['targetpopsizes'] = targetpopsizes
+        engine['rows'] = rows
+        engine['outcodes'] = array(codes, dtype=int)
+        for kind,kindrows in [('cov',covrows), ('out',outrows)]:
+            maxprogs = max([len(effects) for intercept,effects in kindrows]+[0])
+            intercepts = zeros((len(kindrows), nyrs))
+            inds = nprogs*ones((len(kindrows), maxprogs), dtype=int)
+            effectarray = zeros((len(kindrows), maxprogs, nyrs))
+            for r,(intercept,effects) in enumerate(kindrows):
+                intercepts[r] = intercept
+                for k,(key,effect) in enumerate(effects.items()):
+                    inds[r,k] = progind[key]
+                    effectarray[r,k] = effect
+            engine[kind+'intercepts'] = intercepts
+            engine[kind+'inds'] = inds
+            engine[kind+'effects'] = effectarray
+        
+        if cachekey is not None:
+            compiledprogsets[cachekey] = engine
+            while len(compiledprogsets)>maxcompiledprogsets: compiledprogsets.pop(compiledprogsets.keys()[0]) # Remove the oldest entries
+        return engine
+
+
     def getoutcomes(self, coverage=None, t=None, parset=None, results=None, sample='best'):
         ''' Get the model parameters corresponding to dictionary of coverage values (number covered)'''
 
@@ -625,81 +777,56 @@ class Programset(object):
             if isnumber(coventry): coverage[covkey] = [coventry]
 
         # Set up internal variables
-        nyrs = len(t)
-        coveragepars = parset.getcovpars() # Get list of coverage-only parameters
-        targetpopsizes = self.gettargetpopsizes(t=t, parset=parset)
-        progs_by_targetpar = self.progs_by_targetpar()
-        propcovered = odict()
-        for pn in coverage.keys():
-            if coverage[pn] is not None: propcovered[pn] = coverage[pn]/targetpopsizes[pn]
-
-        # Loop over parameter types
+        engine = self.compileoutcomes(t=t, parset=parset, results=results, sample=sample)
+        nyrs = engine['nyrs']
+        numcovered = zeros((len(engine['progkeys'])+1, nyrs)) # The last row is the dummy program
+        missing = []
+        for i,key in enumerate(engine['progkeys']):
+            if coverage.get(key) is not None: numcovered[i] = coverage[key]
+            else:
+                numcovered[i] = nan
+                missing.append(i)
+        with errstate(divide='ignore', invalid='ignore'): # Programs with no target population, e.g. no popsize yet
+            propcovered = numcovered/engine['targetpopsizes']
+        used = set(engine['covinds'].flatten()) | set(engine['outinds'].flatten())
+        if used.intersection(missing):
+            raise OptimaException('No coverage given for program(s) %s' % [engine['progkeys'][i] for i in missing if i in used])
+
+        # Coverage parameters: add the number covered in each population
+        covoutcomes = array(engine['covintercepts'])
+        for k in range(engine['covinds'].shape[1]):
+            covoutcomes += numcovered[engine['covinds'][:,k]]*engine['coveffects'][:,k]
+        
+        # Outcome parameters: add the effect of each program, ordered descending by absolute value of delta change, e.g. most impactful program first
+        # By sorting in descending order of program impact, and assuming that each person is only reached by the one most impactful program that they are reached by, we simplify the results.
+        # WARNING: a parameter with 'nested' or 'random' coverage and strong negative and strong positive deltas could get strange flipping results, but that's probably a problem with program definitions
+        outoutcomes = array(engine['outintercepts'])
+        order = argsort(-absolute(engine['outeffects']), axis=1, kind='stable')
+        delta = take_along_axis(engine['outeffects'], order, axis=1)
+        cov = take_along_axis(propcovered[engine['outinds']], order, axis=1)
+        additive = (engine['outcodes']==0)[:,None]
+        nested = (engine['outcodes']==1)[:,None]
+        cumulative_covered = zeros(outoutcomes.shape) # Make sure we can't have more than 100% coverage
+        for k in range(delta.shape[1]):
+            this_cov = where(additive, minimum(1-cumulative_covered, cov[:,k]), # e.g. full coverage unless exceeding 100%
+                       where(nested,   maximum(cov[:,k]-cumulative_covered, 0), # e.g. only anything overlapping outside the circle of coverage from more impactful programs
+                                       (1-cumulative_covered)*cov[:,k]))        # e.g. a proportional random amount of coverage outside of what has been covered by more impactful programs
+            outoutcomes += this_cov*delta[:,k]
+            cumulative_covered += this_cov
+        
+        # Collect the outcomes
         for thispartype in self.targetpartypes:
             outcomes[thispartype] = odict()
-            
-            # Loop over populations relevant for this parameter type
-            for popno, thispop in enumerate(progs_by_targetpar[thispartype].keys()):
-
-                # If it's a coverage parameter, you are done
-                if thispartype in coveragepars:
-                    outcomes[thispartype][thispop] = array(self.covout[thispartype][thispop].getccopar(t=t, sample=sample)['intercept'])
-                    for thisprog in progs_by_targetpar[thispartype][thispop]: # Loop over the programs that target this parameter/population combo
-                        if thispop == 'tot':
-                            popcoverage = coverage[thisprog.short]
-                        else: popcoverage = coverage[thisprog.short]*thisprog.gettargetcomposition(t=t, parset=parset, results=results)[thispop]
-                        outcomes[thispartype][thispop] += popcoverage
-
-                # If it's an outcome parameter, need to get outcomes
-                else:
-                    delta, thiscov = odict(), odict()
-                    ccopar = self.covout[thispartype][thispop].getccopar(t=t, sample=sample)
-
-                    # Loop over the programs that target this parameter/population combo
-                    for thisprog in progs_by_targetpar[thispartype][thispop]:
-                        if not self.covout[thispartype][thispop].ccopars[thisprog.short]:
-                            print('WARNING: no coverage-outcome function defined for optimizable program  "%s", skipping over... ' % (thisprog.short))
-                            outcomes[thispartype][thispop] = None
-                        else:
-                            outcomes[thispartype][thispop] = ccopar['intercept']
-                            thiscov[thisprog.short] = propcovered[thisprog.short]
-                            delta[thisprog.short] = [ccopar[thisprog.short][j] - outcomes[thispartype][thispop][j] for j in range(nyrs)]
-                    
-                    if outcomes[thispartype][thispop] is not None:
-                        for yr in range(nyrs):
-                            delt, cov = [],[]
-                            for thisprog in thiscov.keys():
-                                delt.append(delta[thisprog][yr])
-                                cov.append(thiscov[thisprog][yr])
-                            # A tuple storing the coverage and delta out, ordered descending by absolute value of delta change, e.g. most impactful program first
-                            cov_tuple = sorted(zip(delt,cov), key= lambda x: abs(x[0]), reverse=True)  
-                            
-                            cumulative_covered = 0. #make sure we can't have more than 100% coverage
-                            #By sorting in descending order of program impact, and assuming that each person is only reached by the one most impactful program that they are reached by, we simplify the results.
-                            for delt, cov in cov_tuple:
-                                #Coverage determined by interaction type
-                                #WARNING: a parameter with 'nested' or 'random' coverage and strong negative and strong positive deltas could get strange flipping results, but that's probably a problem with program definitions
-                                if self.covout[thispartype][thispop].interaction == 'additive' or len(progs_by_targetpar[thispartype][thispop])==1:
-                                    this_cov = min(1-cumulative_covered, cov) #e.g. full coverage unless exceeding 100%
-                                elif self.covout[thispartype][thispop].interaction == 'nested':
-                                    this_cov = max(cov - cumulative_covered, 0) #e.g. only anything overlapping outside the circle of coverage from more impactful programs
-                                elif self.covout[thispartype][thispop].interaction == 'random':
-                                    this_cov = (1 - cumulative_covered) * cov  #e.g. a proportional random amount of coverage outside of what has been covered by more impactful programs 
-                                else:
-                                    raise OptimaException('Unknown reachability type "%s"',self.covout[thispartype][thispop].interaction)
-                                outcomes[thispartype][thispop][yr] += this_cov*delt
-                                cumulative_covered += this_cov                      
-        
-        # Validate
-        for outcome in outcomes.keys():
-            for key in outcomes[outcome].keys():
-                if outcomes[outcome][key] is not None and len(outcomes[outcome][key])!=nyrs:
-                    raise OptimaException('Parameter lengths must match (len(outcome)=%i, nyrs=%i)' % (len(outcomes[outcome][key]), nyrs))
+        for thispartype,thispop,kind,r in engine['rows']:
+            if   kind == 'coverage': outcomes[thispartype][thispop] = covoutcomes[r]
+            elif kind == 'outcome':  outcomes[thispartype][thispop] = outoutcomes[r]
+            else:                    outcomes[thispartype][thispop] = None
         return outcomes
         
         
         
-    def getpars(self, coverage, t=None, parset=None, results=None, sample='best', die=False, verbose=2):
-        ''' Make pars'''
+    def getpars(self, coverage, t=None, parset=None, results=None, sample='best', die=False, verbose=2, delta=False):
+        ''' Make pars -- if delta=True, return only the parameters affected by the programs, for use with overlaysimpars() '''
         
         years = t # WARNING, not renaming in the function definition for now so as to not break things
         
@@ -718,9 +845,10 @@ class Programset(object):
         outcomes = self.getoutcomes(coverage=coverage, t=years, parset=parset, results=results, sample=sample)
 
         # Create a parset and copy over parameter changes
-        pars = dcp(parset.pars)
+        if delta: pars = odict() # Only copy the parameters that change
+        else:     pars = dcp(parset.pars)
         for outcome in outcomes.keys():
-            thispar = pars[outcome]
+            thispar = dcp(parset.pars[outcome]) if delta else pars[outcome]
             
             # Find last good value -- WARNING, copied from scenarios.py!!! and shouldn't be in this loop!
             last_t = min(years) - settings.dt # Last timestep before the scenario starts
@@ -1,12 +1,15 @@
 from optima import OptimaException, Settings, Parameterset, Programset, Resultset, BOC, Parscen, Budgetscen, Coveragescen, Progscen, Optim, Link # Import classes
-from optima import odict, odict_custom, standard_dcp, standard_cp, getdate, today, uuid, dcp, makefilepath, objrepr, printv, isnumber, saveobj, promotetolist, promotetoodict, sigfig # Import utilities
-from optima import loadspreadsheet, model, gitinfo, defaultscenarios, makesimpars, makespreadsheet
-from optima import defaultobjectives, autofit, runscenarios, optimize, multioptimize, tvoptimize, outcomecalc, icers # Import functions
+from optima import odict, odict_custom, standard_dcp, standard_cp, getdate, today, uuid, dcp, makefilepath, objrepr, printv, isnumber, saveobj, savebinary, promotetolist, promotetoodict, sigfig # Import utilities
+from optima import loadspreadsheet, model, batchmodel, getobjectiveoutcomes, overlaysimpars, gitinfo, defaultscenarios, makesimpars, makespreadsheet
+from optima import defaultobjectives, autofit, runscenarios, optimize, multioptimize, tvoptimize, outcomecalc, icers, makeoptimpool, Optimcheckpoint, Snapshotcache # Import functions
 from optima import supported_versions, revision, cpu_count # Get current version
 from numpy import argmin, argsort, nan, ceil
 from numpy.random import seed, randint, default_rng
 from time import time
 from sciris import parallelize
+from functools import partial
+from multiprocessing.pool import ThreadPool
+import sciris as sc
 
 import os
 
@@ -78,6 +81,7 @@ class Project(object):
         self.gitbranch, self.gitversion = gitinfo()
         self.filename = None # File path, only present if self.save() is used
         self.warnings = None # Place to store information about warnings (mostly used during migrations)
+        self.snapshotcache = Snapshotcache() # Epidemic states for starting runs part way through -- not saved
 
         ## Load spreadsheet, if available
         if spreadsheet:
@@ -511,21 +515,25 @@ class Project(object):
                 if hasattr(scen,'pars'):   del scen.pars  # pars of a Progscen get re-generated when run, only needed in a Parscen
             if hasattr(scen,'scenparset'): scen.scenparset = None  # scenparset always gets re-generated
     
-    def save(self, filename=None, folder=None, saveresults=False, verbose=2, advancedtracking=False, cleanparsfromscens=None):
-        ''' Save the current project, by default using its name, and without results '''
+    def save(self, filename=None, folder=None, saveresults=False, verbose=2, advancedtracking=False, cleanparsfromscens=None, binary=False, compression=None):
+        '''
+        Save the current project, by default using its name, and without results. With binary=True, save it with
+        savebinary() (q.v.), which is much faster to load with results, but can't be opened by older versions of Optima.
+        '''
+        savefunc = partial(savebinary, compression=compression) if binary else saveobj
         if cleanparsfromscens is None: cleanparsfromscens = not saveresults  # Default to cleaning if we are not saving results
         origadvancedtracking = self.settings.advancedtracking
         self.settings.advancedtracking = advancedtracking # Default to turning advancedtracking off
         fullpath = makefilepath(filename=filename, folder=folder, default=[self.filename, self.name], ext='prj', sanitize=True)
         self.filename = fullpath # Store file path
         if saveresults and not cleanparsfromscens:
-            fullpath = saveobj(fullpath, self, verbose=verbose)
+            fullpath = savefunc(fullpath, self, verbose=verbose)
         else:
             tmpproject = dcp(self) # Need to do this so we don't clobber the existing results
             tmpproject.restorelinks() # Make sure links are restored
             if not saveresults:    tmpproject.cleanresults()       # Get rid of all results
             if cleanparsfromscens: tmpproject.cleanparsfromscens() # Get rid of (unnecessary) parameters from scenarios
-            fullpath = saveobj(fullpath, tmpproject, verbose=verbose) # Save it to file
+            fullpath = savefunc(fullpath, tmpproject, verbose=verbose) # Save it to file
             del tmpproject # Don't need it hanging around any more
         self.settings.advancedtracking = origadvancedtracking
         return fullpath
@@ -653,11 +661,24 @@ class Project(object):
                budget=None, coverage=None, budgetyears=None, data=None, n=1, sample=None, tosample=None, randseed=None,
                addresult=True, overwrite=True, keepraw=False, doround=False, die=True, debug=False, verbose=None,
                parsetname=None, progsetname=None, resultname=None, label=None, smoothness=None, flattenraw=None,
-               advancedtracking=None, parallel=False, parallelizer=None, ncpus=None, quantiles=None, **kwargs):
+               advancedtracking=None, parallel=False, parallelizer=None, ncpus=None, quantiles=None, outcomekeys=None, deltapars=None, engine=None, raw=None, **kwargs):
         ''' 
         This function runs a single simulation, or multiple simulations if n>1. This is the
         core function for actually running the model!!!!!!
         
+        If outcomekeys is given (e.g. ['numinci','numdeath']), no Resultset is made: instead, an odict
+        of the annual totals of those outcomes for the first simulation is returned (see getobjectiveoutcomes()).
+        
+        If deltapars is given (e.g. from Programset.getpars(delta=True)), these parameters replace the ones in
+        pars, and for a single unsampled run the simpars for the rest of pars are reused (see overlaysimpars()).
+        deltapars can also be a list, to run the model for each of them together; with outcomekeys, a list of
+        outcomes is then returned.
+        
+        engine is 'numpy' or 'jit' (compiled, if Numba is installed), and defaults to settings.engine.
+        
+        If raw is given (e.g. a run started from a snapshot of another, see runscenarios()), the model isn't run:
+        the results are made from it, with simpars.
+        
         Version: 2018jan13
         '''
         if dt      is None: dt      = self.settings.dt # Specify the timestep
@@ -690,6 +711,11 @@ class Project(object):
         if label is None: # Define the label
             if name is None: label = '%s' % parsetname
             else:            label = name
+        if deltapars is not None: # Overlay the changed parameters
+            deltaparslist = deltapars if isinstance(deltapars, list) else [deltapars]
+            basepars = pars
+            pars = odict(basepars)
+            pars.update(deltaparslist[0])
             
         # Get the parameters sorted
         if simpars is None: # Optionally run with a precreated simpars instead
@@ -704,6 +730,10 @@ class Project(object):
                 except: end   = self.settings.end # Ditto
             maxint = 2**31-1 # See https://en.wikipedia.org/wiki/2147483647_(number)
             sampleseeds = rng_sampler.integers(0, maxint, n)
+            if deltapars is not None and (n==1 or len(deltaparslist)>1) and not sample: # Only the changed parameters need to be interpolated
+                for thisdeltapars in deltaparslist:
+                    simparslist.append(overlaysimpars(pars=basepars, deltapars=thisdeltapars, parsetuid=parsetuid, projectversion=self.version, start=start, end=end, dt=dt, tvec=tvec, settings=self.settings, name=parsetname, smoothness=smoothness, verbose=verbose))
+                sampleseeds = []
             for sampleseed in sampleseeds:
                 simparslist.append(makesimpars(pars, projectversion=self.version, start=start, end=end, dt=dt, tvec=tvec, settings=self.settings, name=parsetname, sample=sample, tosample=tosample, randseed=sampleseed, smoothness=smoothness))
         else:
@@ -711,24 +741,30 @@ class Project(object):
 
         # Run the model!
         rawlist = []
-        if n == 1 or (not parallel): # Run single simulation as quick as possible (or just not in parallel)
-            for ind,simpars in enumerate(simparslist):
-                raw = model(simpars=simpars, settings=self.settings, version=self.version, die=die, debug=debug, verbose=verbose,
-                            label=self.name, advancedtracking=advancedtracking, flattenraw=flattenraw, **kwargs) # ACTUALLY RUN THE MODEL
-                rawlist.append(raw)
+        if raw is not None: # Already run
+            rawlist = promotetolist(raw)
+        elif n == 1 or (not parallel): # Run single simulation as quick as possible (or just not in parallel) -- multiple simulations are run together as a batch
+            rawlist = batchmodel(simparslist=simparslist, settings=self.settings, version=self.version, die=die, debug=debug, verbose=verbose,
+                                 label=self.name, advancedtracking=advancedtracking, flattenraw=flattenraw, engine=engine, **kwargs) # ACTUALLY RUN THE MODEL
 
         else: # Run in parallel
             all_kwargs = {'settings':self.settings, 'version':self.version, 'die':die, 'debug':debug, 'verbose':verbose,
-                          'label':self.name, 'advancedtracking':advancedtracking, 'flattenraw':flattenraw, **kwargs}
+                          'label':self.name, 'advancedtracking':advancedtracking, 'flattenraw':flattenraw, 'engine':engine, **kwargs}
             try: rawlist = parallelize(model, iterarg=simparslist, kwargs=all_kwargs, ncpus=ncpus, parallelizer=parallelizer) # ACTUALLY RUN THE MODEL
             except:
                 printv('\nWARNING: Could not run in parallel probably because this process is already running in parallel. Trying in serial...', 1, verbose)
                 rawlist = []
                 for ind,simpars in enumerate(simparslist):
                     raw = model(simpars=simpars, settings=self.settings, version=self.version, die=die, debug=debug, verbose=verbose,
-                                label=self.name, advancedtracking=advancedtracking, flattenraw=flattenraw, **kwargs) # ACTUALLY RUN THE MODEL
+                                label=self.name, advancedtracking=advancedtracking, flattenraw=flattenraw, engine=engine, **kwargs) # ACTUALLY RUN THE MODEL
                     rawlist.append(raw)
 
+        # Skip making the results if only a few outcomes are needed, e.g. when evaluating an objective function
+        if outcomekeys is not None:
+            outcomeslist = [getobjectiveoutcomes(raw=raw, keys=outcomekeys, pars=pars, settings=self.settings, version=self.version) for raw in rawlist]
+            if isinstance(deltapars, list): return outcomeslist
+            else:                           return outcomeslist[0]
+        
         # Store results if required
         results = Resultset(name=resultname, pars=pars, parsetname=parsetname, parsetuid=parsetuid, progsetname=progsetname, raw=rawlist, simpars=simparslist,
                             budget=budget, coverage=coverage, budgetyears=budgetyears, project=self, keepraw=keepraw, doround=doround, data=data,
@@ -742,6 +778,15 @@ class Project(object):
         return results
 
 
+    def getsnapshot(self, parsetname=-1, year=None, tvec=None, start=None, end=None):
+        '''
+        Get the people and cascade proportions at the timestep nearest to year in a run of a parset, to start other
+        runs from: returns an odict of startind, initpeople and initprops. The run is cached until the parset changes.
+        '''
+        if getattr(self, 'snapshotcache', None) is None: self.snapshotcache = Snapshotcache() # For projects from before this
+        return self.snapshotcache.get(project=self, parsetname=parsetname, year=year, tvec=tvec, start=start, end=end)
+
+
     def sensitivity(self, name='perturb', orig=-1, n=5, tosample=None, randseed=None, **kwargs): # orig=default or orig=0?
         '''
         Function to perform sensitivity analysis over the parameters as a proxy for "uncertainty".
@@ -876,7 +921,7 @@ class Project(object):
     def optimize(self, name=None, parsetname=None, progsetname=None, objectives=None, constraints=None, absconstraints=None, proporigconstraints=None, maxiters=None, maxtime=None,
                  verbose=2, stoppingfunc=None, die=False, origbudget=None, randseed=None, mc=None, optim=None, optimname=None, multi=False, 
                  nchains=None, nblocks=None, blockiters=None, ncpus=None, parallel=None, timevarying=None, tvsettings=None, tvconstrain=None, which=None,
-                 makescenarios=True, **kwargs):
+                 makescenarios=True, checkpoint=None, resume=False, **kwargs):
         '''
         Function to minimize outcomes or money.
         
@@ -904,6 +949,9 @@ class Project(object):
             multi: !! This input gets ignored since this function interprets whether or not multioptimize needs to be used now !!
             blockiters !! This input gets ignored now since it is the same as maxiters !!
             origbudget: if you want to customize the "Optimization baseline", which is the optimization's starting point
+            checkpoint: a folder (or e.g. a Redis connection, or an Optimcheckpoint) to save the state of each optimization run to as it goes
+            resume: if True, continue the optimization saved in checkpoint, e.g. after it was interrupted (or the folder to continue from)
+                (neither is used for money optimizations, which are always run from the start)
         '''
         
         if parsetname  is None or parsetname == -1:  parsetname  = self.parsets.keys()[-1]  #use the real name instead of -1
@@ -939,6 +987,16 @@ class Project(object):
             if settings[key] is None: settings[key] = defaultsettings[key]  # Only overwrite Nones with the default
 
         multi = settings['nchains'] > 1 or settings['nblocks'] > 1    # Need to run with multioptimize if you have nchains or nblocks
+        if (checkpoint is not None or resume) and optim.objectives['which']=='money': # minmoney() has no runs to save or resume
+            printv('WARNING: money optimizations cannot be checkpointed or resumed, so running from the start without a checkpoint', 1, verbose)
+            checkpoint, resume = None, False
+        if resume and resume is not True and checkpoint is None: checkpoint = resume # The folder to resume from was given
+        if resume and checkpoint is None: raise OptimaException('To resume an optimization, please give the checkpoint it was saved to')
+        if checkpoint is not None:
+            if not isinstance(checkpoint, Optimcheckpoint): checkpoint = Optimcheckpoint(checkpoint, prefix=optim.name+'-')
+            checkpoint.resume = bool(resume)
+            randseed = checkpoint.getrandseed(randseed) # The same seed is needed to start from the same budgets
+            kwargs['checkpoint'] = checkpoint
         if settings['maxtime'] is not None: settings['finishtime'] = time() + settings['maxtime'] # START THE TIMER
         # Note we still pass maxtime into the functions, even though it will reach finishtime before maxtime, so that it saves maxtime
 
@@ -1091,8 +1149,14 @@ class Project(object):
     #######################################################################################################
         
     def genBOC(self, budgetratios=None, name=None, parsetname=None, progsetname=None, objectives=None, constraints=None, absconstraints=None, proporigconstraints=None,
-               maxiters=1000, maxtime=None, verbose=2, stoppingfunc=None, mc=None, parallel=True, finishtime=None, ncpus=None, die=False, randseed=None, origbudget=None, **kwargs):
-        ''' Function to generate project-specific budget-outcome curve for geospatial analysis '''
+               maxiters=1000, maxtime=None, verbose=2, stoppingfunc=None, mc=None, parallel=True, finishtime=None, ncpus=None, die=False, randseed=None, origbudget=None, npoints=None, **kwargs):
+        '''
+        Function to generate project-specific budget-outcome curve for geospatial analysis
+        
+        If parallel, up to npoints budgets are optimized at once (by default, enough to keep ncpus busy), with all of their
+        optimizations run in one pool of ncpus worker processes. The first budget is optimized on its own, so that the
+        others can start from its allocation.
+        '''
         if name is None:
             name = 'BOC ' + self.name
         if objectives is None:
@@ -1119,13 +1183,13 @@ class Project(object):
             budgetratios = [1.0, 0.8, 0.5, 0.3, 0.1, 0.01, 1.5, 3.0, 5.0, 10.0, 30.0, 100.0]
         if 1.0 not in budgetratios:
             printv('Warning, current budget not present in budget ratios, adding...', 3, verbose)
-            budgetratios = list(budgetratios).insert(0, 1.0) # Ensure 1.0 is in there
+            budgetratios = [1.0] + list(budgetratios) # Ensure 1.0 is in there
         ybaseline = nan # Prepopulate, assuming it won't be found (which it probably will be)
         yregionoptim = nan # The optimal y value for the within-region optimum
         regionoptimbudget = None # The budget for the within-region optimum
         
         # Calculate the number of iterations
-        noptims = 1 + (mc!=0) + max(abs(mc),0) # Calculate the number of optimizations per BOC point
+        noptims = sum(mc) # Calculate the number of optimizations per BOC point
         nbocpts = len(budgetratios)
         guessmaxiters = maxiters if maxiters is not None else 1000
         guessminiters = min(50, guessmaxiters)  # WARNING, shouldn't hardcode stalliters but doesn't really matter, either
@@ -1142,45 +1206,80 @@ class Project(object):
         tmptotals = odict()
         tmpallocs = odict()
         counts = odict([(key,0) for key in budgetdict.keys()]) # Initialize to zeros -- count how many times each budget is run
-        while len(budgetdict):
-            key, ratio = budgetdict.items()[0] # Use first budget in the stack
-            counts[key] += 1
-            budget = ratio*sum(defaultbudget[:])
-            thiscount = sum(counts[:])
-            totalcount = len(budgetdict)+sum(counts[:])-1
-            printv('Running budget %i/%i ($%0.0f)' % (thiscount, totalcount, budget), 2, verbose)
-            objectives['budget'] = budget
+        if not parallel: npoints = 1
+        elif npoints is None: npoints = max(1, int(ceil(ncpus/noptims)))
+        
+        # Start the worker pool, which gets sent the project once and is shared by all the BOC points
+        progset = self.progsets[progsetname]
+        if absconstraints is not None: progset.reorderprograms(absconstraints['name'].keys()) # Do this before the pool starts
+        pool = None
+        if parallel and npoints>1:
+            try:
+                pool = makeoptimpool(project=self, ncpus=ncpus)
+            except AssertionError: # e.g. in a daemonic Celery worker
+                printv('WARNING: Could not start a pool because this process is already running in parallel, generating BOC in serial...', 1, verbose)
+                npoints = 1
+        
+        def runpoint(point):
+            ''' Run the optimization for one BOC point; the bookkeeping is done afterwards, in order '''
+            key, budget, thisorigbudget, label, thisfinishtime = point
+            thisobjectives = dcp(objectives)
+            thisobjectives['budget'] = budget
             optim = Optim(project=self, name=name, constraints=constraints,absconstraints=absconstraints,proporigconstraints=proporigconstraints,
-                          objectives=objectives, parsetname=parsetname, progsetname=progsetname)
-            
-            # All subsequent genBOC steps use the allocation of the previous step as its initial budget, scaled up internally within optimization.py of course.
-            if len(tmptotals):
-                closest = argmin(abs(tmptotals[:]-budget)) # Find closest budget
-                origbudget = tmpallocs[closest]
-            label = self.name+' $%sm (%i/%i)' % (sigfig(budget/1e6, sigfigs=3), thiscount, totalcount)
-
-            if finishtime is None and maxtime is not None: finishtime = time() + maxtime  # Each optimization gets its own maxtime
-            # Actually run
-            results = optimize(optim=optim, maxiters=maxiters, maxtime=maxtime, verbose=verbose, stoppingfunc=stoppingfunc, origbudget=origbudget, label=label, mc=mc, finishtime=finishtime, parallel=parallel, ncpus=ncpus, die=die, randseed=randseed, **kwargs)
-            tmptotals[key] = budget
-            tmpallocs[key] = dcp(results.budgets.findbykey('Optim'))
-            tmpx[key] = budget # Used to be append, but can't use lists since can iterate multiple times over a single budget
-            tmpy[key] = results.outcome
-            boc.budgets[key] = tmpallocs[-1]
-            if ratio==1.0: # Check if ratio is 1, and if so, store the baseline
-                ybaseline = results.outcomes.findbykey('Base') # Store baseline result, but also not part of the BOC
-                yregionoptim = results.outcome
-                regionoptimbudget = budget
-            
-            # Check that the BOC points are monotonic, and if not, rerun
-            budgetdict.pop(key) # Remove the current key from the list
-            for oldkey in tmpy.keys():
-                if tmpy[oldkey]>tmpy[key] and tmptotals[oldkey]>tmptotals[key]: # Outcome is worse but budget is larger
-                    printv('WARNING, outcome for %s is worse than outcome for %s, rerunning...' % (oldkey, key), 1, verbose)
-                    if counts[oldkey]<5: # Don't get stuck in an infinite loop -- 5 is arbitrary, but jeez, that should take care of it
-                        budgetdict.insert(0, oldkey, float(oldkey)) # e.g. key2='0.8'
-                    else:
-                        printv('WARNING, tried 5 times to reoptimize budget and unable to get lower', 1, verbose) # Give up
+                          objectives=thisobjectives, parsetname=parsetname, progsetname=progsetname)
+            return optimize(optim=optim, maxiters=maxiters, maxtime=maxtime, verbose=verbose, stoppingfunc=stoppingfunc, origbudget=thisorigbudget, label=label, mc=mc, finishtime=thisfinishtime, parallel=parallel, ncpus=ncpus, die=die, randseed=randseed, pool=pool, **kwargs)
+        
+        try:
+            while len(budgetdict):
+                points = []
+                nthispoints = npoints if len(tmptotals) else 1 # Start with the first budget on its own, so the rest can start from its allocation
+                for key, ratio in budgetdict.items()[:nthispoints]: # Use the first budgets in the stack
+                    counts[key] += 1
+                    budget = ratio*sum(defaultbudget[:])
+                    thiscount = sum(counts[:])
+                    totalcount = len(budgetdict)+sum(counts[:])-1
+                    printv('Running budget %i/%i ($%0.0f)' % (thiscount, totalcount, budget), 2, verbose)
+                    
+                    # All subsequent genBOC steps use the allocation of the closest previous step as its initial budget, scaled up internally within optimization.py of course.
+                    if len(tmptotals):
+                        closest = argmin(abs(tmptotals[:]-budget)) # Find closest budget
+                        origbudget = tmpallocs[closest]
+                    label = self.name+' $%sm (%i/%i)' % (sigfig(budget/1e6, sigfigs=3), thiscount, totalcount)
+                    
+                    if finishtime is None and maxtime is not None: finishtime = time() + maxtime  # Each optimization gets its own maxtime
+                    points.append((key, budget, origbudget, label, finishtime))
+                
+                # Actually run
+                if len(points)==1: allresults = [runpoint(points[0])]
+                else:
+                    threadpool = ThreadPool(len(points))
+                    try:     allresults = threadpool.map(runpoint, points)
+                    finally: threadpool.terminate()
+                
+                for (key, budget, thisorigbudget, label, thisfinishtime), results in zip(points, allresults):
+                    ratio = budgetdict[key]
+                    objectives['budget'] = budget
+                    tmptotals[key] = budget
+                    tmpallocs[key] = dcp(results.budgets.findbykey('Optim'))
+                    tmpx[key] = budget # Used to be append, but can't use lists since can iterate multiple times over a single budget
+                    tmpy[key] = results.outcome
+                    boc.budgets[key] = tmpallocs[-1]
+                    if ratio==1.0: # Check if ratio is 1, and if so, store the baseline
+                        ybaseline = results.outcomes.findbykey('Base') # Store baseline result, but also not part of the BOC
+                        yregionoptim = results.outcome
+                        regionoptimbudget = budget
+                    
+                    # Check that the BOC points are monotonic, and if not, rerun
+                    budgetdict.pop(key) # Remove the current key from the list
+                    for oldkey in tmpy.keys():
+                        if tmpy[oldkey]>tmpy[key] and tmptotals[oldkey]>tmptotals[key]: # Outcome is worse but budget is larger
+                            printv('WARNING, outcome for %s is worse than outcome for %s, rerunning...' % (oldkey, key), 1, verbose)
+                            if counts[oldkey]<5: # Don't get stuck in an infinite loop -- 5 is arbitrary, but jeez, that should take care of it
+                                budgetdict.insert(0, oldkey, float(oldkey)) # e.g. key2='0.8'
+                            else:
+                                printv('WARNING, tried 5 times to reoptimize budget and unable to get lower', 1, verbose) # Give up
+        finally:
+            if pool is not None: pool.terminate()
                         
         # Tidy up: insert remaining points
         if sum(counts[:]):
@@ -7,8 +7,12 @@ Version: 2018nov19
 from optima import OptimaException, Link, Settings, odict, pchip, plotpchip, sigfig # Classes/functions
 from optima import revision, compareversions, supported_versions, uuid, today, makefilepath, getdate, printv, dcp, objrepr, defaultrepr, sanitizefilename, sanitize # Printing/file utilities
 from optima import quantile, findinds, findnearest, promotetolist, promotetoarray, checktype # Numeric utilities
-from numpy import array, nan, zeros, arange, shape, maximum, log, swapaxes, array_equal
+from numpy import array, nan, zeros, arange, shape, maximum, log, swapaxes, array_equal, ndarray, save as npsave, load as npload
 from numbers import Number
+from copy import deepcopy
+from shutil import rmtree
+import tempfile
+import os
 from xlsxwriter import Workbook
 
 import six
@@ -20,14 +24,21 @@ if six.PY3:
 prcstr = '!PERC'  # included as string in cells that should be formatted as percent
 condstr = '!COND'  # included as string in cells that should be coloured conditionally
 epsbudcov = 0.1 # The minimum budget or coverage amount to consider to be nonzero -- only used for budget comparisons
+rawcacheminsize = 2**20 # Raw arrays smaller than this many bytes are kept in memory even if the raw results are memory-mapped
 
 __all__ = [
     'Result',
     'Resultset',
     'Multiresultset',
+    'Mappedarray',
+    'Mappedraw',
+    'clearrawcache',
     'BOC',
     'ICER',
-    'getresults'
+    'getresults',
+    'calcdalys',
+    'getobjectiveoutcomes',
+    'objectiveoutcomekeys',
 ]
 
 
@@ -50,9 +61,109 @@ class Result(object):
 
 
 
+class Mappedarray(object):
+    ''' A reference to an array stored in a .npy file -- see Mappedraw '''
+    def __init__(self, filename=None, shape=None, dtype=None):
+        self.filename = filename
+        self.shape = shape
+        self.dtype = dtype
+
+    def __repr__(self):
+        return 'Mappedarray(%s, shape=%s, dtype=%s)' % (self.filename, self.shape, self.dtype)
+
+    def load(self):
+        ''' Map the array from its file: its data are only read as they're used, and changes to it aren't written back '''
+        try:
+            output = npload(self.filename, mmap_mode='c')
+        except (IOError, OSError) as E:
+            errormsg = 'Could not load raw results array from "%s" -- has the raw results cache been cleared? (%s)' % (self.filename, repr(E))
+            raise OptimaException(errormsg)
+        if output.shape != tuple(self.shape):
+            errormsg = 'Raw results array in "%s" has shape %s, expecting %s' % (self.filename, output.shape, self.shape)
+            raise OptimaException(errormsg)
+        return output
+
+
+
+class Mappedraw(dict):
+    '''
+    Raw model output (as returned by model()) with its large arrays stored in memory-mapped files in folder, rather
+    than in memory. Each array is mapped from its file the first time it's used; copying or pickling only copies the
+    filenames, not the arrays. Use unmap() to get an ordinary dict back, e.g. before moving a project to another
+    computer.
+    '''
+    def __init__(self, raw=None, folder=None, prefix='', minsize=None):
+        dict.__init__(self)
+        self._mapped = {} # Arrays mapped so far -- not copied or pickled
+        if raw is None: raw = {}
+        if isinstance(raw, Mappedraw): raw = raw.stored() # Already stored, don't save again
+        if minsize is None: minsize = rawcacheminsize
+        if folder is not None and not os.path.exists(folder): os.makedirs(folder)
+        for key,value in raw.items():
+            if folder is not None and isinstance(value, ndarray) and value.dtype!=object and value.nbytes>=minsize:
+                filename = os.path.join(folder, sanitizefilename('%s%s.npy' % (prefix, key)))
+                npsave(filename, value)
+                value = Mappedarray(filename=filename, shape=value.shape, dtype=str(value.dtype))
+            dict.__setitem__(self, key, value)
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if isinstance(value, Mappedarray):
+            if key not in self._mapped: self._mapped[key] = value.load()
+            value = self._mapped[key]
+        return value
+
+    def __setitem__(self, key, value):
+        self._mapped.pop(key, None)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._mapped.pop(key, None)
+        dict.__delitem__(self, key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key,self[key]) for key in self.keys()]
+
+    def stored(self):
+        ''' The contents without mapping anything, i.e. with a Mappedarray in place of each stored array '''
+        return dict(dict.items(self))
+
+    def unmap(self):
+        ''' Return an ordinary dict, with all of the arrays read into memory '''
+        return dict((key, array(value) if isinstance(dict.__getitem__(self, key), Mappedarray) else value) for key,value in self.items())
+
+    def __reduce__(self):
+        return (Mappedraw, (self.stored(),))
+
+    def __deepcopy__(self, memo):
+        return Mappedraw(deepcopy(self.stored(), memo))
+
+
+
+def clearrawcache(project=None, rawcache=True):
+    ''' Delete the memory-mapped raw results stored for a project (or for all projects if none is given) '''
+    folder = getrawcachefolder(project=project, rawcache=rawcache)
+    if os.path.exists(folder): rmtree(folder)
+    return None
+
+
+def getrawcachefolder(project=None, rawcache=True):
+    ''' The folder memory-mapped raw results are stored in: rawcache is a folder, or True for a temporary folder '''
+    if rawcache is True: rawcache = os.path.join(tempfile.gettempdir(), 'optima-rawcache')
+    if project is None: return rawcache
+    else:               return os.path.join(rawcache, str(project.uid))
+
+
+
 class Resultset(object):
     ''' Structure to hold results '''
-    def __init__(self, raw=None, name=None, pars=None, simpars=None, project=None, settings=None, data=None, parsetname=None, parsetuid=None, progsetname=None, budget=None, coverage=None, budgetyears=None, domake=True, quantiles=None, keepraw=False, verbose=2, doround=False, advancedtracking=False):
+    def __init__(self, raw=None, name=None, pars=None, simpars=None, project=None, settings=None, data=None, parsetname=None, parsetuid=None, progsetname=None, budget=None, coverage=None, budgetyears=None, domake=True, quantiles=None, keepraw=False, verbose=2, doround=False, advancedtracking=False, rawcache=None):
         # Basic info
         self.uid = uuid()
         self.created = today()
@@ -160,6 +271,29 @@ class Resultset(object):
             self.other['only'+healthkey]   = Result(healthname) # Pick out only people in these health states
             
         if domake: self.make(raw, verbose=verbose, doround=doround, advancedtracking=advancedtracking)
+        
+        # Move large raw arrays out of memory, if asked -- done after make() so it uses the in-memory versions
+        if rawcache is None: rawcache = getattr(self.settings, 'rawcache', None) # Settings from older projects may not have it
+        if keepraw and rawcache: self.mapraw(rawcache=rawcache, project=project)
+    
+    
+    def mapraw(self, rawcache=True, project=None, minsize=None):
+        ''' Store large arrays in the raw results in memory-mapped files -- see Mappedraw '''
+        if project is None: project = self.projectref()
+        folder = getrawcachefolder(project=project, rawcache=rawcache)
+        self.raw = [Mappedraw(raw, folder=folder, prefix='%s-%i-' % (self.uid, i), minsize=minsize) for i,raw in enumerate(self.raw)]
+        return None
+    
+    
+    def unmapraw(self):
+        ''' Read memory-mapped raw results back into memory, e.g. before saving the project to move it elsewhere '''
+        def unmap(raw): return raw.unmap() if isinstance(raw, Mappedraw) else raw
+        raws = getattr(self, 'raw', None)
+        if isinstance(raws, dict): # A Multiresultset, with a list of raw results for each resultset
+            for key in raws.keys(): raws[key] = [unmap(raw) for raw in raws[key]]
+        elif raws is not None:
+            self.raw = [unmap(raw) for raw in raws]
+        return None
     
     
     def __repr__(self):
@@ -493,51 +627,8 @@ class Resultset(object):
 
 
         # Calculate DALYs
-        
-        ## Years of life lost
-        yllpops = alldeaths.sum(axis=1) # Total deaths per population, sum over health states
-        for pk,popkey in enumerate(self.popkeys): # Loop over each population
-            meanage = self.pars['age'][pk].mean()
-            potentialyearslost = max(0,lifeexpectancy-meanage) # Don't let this go negative!
-            
-            if yllconstrained:
-                numtimes = len(alldeaths[0][0][0]) #number of timesteps in the raw results
-                raw_dt = 1./int((numtimes-1)/(len(self.tvec)-1)) #TODO replace this
-                potentialyearslost_array = [min(potentialyearslost, (numtimes-timestep)*raw_dt) for timestep in range(0, numtimes)]
-                if discountrate>0 and discountrate<1: # Make sure it has reasonable bounds
-                    discountedyearslost_array = [((1-discountrate)**pyl - 1)/log(1-discountrate) for pyl in potentialyearslost_array]
-                elif discountrate==0: # Nothing to discount
-                    discountedyearslost_array = potentialyearslost_array
-                else:
-                    raise OptimaException('Invalid discount rate (%s)' % discountrate)
-                yllpops[:,pk,:] *= discountedyearslost_array # Multiply by the number of potential years of life lost which can be different in each timestep.
-                
-            else:
-                if discountrate>0 and discountrate<1: # Make sure it has reasonable bounds
-                    denominator = log(1-discountrate) # Start calculating the integral of (1-discountrate)**potentialyearslost
-                    numerator = (1-discountrate)**potentialyearslost - 1 # Minus 1 for t=0
-                    discountedyearslost = numerator/denominator # See https://en.wikipedia.org/wiki/Lists_of_integrals#Exponential_functions
-                elif discountrate==0: # Nothing to discount
-                    discountedyearslost = potentialyearslost
-                else:
-                    raise OptimaException('Invalid discount rate (%s)' % discountrate)
-                yllpops[:,pk,:] *= discountedyearslost # Multiply by the number of potential years of life lost
-            
-        ylltot = yllpops.sum(axis=1) # Sum over populations
-        
-        ## Years lived with disability
-        disutiltx = self.pars['disutiltx'].y
-        disutils = [self.pars['disutil'+key].y for key in self.settings.hivstates]
-        yldpops = allpeople[:,alltx,:,:].sum(axis=1)     * disutiltx
-        yldtot  = allpeople[:,alltx,:,:].sum(axis=(1,2)) * disutiltx
-        notonart = set(self.settings.notonart)
-        for h,key in enumerate(self.settings.hivstates): # Loop over health states
-            hivstateindices = set(getattr(self.settings,key))
-            healthstates = array(list(hivstateindices & notonart)) # Find the intersection of this HIV state and not on ART states
-            yldpops += allpeople[:,healthstates,:,:].sum(axis=1) * disutils[h]
-            yldtot += allpeople[:,healthstates,:,:].sum(axis=(1,2)) * disutils[h]
-        
-        ## Add them up
+        yllpops, ylltot, yldpops, yldtot = calcdalys(allpeople=allpeople, alldeaths=alldeaths, pars=self.pars, settings=self.settings, tvec=self.tvec,
+                                                     lifeexpectancy=lifeexpectancy, discountrate=discountrate, yllconstrained=yllconstrained)
         dalypops = yllpops + yldpops
         dalytot  = ylltot + yldtot
         self.main['numdaly'].pops = process(dalypops[:,:,indices])
@@ -1323,6 +1414,112 @@ def getresults(project=None, pointer=None, die=True):
         else: return None
 
 
+def calcdalys(allpeople=None, alldeaths=None, pars=None, settings=None, tvec=None, lifeexpectancy=80, discountrate=0.03, yllconstrained=False):
+    '''
+    Calculate years of life lost and years lived with disability from assembled model outputs, where the first axis
+    of allpeople and alldeaths is the sample. Returns yllpops, ylltot, yldpops, yldtot.
+    '''
+    
+    ## Years of life lost
+    yllpops = alldeaths.sum(axis=1) # Total deaths per population, sum over health states
+    for pk in range(yllpops.shape[1]): # Loop over each population
+        meanage = pars['age'][pk].mean()
+        potentialyearslost = max(0,lifeexpectancy-meanage) # Don't let this go negative!
+        
+        if yllconstrained:
+            numtimes = len(alldeaths[0][0][0]) #number of timesteps in the raw results
+            raw_dt = 1./int((numtimes-1)/(len(tvec)-1)) #TODO replace this
+            potentialyearslost_array = [min(potentialyearslost, (numtimes-timestep)*raw_dt) for timestep in range(0, numtimes)]
+            if discountrate>0 and discountrate<1: # Make sure it has reasonable bounds
+                discountedyearslost_array = [((1-discountrate)**pyl - 1)/log(1-discountrate) for pyl in potentialyearslost_array]
+            elif discountrate==0: # Nothing to discount
+                discountedyearslost_array = potentialyearslost_array
+            else:
+                raise OptimaException('Invalid discount rate (%s)' % discountrate)
+            yllpops[:,pk,:] *= discountedyearslost_array # Multiply by the number of potential years of life lost which can be different in each timestep.
+            
+        else:
+            if discountrate>0 and discountrate<1: # Make sure it has reasonable bounds
+                denominator = log(1-discountrate) # Start calculating the integral of (1-discountrate)**potentialyearslost
+                numerator = (1-discountrate)**potentialyearslost - 1 # Minus 1 for t=0
+                discountedyearslost = numerator/denominator # See https://en.wikipedia.org/wiki/Lists_of_integrals#Exponential_functions
+            elif discountrate==0: # Nothing to discount
+                discountedyearslost = potentialyearslost
+            else:
+                raise OptimaException('Invalid discount rate (%s)' % discountrate)
+            yllpops[:,pk,:] *= discountedyearslost # Multiply by the number of potential years of life lost
+        
+    ylltot = yllpops.sum(axis=1) # Sum over populations
+    
+    ## Years lived with disability
+    alltx = settings.alltx
+    disutiltx = pars['disutiltx'].y
+    disutils = [pars['disutil'+key].y for key in settings.hivstates]
+    yldpops = allpeople[:,alltx,:,:].sum(axis=1)     * disutiltx
+    yldtot  = allpeople[:,alltx,:,:].sum(axis=(1,2)) * disutiltx
+    notonart = set(settings.notonart)
+    for h,key in enumerate(settings.hivstates): # Loop over health states
+        hivstateindices = set(getattr(settings,key))
+        healthstates = array(list(hivstateindices & notonart)) # Find the intersection of this HIV state and not on ART states
+        yldpops += allpeople[:,healthstates,:,:].sum(axis=1) * disutils[h]
+        yldtot += allpeople[:,healthstates,:,:].sum(axis=(1,2)) * disutils[h]
+    
+    return yllpops, ylltot, yldpops, yldtot
+
+
+objectiveoutcomekeys = ['numinci', 'numdeath', 'numdaly', 'numplhiv', 'numdiag', 'numtreat', 'numnewdiag', 'propdiag', 'proptreat', 'propsuppressed', 'propplhivtreat', 'propplhivsupp']
+
+def getobjectiveoutcomes(raw=None, keys=None, pars=None, settings=None, version=None, lifeexpectancy=80, discountrate=0.03, yllconstrained=False):
+    '''
+    Calculate only the annual totals of the given outcomes (e.g. numinci, numdeath, propdiag) from a single model run,
+    without making a Resultset. This is much quicker when evaluating an objective function thousands of times. The
+    values match results.main[key].tot[0] for the same run. Returns an odict with the time vector and one array per key.
+    
+    Valid keys are listed in objectiveoutcomekeys.
+    '''
+    keys = promotetolist(keys)
+    invalid = [key for key in keys if key not in objectiveoutcomekeys]
+    if invalid:
+        errormsg = 'Cannot calculate outcomes %s without a full Resultset: valid keys are %s' % (invalid, objectiveoutcomekeys)
+        raise OptimaException(errormsg)
+    
+    tvec = raw['tvec']
+    indices = arange(0, len(tvec), int(round(1.0/(tvec[1]-tvec[0])))) # Subsample to annual results, as Resultset.make() does
+    if compareversions(version if version is not None else supported_versions[-1], '2.12.3') >= 0: # Index in the same order as Resultset.make() so the results are identical
+        assembleindices, indices = indices, slice(None)
+    else:
+        assembleindices = slice(None)
+    eps = settings.eps
+    allplhiv = settings.allplhiv
+    alldx    = settings.alldx
+    alltx    = settings.alltx
+    svl      = settings.svl
+    def assemble(key): return array([raw[key][...,assembleindices]]) # Add the sample axis so that every calculation is the same as in Resultset.make()
+    allpeople = assemble('people')
+    def peoplesum(states): return allpeople[:,states,:,:][:,:,:,indices].sum(axis=(1,2))[0]
+    
+    outcomes = odict()
+    outcomes['tvec'] = tvec[assembleindices][indices]
+    for key in keys:
+        if   key=='numinci':        outcomes[key] = assemble('inci')[:,:,indices].sum(axis=1)[0]
+        elif key=='numdeath':       outcomes[key] = assemble('death')[:,:,:,indices].sum(axis=(1,2))[0]
+        elif key=='numnewdiag':     outcomes[key] = assemble('diag')[:,:,indices].sum(axis=1)[0]
+        elif key=='numplhiv':       outcomes[key] = peoplesum(allplhiv)
+        elif key=='numdiag':        outcomes[key] = peoplesum(alldx)
+        elif key=='numtreat':       outcomes[key] = peoplesum(alltx)
+        elif key=='propdiag':       outcomes[key] = peoplesum(alldx)/maximum(peoplesum(allplhiv),eps)
+        elif key=='proptreat':      outcomes[key] = peoplesum(alltx)/maximum(peoplesum(alldx),eps)
+        elif key=='propsuppressed': outcomes[key] = peoplesum(svl)/maximum(peoplesum(alltx),eps)
+        elif key=='propplhivtreat': outcomes[key] = peoplesum(alltx)/maximum(peoplesum(allplhiv),eps)
+        elif key=='propplhivsupp':  outcomes[key] = peoplesum(svl)/maximum(peoplesum(allplhiv),eps)
+        elif key=='numdaly':
+            yllpops, ylltot, yldpops, yldtot = calcdalys(allpeople=allpeople, alldeaths=assemble('death'), pars=pars, settings=settings, tvec=outcomes['tvec'],
+                                                         lifeexpectancy=lifeexpectancy, discountrate=discountrate, yllconstrained=yllconstrained)
+            outcomes[key] = (ylltot + yldtot)[:,indices][0]
+    
+    return outcomes
+
+
 def sanitizeseps(stringlist, sep=',', sub=';'):
     ''' Ensures that the input items do not themselves contain the separator character '''
     if isinstance(stringlist, list):
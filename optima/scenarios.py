@@ -5,10 +5,11 @@ Version: 2017jun03
 '''
 
 ## Imports
-from numpy import append, array, inf
-from optima import OptimaException, Link, Multiresultset, Timepar, Popsizepar # Core classes/functions
+from numpy import append, array, inf, isnan, ndarray
+from optima import OptimaException, Link, Multiresultset, Timepar, Popsizepar, model, makesimpars # Core classes/functions
 from optima import parallelpool, dcp, today, odict, printv, findinds, defaultrepr, getresults, vec2obj, isnumber, uuid, promotetoarray, cpu_count # Utilities
 from optima import checkifparsetoverridesprogset, checkifparsoverridepars, createwarningforoverride # From programs.py and parameters.py for warning
+from optima.model import propkeys, findfixinds, stitchraw
 from sciris import parallelize
 from numpy import ceil
 
@@ -86,9 +87,13 @@ def runsim_wrapper(project, print_label, verbose=2, **kwargs):
     return project.runsim(verbose=0, **kwargs)
 
 def runscenarios(project=None, verbose=2, name=None, defaultparset=-1, debug=False, nruns=None, base=None, ccsample=None,
-                 randseed=None, parallel=False, ncpus=None, keepresultsetlist=False, **kwargs):
+                 randseed=None, parallel=False, ncpus=None, keepresultsetlist=False, branch=True, **kwargs):
     """
     Run all the scenarios.
+    
+    With branch=True, a single run of each scenario is only simulated from where it differs from an earlier one,
+    and gives the same results as running it from the start -- see runbranchedscenarios().
+    
     Version: 2017aug15
     """
     
@@ -109,6 +114,7 @@ def runscenarios(project=None, verbose=2, name=None, defaultparset=-1, debug=Fal
     if ncpus is None:    ncpus = int(ceil( cpu_count()/2 ))
     # We run in a parallel here if the number of scenarios is more than the number of runs per scenario (nruns)
     this_parallel = True if (parallel and nscens > nruns) else False
+    branch = branch and nscens>1 and nruns==1 and not parallel and not debug and not project.settings.advancedtracking and set(kwargs).issubset(branchkwargs)
     parallel = parallel and (not this_parallel)  # Allowed to run in parallel and we are not running here in parallel
     parallelizer = parallelpool(ncpus).map if parallel else None
 
@@ -150,7 +156,8 @@ def runscenarios(project=None, verbose=2, name=None, defaultparset=-1, debug=Fal
                               'parallelizer':parallelizer, **kwargs}
 
     # We need the runsim_wrapper instead of project.runsim because we need different projects in parallel
-    allresults = parallelize(runsim_wrapper, iterkwargs=all_kwargs, serial=(not this_parallel), parallelizer='fast', ncpus=ncpus)
+    if branch: allresults = runbranchedscenarios(project=project, all_kwargs=all_kwargs, verbose=verbose)
+    else:      allresults = parallelize(runsim_wrapper, iterkwargs=all_kwargs, serial=(not this_parallel), parallelizer='fast', ncpus=ncpus)
 
     for scenno, result in enumerate(allresults):
         result.name = scenlist[scenno].name # Give a name to these results so can be accessed for the plot legend
@@ -172,6 +179,101 @@ def runscenarios(project=None, verbose=2, name=None, defaultparset=-1, debug=Fal
 
 
 
+branchkwargs = ['keepraw', 'doround', 'quantiles', 'data', 'die', 'engine'] # Other arguments to runsim() that scenarios can be branched with
+
+
+def firstdifference(val1, val2, npts):
+    ''' The first time index at which two simpars entries differ: 0 if they differ in something that isn't over time, npts if they don't '''
+    if isinstance(val1, dict) or isinstance(val2, dict):
+        if not (isinstance(val1, dict) and isinstance(val2, dict)) or list(val1.keys())!=list(val2.keys()): return 0
+        return min([firstdifference(val1[key], val2[key], npts) for key in val1.keys()]+[npts])
+    if isinstance(val1, ndarray) or isinstance(val2, ndarray):
+        if not (isinstance(val1, ndarray) and isinstance(val2, ndarray)) or val1.shape!=val2.shape or val1.dtype!=val2.dtype: return 0
+        same = val1==val2
+        if val1.dtype.kind in 'fc': same |= isnan(val1) & isnan(val2) # nan is the same as nan here
+        if same.all(): return npts
+        if val1.ndim and val1.shape[-1]==npts: return findinds(~same.reshape(-1,npts).all(axis=0))[0]
+        return 0
+    try:
+        if val1 is val2 or val1==val2: return npts
+    except: return 0 # Can't compare them, so assume they differ
+    if isnumber(val1) and isnumber(val2) and isnan(val1) and isnan(val2): return npts
+    return 0
+
+
+def branchind(refsimpars, simpars, npts):
+    '''
+    The latest time index from which a run of simpars can be started from a snapshot of a run of refsimpars: the
+    timestep before they first differ, or before a cascade proportion that differs would be fixed.
+    '''
+    ind = firstdifference(refsimpars, simpars, npts) - 1
+    for key,fixind in zip(propkeys, findfixinds(simpars)):
+        if fixind<ind and firstdifference(refsimpars[key], simpars[key], npts)<npts: ind = fixind # The snapshot would have the proportion fixed from the wrong values
+    return max(ind, 0)
+
+
+def runbranchedscenarios(project=None, all_kwargs=None, verbose=2):
+    '''
+    Run the scenarios, given the arguments to runsim() for each, so their shared history is only simulated once.
+
+    Each scenario is started from a snapshot of the people and cascade proportions of the earlier scenario it shares
+    the most timesteps with, at the last timestep before their parameters differ, and the results before that are
+    copied from it. Scenarios that differ from all earlier ones from the start are run in full. Returns the list of
+    results, which are the same as from runsim().
+    '''
+    settings = project.settings
+    nscens = len(all_kwargs)
+
+    # Make the parameters for each scenario, as runsim() would
+    simparslist = []
+    for kwargs in all_kwargs:
+        parsetname = kwargs['name']
+        try:    start = project.parsets[parsetname].start
+        except: start = settings.start
+        try:    end   = project.parsets[parsetname].end
+        except: end   = settings.end
+        simparslist.append(makesimpars(kwargs['pars'], projectversion=project.version, start=start, end=end, dt=settings.dt, settings=settings, name=parsetname))
+    npts = len(simparslist[0]['tvec'])
+
+    # Choose which earlier scenario to start each one from, and where
+    parents   = [None]*nscens
+    startinds = [0]*nscens
+    snapshots = [[] for scenno in range(nscens)]
+    for scenno in range(nscens):
+        for parent in range(scenno):
+            ind = branchind(simparslist[parent], simparslist[scenno], npts)
+            if ind>startinds[scenno] and ind>=startinds[parent]: # The parent run has to have got to this point
+                parents[scenno], startinds[scenno] = parent, ind
+        if parents[scenno] is not None: snapshots[parents[scenno]].append(startinds[scenno])
+
+    # Run the model
+    rawlist = [None]*nscens
+    for scenno,kwargs in enumerate(all_kwargs):
+        printv(kwargs['print_label'], 2, verbose)
+        modelkwargs = {'settings':settings, 'version':project.version, 'die':kwargs.get('die', True), 'verbose':0, 'label':project.name,
+                       'engine':kwargs.get('engine'), 'snapshots':snapshots[scenno]}
+        parent, ind = parents[scenno], startinds[scenno]
+        if parent is None:
+            rawlist[scenno] = model(simparslist[scenno], **modelkwargs)
+        else:
+            snapshot = rawlist[parent]['snapshots'][ind]
+            initprops = [] # The parent's proportions as they were at ind, unless this scenario's are different
+            for p,key in enumerate(propkeys):
+                if firstdifference(simparslist[parent][key], simparslist[scenno][key], npts)==npts: initprops.append(snapshot['props'][p])
+                else:                                                                                initprops.append(simparslist[scenno][key])
+            raw = model(simparslist[scenno], initpeople=snapshot['people'], initprops=initprops, startind=ind, **modelkwargs)
+            rawlist[scenno] = stitchraw(raw, rawlist[parent], ind)
+            printv('Started from scenario %i at %0.1f' % (parent+1, simparslist[scenno]['tvec'][ind]), 3, verbose)
+
+    # Make the results
+    allresults = []
+    for scenno,kwargs in enumerate(all_kwargs):
+        rawlist[scenno].pop('snapshots', None)
+        runkwargs = dict((key,val) for key,val in kwargs.items() if key not in ['project', 'print_label', 'verbose'])
+        allresults.append(project.runsim(simpars=simparslist[scenno], raw=rawlist[scenno], verbose=0, **runkwargs))
+    return allresults
+
+
 def makescenarios(project=None, scenlist=None, verbose=2, ccsample=None, randseed=None):
     """ Convert dictionary of scenario parameters into parset to model parameters """
     if ccsample is None: ccsample = 'best'
@@ -92,6 +92,8 @@ class Settings(object):
         self.methodnames = ['Injection', 'Heterosexual sex', 'Homosexual sex', 'MTCT']
 
         self.advancedtracking = False # Try to always set to False to save time when running model
+        self.engine = 'numpy' # How to run the model's time loop: 'numpy', or 'jit' for compiled kernels if Numba is installed (see modelkernels.py)
+        self.rawcache = None # If set to a folder (or True for a temporary folder), large raw results arrays kept with results are memory-mapped from files there
         
         # Set labels for each health state
         thesestates = dcp(self.healthstates)
@@ -207,11 +209,16 @@ def convertlimits(limits=None, tvec=None, dt=None, safetymargin=None, settings=N
     maxduration = 1000.
     maxmeta = 1000.0
     maxacts = 5000.0
-    maxyear = settings.end if settings is not None else Settings().end # Set to a default maximum year
     
     # It's a single number: just return it
     if isnumber(limits): return limits
     
+    # Only make default settings if the maximum year is needed, since it's slow
+    needsyear = limits is None or any([isinstance(m, str) and m=='maxyear' for m in (limits if isinstance(limits, (list, tuple)) else [limits])])
+    if settings is not None: maxyear = settings.end
+    elif needsyear:          maxyear = Settings().end # Set to a default maximum year
+    else:                    maxyear = None
+    
     # Just return the limits themselves as a dict if no input argument
     if limits is None: 
         return {'maxrate':maxrate, 'maxpopsize':maxpopsize, 'maxduration':maxduration, 'maxmeta':maxmeta, 'maxacts':maxacts, 'maxyear':maxyear}
@@ -15,7 +15,7 @@ __all__ = [
 'Link', 'LinkException', 'loadbalancer', 'loadtext', 'makefilepath', 'objectid', 'objatt', 'objmeth', 'objrepr',
 'odict', 'percentcomplete', 'perturb', 'printarr', 'pd', 'printdr', 'printv', 'printvars', 'printtologfile', 'promotetoarray',
 'promotetolist', 'promotetoodict', 'quantile', 'runcommand', 'sanitize', 'sanitizefilename', 'savetext', 'scaleratio', 'setylim',
-'sigfig', 'SItickformatter', 'SIticks', 'slacknotification', 'smoothinterp', 'tic', 'toc', 'today', 'vec2obj',
+'sigfig', 'SItickformatter', 'SIticks', 'slacknotification', 'smoothinterp', 'smoothinterprows', 'tic', 'toc', 'today', 'vec2obj',
 'PersistentLink', 'standard_dcp', 'standard_cp', 'odict_custom', 'parallelpool',
 ]
 
@@ -877,7 +877,7 @@ def dataindex(dataarray, index):
     
     return output
 
-from numpy import array, interp, convolve, linspace, concatenate, ones, exp, nan, inf, isnan, isfinite, argsort, ceil, arange
+from numpy import array, interp, convolve, linspace, concatenate, ones, exp, nan, inf, isnan, isfinite, argsort, ceil, arange, zeros, ix_
 
 def smoothinterp(newx=None, origx=None, origy=None, smoothness=None, growth=None, ensurefinite=False, keepends=True, method='linear'):
     '''
@@ -1002,6 +1002,56 @@ def smoothinterp(newx=None, origx=None, origy=None, smoothness=None, growth=None
     newy = newy[restoredorder]
     
     return newy
+
+
+smoothkernels = {} # Gaussian kernels used by smoothinterprows(), by smoothness
+
+def smoothinterprows(newx=None, origxs=None, origys=None, smoothness=None):
+    '''
+    Same as smoothinterp() (with the default arguments) for a list of origx and origy vectors, e.g. one per population,
+    but returns a 2D array with a row for each, smoothed all together. Rows with values that aren't finite use
+    smoothinterp() itself. smoothness must be supplied, since it can't be calculated per row.
+    
+    Example:
+        newy = smoothinterprows(linspace(2000,2030,151), [[2000,2010],[2005]], [[0.1,0.5],[0.3]], smoothness=5)
+    
+    Version: 2026oct18
+    '''
+    newx = array(newx, dtype=float)
+    neworder = argsort(newx)
+    sortedx = newx[neworder]
+    smoothness = int(smoothness)
+    nrows = len(origxs)
+    newys = zeros((nrows, len(newx)))
+    
+    # Interpolate each row, and pick out the ones to smooth
+    smoothrows = []
+    for r in range(nrows):
+        origx = array(origxs[r], dtype=float).flatten()
+        origy = array(origys[r], dtype=float).flatten()
+        if len(origy)==1: # Constant, so nothing to smooth
+            newys[r,:] = origy[0]
+        elif not isfinite(origy).all(): # Needs special treatment
+            newys[r,:] = smoothinterp(newx, origx, origy, smoothness=smoothness)
+        else:
+            correctorder = argsort(origx)
+            newys[r,neworder] = interp(sortedx, origx[correctorder], origy[correctorder])
+            smoothrows.append(r)
+    
+    # Smooth the rows together, keeping the ends
+    if smoothness and smoothrows:
+        if smoothness not in smoothkernels:
+            kernel = exp(-linspace(-2,2,2*smoothness+1)**2)
+            smoothkernels[smoothness] = kernel/kernel.sum()
+        kernel = smoothkernels[smoothness]
+        rows = newys[smoothrows][:,neworder]
+        padded = concatenate([rows[:,:1].repeat(smoothness, axis=1), rows, rows[:,-1:].repeat(smoothness, axis=1)], axis=1)
+        smoothed = zeros(rows.shape)
+        npts = rows.shape[1]
+        for k in range(len(kernel)): smoothed += kernel[-1-k]*padded[:,k:k+npts] # Same as convolve(..., 'valid') on each row
+        newys[ix_(smoothrows, neworder)] = smoothed
+    
+    return newys
     
 
 def perturb(n=1, span=0.5, randseed=None):
@@ -38,7 +38,9 @@ optima.debuginfo()
 
 # Load the database
 from server.webapp import dbconn
-dbconn.db = SQLAlchemy(app)
+dbconn.db = SQLAlchemy(app) # Uses the SQLALCHEMY_POOL_* settings from the config
+if app.config.get('SQLALCHEMY_POOL_PRE_PING', True):
+    dbconn.enable_pool_pre_ping()
 dbconn.redis = redis.StrictRedis.from_url(app.config["REDIS_URL"])
 
 from server.webapp.dbmodels import UserDb
@@ -12,6 +12,11 @@ CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL',REDIS_URL)
 CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND',REDIS_URL)
 CELERY_ACCEPT_CONTENT = os.getenv('CELERY_ACCEPT_CONTENT','pickle,json,msgpack,yaml').split(',') # Comma separated list
 SQLALCHEMY_TRACK_MODIFICATIONS = bool(os.getenv('SQLALCHEMY_TRACK_MODIFICATIONS',False))
+SQLALCHEMY_POOL_SIZE = int(os.getenv('SQLALCHEMY_POOL_SIZE',5)) # Connections kept open by each web server and Celery worker process
+SQLALCHEMY_MAX_OVERFLOW = int(os.getenv('SQLALCHEMY_MAX_OVERFLOW',10)) # Extra connections allowed when all of those are in use
+SQLALCHEMY_POOL_TIMEOUT = int(os.getenv('SQLALCHEMY_POOL_TIMEOUT',30)) # Seconds to wait for a connection before giving up
+SQLALCHEMY_POOL_RECYCLE = int(os.getenv('SQLALCHEMY_POOL_RECYCLE',1800)) # Seconds before a connection is replaced, so it isn't closed by the database first
+SQLALCHEMY_POOL_PRE_PING = bool(int(os.getenv('SQLALCHEMY_POOL_PRE_PING',1))) # Check connections before using them, and reconnect if they've gone away
 MATPLOTLIB_BACKEND = os.getenv('MATPLOTLIB_BACKEND',"agg")
 SERVER_PORT = int(os.getenv('PORT', 8080))
 WORKERS = int(os.getenv('WORKERS',min(math.ceil(multiprocessing.cpu_count()/2.0),8))) # By default use half the CPUs, up to a maximum of 8
@@ -30,11 +30,13 @@ from validate_email import validate_email
 import optima as op
 from pylab import argsort
 
-from .dbconn import db
+from .dbconn import db, get_pool_status
 from . import parse
 from .exceptions import ProjectDoesNotExist, ParsetAlreadyExists, \
     UserAlreadyExists, UserDoesNotExist, InvalidCredentials
 from .dbmodels import UserDb, ProjectDb, ResultsDb, PyObjectDb, UndoStackDb
+from .projectstore import LazyProject
+from . import undostore
 from .plot import make_mpld3_graph_dict, convert_to_mpld3, process_which
 
 import six
@@ -289,6 +291,13 @@ def revoke_admin(user_id):
     return None
 
 
+def get_db_pool_status():
+    ''' Returns the state of this server process's database connection pool, for monitoring '''
+    if not current_user.is_admin:
+        abort(403)
+    return get_pool_status(db.engine)
+
+
 def reset_password(user_id):
     ''' Reset the user's password to "optima" '''
     defaultpassword = 'optima'
@@ -440,6 +449,8 @@ def load_project_from_record(project_record):
     except:
         print('WARNING, could not load project!')
         return None
+    if isinstance(project, LazyProject): # Links are restored as each component is fetched
+        return project
     for progset in project.progsets.values():
         if not hasattr(progset, 'inactive_programs'):
             progset.inactive_programs = op.odict()
@@ -987,21 +998,40 @@ def upload_project_object(filename, project_id, obj_type):
 ### RESULTS
 #############################################################################################
 
-def load_result(project_id, which=None, name=None):
-    result_records = db.session.query(ResultsDb).filter_by(project_id=project_id)
-    for result_record in result_records:
-        result = result_record.load()
-        if result.name == name:
-            print(">> load_result loaded '%s'" % str(result.name))
-            if which:
-                result.which = which
-                print(">> load_result saving which", which)
-                result_record.save_obj(result)
-            return result
-    print(">> load_result: stored result is empty")
+def load_result_record_by_name(project_id, name, db_session=None, **kwargs):
+    """
+    Returns the record of the project's result with this name, looked up in the result index,
+    or None. Other kwargs (e.g. calculation_type) are used to filter the records.
+    """
+    if db_session is None:
+        db_session = db.session
+    query = db_session.query(ResultsDb).filter_by(project_id=project_id, **kwargs)
+    result_id = ResultsDb.lookup(project_id, name)
+    if result_id is not None:
+        result_record = query.filter_by(id=UUID(result_id)).first()
+        if result_record is not None:
+            return result_record
+    # Not in the index, e.g. saved before it existed, so check the metadata of each result (which adds them to the index)
+    for result_record in query:
+        if result_record.get_metadata()['name'] == name:
+            return result_record
     return None
 
 
+def load_result(project_id, which=None, name=None):
+    result_record = load_result_record_by_name(project_id, name)
+    if result_record is None:
+        print(">> load_result: stored result is empty")
+        return None
+    result = result_record.load()
+    print(">> load_result loaded '%s'" % str(result.name))
+    if which:
+        result.which = which
+        print(">> load_result saving which", which)
+        result_record.save_which(which)
+    return result
+
+
 def load_result_by_id(result_id, which=None):
     result_record = db.session.query(ResultsDb).get(result_id)
     if result_record is None:
@@ -1010,7 +1040,7 @@ def load_result_by_id(result_id, which=None):
     if which is not None:
         result.which = which
         print(">> load_result_by_id saving which", which)
-        result_record.save_obj(result)
+        result_record.save_which(which)
     return result
 
 
@@ -1074,8 +1104,7 @@ def delete_result_by_name(
 
     records = db_session.query(ResultsDb).filter_by(project_id=project_id)
     for record in records:
-        result = record.load()
-        if result.name == result_name:
+        if record.get_metadata()['name'] == result_name:
             print(">> delete_result_by_name '%s'" % result_name)
             record.cleanup()
             db_session.delete(record)
@@ -1116,15 +1145,10 @@ def load_result_by_optimization(project, optimization):
         parset_id = project.parset().uid # Just get the default
 
     print(">> load_result_by_optimization '%s'" % result_name)
-    result_records = db.session.query(ResultsDb).filter_by(
-        project_id=project.uid,
-        parset_id=parset_id,
-        calculation_type="optimization")
-
-    for result_record in result_records:
-        result = result_record.load()
-        if result.name == result_name:
-            return result
+    result_record = load_result_record_by_name(
+        project.uid, result_name, parset_id=parset_id, calculation_type="optimization")
+    if result_record is not None:
+        return result_record.load()
 
     print(">> load_result_by_optimization not result for optim '%s'" % (optimization.name))
 
@@ -1941,8 +1965,10 @@ def make_region_projects(spreadsheet_fname, project_id):
 
 class UndoStack(object):
     """
-    A stack of Project objects for allowing Undo and Redo functionality in
-    Optima.
+    A stack of Project versions for allowing Undo and Redo functionality in
+    Optima.  The versions are kept in Redis as frames holding only the parts
+    of the project that changed from the version before (see undostore.py),
+    so the stack itself only holds the frame keys.
 
     Methods:
         __init__(theProjectUID: UUID): void -- constructor, taking the project's
@@ -1976,10 +2002,16 @@ class UndoStack(object):
             Redis tables
         useDirtyFlag: bool -- should we use the dirty flag?
         dirtyFlag: bool -- do we have pending information waiting to be saved?
-        projectVersions: list of Project objects -- Python list holding
-            the Project objects we want to be able to revert to
+        frameKeys: list of str -- Redis keys of the frames of each of the
+            Project versions we want to be able to revert to
+        snapshotFlags: list of bool -- whether each frame is a snapshot
+        currentHashes: odict -- hashes of the parts of the current version,
+            to tell which parts the next version changes
         currentIndex: int [or None] -- the index into the current project
             version on the stack
+        pendingFrames: dict -- frames not yet written to Redis
+        staleFrameKeys: list of str -- dropped frames not yet deleted from
+            Redis
 
     Usage:
         >>> undoStack = UndoStack(project_id)
@@ -1995,9 +2027,67 @@ class UndoStack(object):
         # Set the dirtyFlag to clean.
         self.setClean()
 
-        # Start with an empty list of Projects and index None.
-        self.projectVersions = []
+        # Start with no frames and index None.
+        self.frameKeys = []
+        self.snapshotFlags = []
+        self.currentHashes = None
         self.currentIndex = None
+        self.pendingFrames = {}
+        self.staleFrameKeys = []
+
+    def __getstate__(self):
+        # The pending frames are written by undostore.save_stack(), not
+        # pickled with the stack.
+        state = self.__dict__.copy()
+        state.pop('pendingFrames', None)
+        state.pop('staleFrameKeys', None)
+        return state
+
+    def __setstate__(self, state):
+        # Stacks saved before frames were used hold whole Project objects:
+        # turn them into frames, which get written the next time the stack
+        # is saved.
+        projectVersions = state.pop('projectVersions', None)
+        self.__dict__.update(state)
+        self.pendingFrames = {}
+        self.staleFrameKeys = []
+        if projectVersions is not None:
+            currentIndex = self.currentIndex
+            self.frameKeys = []
+            self.snapshotFlags = []
+            self.currentHashes = None
+            for version in projectVersions:
+                self.appendFrame(version)
+            self.currentIndex = currentIndex
+            if currentIndex is not None and currentIndex != len(projectVersions) - 1:
+                self.currentHashes = None # Not the last frame; fetched if needed
+
+    def appendFrame(self, newVersion):
+        # Make a snapshot if there have been enough frames since the last one,
+        # otherwise only keep what changed from the current version.
+        index = len(self.frameKeys)
+        if self.currentHashes is None or index - self.lastSnapshot(index - 1) >= undostore.snapshot_interval:
+            lastHashes = None
+        else:
+            lastHashes = self.currentHashes
+        frame, self.currentHashes = undostore.make_frame(newVersion, lastHashes)
+        frameKey = undostore.new_frame_key()
+        self.pendingFrames[frameKey] = frame
+        self.frameKeys.append(frameKey)
+        self.snapshotFlags.append(frame['snapshot'])
+        self.currentIndex = index
+
+    def lastSnapshot(self, index):
+        # Find the last snapshot frame at or before the index.
+        while not self.snapshotFlags[index]:
+            index -= 1
+        return index
+
+    def loadVersion(self, index):
+        # Replay the frames from the last snapshot to get the version.
+        frameKeys = self.frameKeys[self.lastSnapshot(index):(index + 1)]
+        project, self.currentHashes = undostore.load_version(frameKeys, self.pendingFrames)
+        return project
 
     def pushNewVersion(self, newVersion):
         # Exit if we cannot save to the stack yet.
@@ -2007,16 +2097,17 @@ class UndoStack(object):
         # If we are not at the stack top, trim out all indices after the
         # current one.
         if not self.atStackTop():
-            self.projectVersions = self.projectVersions[:(self.currentIndex + 1)]
+            self.staleFrameKeys += self.frameKeys[(self.currentIndex + 1):]
+            self.frameKeys = self.frameKeys[:(self.currentIndex + 1)]
+            self.snapshotFlags = self.snapshotFlags[:(self.currentIndex + 1)]
 
-        # Append the Project object for the new version.
-        self.projectVersions.append(newVersion)
+        # If we don't know what the current version holds, get it.
+        if self.currentIndex is not None and self.currentHashes is None:
+            self.loadVersion(self.currentIndex)
 
-        # Move the index up so we point to the new version.
-        if self.currentIndex == None:
-            self.currentIndex = 0
-        else:
-            self.currentIndex += 1
+        # Append the frame for the new version, and move the index up so we
+        # point to it.
+        self.appendFrame(newVersion)
 
         # Set the dirty flag clean.
         self.setClean()
@@ -2043,7 +2134,7 @@ class UndoStack(object):
                 self.currentIndex -= 1
 
                 # Return the now-pointed-to version of the Project.
-                return self.projectVersions[self.currentIndex]
+                return self.loadVersion(self.currentIndex)
 
         # Otherwise (not using the dirty flag)...
         else:
@@ -2051,7 +2142,7 @@ class UndoStack(object):
             self.currentIndex -= 1
 
             # Return the now-pointed-to version of the Project.
-            return self.projectVersions[self.currentIndex]
+            return self.loadVersion(self.currentIndex)
 
     def getRedoVersion(self):
         # Exit if we cannot redo from the stack yet.
@@ -2065,10 +2156,10 @@ class UndoStack(object):
         self.setClean()
 
         # Return the now-pointed-to version of the Project.
-        return self.projectVersions[self.currentIndex]
+        return self.loadVersion(self.currentIndex)
 
     def getSelectedVersion(self):
-        return self.projectVersions[self.currentIndex]
+        return self.loadVersion(self.currentIndex)
 
     def getProjectUID(self):
         return self.projectUID
@@ -2122,13 +2213,13 @@ class UndoStack(object):
         return (not self.atStackTop())
 
     def isEmpty(self):
-        return len(self.projectVersions) == 0
+        return len(self.frameKeys) == 0
 
     def atStackTop(self):
         if self.currentIndex == None:
             return True
         else:
-            return (self.currentIndex == (len(self.projectVersions) - 1))
+            return (self.currentIndex == (len(self.frameKeys) - 1))
 
     def atStackBottom(self):
         return self.currentIndex == 0
@@ -2148,7 +2239,7 @@ class UndoStack(object):
         if self.isEmpty():
             print('Contents: Empty')
         else:
-            print('Contents: %d Project versions' % len(self.projectVersions))
+            print('Contents: %d Project versions (%d snapshots)' % (len(self.frameKeys), sum(self.snapshotFlags)))
             print('Stack Index: %d' % self.currentIndex)
         print
 
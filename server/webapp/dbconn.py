@@ -1,5 +1,42 @@
 # This is a module-wide location to store the connection to the database
 # that is initialized in api.py
 
+from sqlalchemy import event, exc, select
+from sqlalchemy.engine import Engine
+
 db = None
 redis = None
+
+
+def enable_pool_pre_ping():
+    """
+    Test each connection when it's taken from the pool, and reconnect if it has
+    gone away (e.g. Postgres was restarted), rather than failing the request
+    """
+    @event.listens_for(Engine, "engine_connect")
+    def ping_connection(connection, branch):
+        if branch: # A sub-connection of one that's already been checked
+            return
+        should_close_with_result = connection.should_close_with_result
+        connection.should_close_with_result = False
+        try:
+            connection.scalar(select([1]))
+        except exc.DBAPIError as err:
+            if err.connection_invalidated: # The whole pool has been invalidated, so this reconnects
+                connection.scalar(select([1]))
+            else:
+                raise
+        finally:
+            connection.should_close_with_result = should_close_with_result
+
+
+def get_pool_status(engine=None):
+    """ Returns the size and usage of this process's database connection pool """
+    if engine is None:
+        engine = db.engine
+    pool = engine.pool
+    status = {'pool_class': type(pool).__name__, 'status': pool.status()}
+    for key in ['size', 'checkedin', 'checkedout', 'overflow']:
+        if hasattr(pool, key): # Not all pools have these
+            status[key] = getattr(pool, key)()
+    return status
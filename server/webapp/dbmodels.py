@@ -1,10 +1,112 @@
 import os
+import time
+import json
+from hashlib import md5
+from uuid import UUID as PyUUID
 #from flask_restful_swagger import swagger
 from sqlalchemy import text
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.dialects.postgresql import JSON
 import optima as op
 from .dbconn import db, redis
+from . import projectstore
+from . import undostore
+
+
+def as_text(value):
+    """ Redis returns bytes unless it's set up to decode them """
+    return value.decode() if isinstance(value, bytes) else value
+
+
+# Rendered graphs are cached per result and plot, in "graph-<result>-<hash of plot settings>" keys.
+# Each result's keys are listed in "graph-keys-<result>", to remove them when the result changes,
+# and "graph-lru" holds every key by last use, to remove the least recently used beyond the limit
+# (and from their result's list, so lists of results that are never cleaned up don't pile up).
+max_cached_graphs = 1000
+
+
+def graph_cache_key(result_id, *settings):
+    return "graph-%s-%s" % (PyUUID(str(result_id)).hex, md5(repr(settings).encode()).hexdigest())
+
+
+def graph_keys_key(result_id):
+    return "graph-keys-" + PyUUID(str(result_id)).hex
+
+
+def load_cached_graphs(result_id, *settings):
+    key = graph_cache_key(result_id, *settings)
+    blob = redis.get(key)
+    if blob is None:
+        return None
+    redis.zadd("graph-lru", {key: time.time()}) # Mark as recently used
+    return op.loadstr(blob)
+
+
+def save_cached_graphs(result_id, graphs, *settings):
+    key = graph_cache_key(result_id, *settings)
+    pipe = redis.pipeline()
+    pipe.set(key, op.dumpstr(graphs))
+    pipe.sadd(graph_keys_key(result_id), key)
+    pipe.zadd("graph-lru", {key: time.time()})
+    pipe.execute()
+    nexcess = redis.zcard("graph-lru") - max_cached_graphs
+    if nexcess > 0:
+        oldkeys = redis.zrange("graph-lru", 0, nexcess-1)
+        pipe = redis.pipeline()
+        pipe.zrem("graph-lru", *oldkeys)
+        pipe.delete(*oldkeys)
+        for oldkey in oldkeys: # Keys are graph-<result>-<hash>
+            pipe.srem(graph_keys_key(as_text(oldkey).split('-')[1]), oldkey)
+        pipe.execute()
+
+
+def clear_cached_graphs(result_id):
+    setkey = graph_keys_key(result_id)
+    keys = redis.smembers(setkey)
+    pipe = redis.pipeline()
+    if keys:
+        pipe.zrem("graph-lru", *keys)
+        pipe.delete(*keys)
+    pipe.delete(setkey)
+    pipe.execute()
+
+
+
+# The progress of a running task (e.g. iterations of an optimization) is kept as JSON in
+# "task-progress-<task id>", which expires if the task stops updating it.
+task_progress_expiry = 24*60*60
+
+
+def save_task_progress(task_id, progress):
+    redis.set("task-progress-%s" % task_id, json.dumps(progress), ex=task_progress_expiry)
+
+
+def load_task_progress(task_id):
+    blob = redis.get("task-progress-%s" % task_id)
+    return json.loads(as_text(blob)) if blob is not None else None
+
+
+def clear_task_progress(task_id):
+    redis.delete("task-progress-%s" % task_id)
+
+
+
+# Optimizations save the state of their runs in "optim-checkpoint-..." keys (see op.Optimcheckpoint),
+# which expire if the optimization isn't relaunched to carry on from them.
+checkpoint_expiry = 7*24*60*60
+
+
+class CheckpointStore(object):
+    """ The Redis store for op.Optimcheckpoint """
+
+    def get(self, key):
+        return redis.get(key)
+
+    def set(self, key, blob):
+        redis.set(key, blob, ex=checkpoint_expiry)
+
+    def delete(self, key):
+        redis.delete(key)
 
 
 #@swagger.model
@@ -98,13 +200,15 @@ class ProjectDb(db.Model):
 
     def load(self):
         print(">> ProjectDb.load " + self.id.hex)
-        redis_entry = redis.get(self.id.hex)
-        project = op.loadproj(redis_entry, fromdb=True)
-        return project
+        return projectstore.load_project(self.id.hex)
 
     def save_obj(self, obj):
         print(">> ProjectDb.save " + self.id.hex)
-        redis.set(self.id.hex, op.dumpstr(obj))
+        projectstore.save_project(self.id.hex, obj)
+
+    def cleanup(self):
+        print(">> ProjectDb.cleanup " + self.id.hex)
+        projectstore.delete_project(self.id.hex)
 
     def as_file(self, loaddir, filename=None):
         project = self.load()
@@ -140,6 +244,7 @@ class ProjectDb(db.Model):
         str_project_id = str(self.id)
         # delete all relevant entries explicitly
         self.delete_dependent_objects(synchronize_session=synchronize_session)
+        self.cleanup()
         # db.session.query(ProjectDataDb).filter_by(id=str_project_id).delete(synchronize_session)
         db.session.query(ProjectDb).filter_by(id=str_project_id).delete(synchronize_session)
         db.session.flush()
@@ -164,17 +269,79 @@ class ResultsDb(db.Model):
         if id:
             self.id = id
 
+    # Besides the pickled result, each result has a Redis hash of its metadata (name, parset_id,
+    # kind, created, which and size), and each project has a hash from result names to result ids,
+    # so results can be found, and which updated, without unpickling them
+
+    @staticmethod
+    def index_key(project_id):
+        return "result-index-" + PyUUID(str(project_id)).hex
+
+    @staticmethod
+    def lookup(project_id, name):
+        """ Returns the id of the project's result with this name, or None if it isn't indexed """
+        result_id = redis.hget(ResultsDb.index_key(project_id), name)
+        return as_text(result_id) if result_id is not None else None
+
+    def meta_key(self):
+        return "result-meta-" + self.id.hex
+
     def load(self):
         print(">> ResultsDb.load result-" + self.id.hex)
-        return op.loadstr(redis.get("result-" + self.id.hex))
+        result = op.loadstr(redis.get("result-" + self.id.hex))
+        which = redis.hget(self.meta_key(), 'which')
+        if which is not None: # It may have been changed without saving the result
+            result.which = op.loadstr(which)
+        return result
 
     def save_obj(self, obj):
         print(">> ResultsDb.save result-" + self.id.hex)
-        redis.set("result-" + self.id.hex, op.dumpstr(obj))
+        blob = op.dumpstr(obj)
+        redis.set("result-" + self.id.hex, blob)
+        self.save_metadata(obj, size=len(blob))
+        clear_cached_graphs(self.id) # The result may have changed
+
+    def save_metadata(self, obj, size=None):
+        if size is None:
+            size = redis.strlen("result-" + self.id.hex)
+        metadata = {
+            'name': obj.name,
+            'parset_id': str(self.parset_id) if self.parset_id is not None else '',
+            'kind': self.calculation_type or '',
+            'created': str(getattr(obj, 'created', '')),
+            'which': op.dumpstr(getattr(obj, 'which', None)),
+            'size': size,
+        }
+        redis.hset(self.meta_key(), mapping=metadata)
+        if self.project_id is not None:
+            redis.hset(ResultsDb.index_key(self.project_id), obj.name, self.id.hex)
+
+    def save_which(self, which):
+        print(">> ResultsDb.save_which result-" + self.id.hex)
+        redis.hset(self.meta_key(), 'which', op.dumpstr(which))
+
+    def get_metadata(self):
+        """ Returns the metadata of the result, storing it first if the result was saved without it """
+        metadata = redis.hgetall(self.meta_key())
+        if not any(as_text(key) == 'name' for key in metadata):
+            self.save_metadata(self.load())
+            metadata = redis.hgetall(self.meta_key())
+        output = {}
+        for key, value in metadata.items():
+            key = as_text(key)
+            output[key] = op.loadstr(value) if key == 'which' else as_text(value)
+        output['size'] = int(output['size'])
+        return output
 
     def cleanup(self):
         print(">> ResultsDb.cleanup result-" + self.id.hex)
-        redis.delete("result-" + self.id.hex)
+        name = redis.hget(self.meta_key(), 'name')
+        if name is not None and self.project_id is not None:
+            index_key = ResultsDb.index_key(self.project_id)
+            if as_text(redis.hget(index_key, as_text(name)) or b'') == self.id.hex: # Don't remove a newer result with the same name
+                redis.hdel(index_key, as_text(name))
+        redis.delete("result-" + self.id.hex, self.meta_key())
+        clear_cached_graphs(self.id)
 
 
 class WorkLogDb(db.Model):  # pylint: disable=R0903
@@ -202,12 +369,12 @@ class UndoStackDb(db.Model):
 
     def load(self):
         print(">> UndoStackDb.load undo-stack-" + self.id.hex)
-        return op.loadstr(redis.get("undo-stack-" + self.id.hex))
+        return undostore.load_stack("undo-stack-" + self.id.hex)
 
     def save_obj(self, obj):
         print(">> UndoStackDb.save undo-stack-" + self.id.hex)
-        redis.set("undo-stack-" + self.id.hex, op.dumpstr(obj))
+        undostore.save_stack("undo-stack-" + self.id.hex, obj)
 
     def cleanup(self):
         print(">> UndoStackDb.cleanup undo-stack-" + self.id.hex)
-        redis.delete("undo-stack-" + self.id.hex)
\ No newline at end of file
+        undostore.delete_stack("undo-stack-" + self.id.hex)
\ No newline at end of file
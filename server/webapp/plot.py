@@ -8,6 +8,7 @@ from numpy import array
 import optima as op
 
 from .parse import normalize_obj
+from .dbmodels import load_cached_graphs, save_cached_graphs
 
 frontendfigsize = (5.5, 2)
 frontendpositionnolegend = [[0.19, 0.12], [0.85, 0.85]]
@@ -151,6 +152,45 @@ def process_which(result=None, which=None, advanced=None, includeadvancedtrackin
     return which,selectors,advanced,origwhich
 
 
+def group_plot_keys(which):
+    """ Splits which into the groups of keys that are plotted together, i.e. the two cascade bar plots, whose titles depend on each other """
+    cascadebars = ['cascadebars', 'cascadebars90']
+    groups = []
+    for plot_key in which:
+        if plot_key in cascadebars and all(key in which for key in cascadebars):
+            if plot_key == [key for key in which if key in cascadebars][0]:
+                groups.append(tuple(cascadebars))
+        else:
+            groups.append((plot_key,))
+    return groups
+
+
+def render_mpld3_graphs(result=None, plot_keys=None, zoom=None, startYear=None, endYear=None):
+    """
+    Makes the graphs for a group of plot keys (each of which may be more than one graph, e.g. one per population)
+
+    Returns:
+        A list of (graph selector, mpld3 graph dictionary) pairs
+    """
+    graphs = op.makeplots(result, toplot=list(plot_keys), plotstartyear=startYear, plotendyear=endYear, newfig=True, die=False)
+    op.reanimateplots(graphs)
+
+    plot_graphs = []
+    for graph_key in graphs:
+        graph_pos = None
+        graph_dict = convert_to_mpld3(graphs[graph_key], zoom=zoom, graph_pos=graph_pos) # !~! most likely the yticklabels are getting lost here
+        graph = graphs[graph_key]
+        while len(graph.axes)>1:
+            print('Warning, too many axes, attempting removal')
+            graph.delaxes(graph.axes[1])
+        ylabels = [l.get_text() for l in graph.axes[0].get_yticklabels()]
+        graph_dict['ylabels'] = ylabels
+        xlabels = [l.get_text() for l in graph.axes[0].get_xticklabels()]
+        graph_dict['xlabels'] = xlabels
+        plot_graphs.append((extract_graph_selector(graph_key), graph_dict))
+    return plot_graphs
+
+
 def make_mpld3_graph_dict(result=None, which=None, zoom=None, startYear=None, endYear=None, includeadvancedtracking=False):
     """
     Converts an Optima sim Result into a dictionary containing
@@ -183,25 +223,19 @@ def make_mpld3_graph_dict(result=None, which=None, zoom=None, startYear=None, en
 
     print(">> make_mpld3_graph_dict which:", which)
 
-    graphs = op.makeplots(result, toplot=which, plotstartyear=startYear, plotendyear=endYear, newfig=True, die=False)
-    op.reanimateplots(graphs)
-
+    # Only render the plots that haven't been rendered for this result with these settings before
     graph_selectors = []
     mpld3_graphs = []
-    for g,graph_key in enumerate(graphs):
-        graph_selectors.append(extract_graph_selector(graph_key))
-        graph_pos = None
-        graph_dict = convert_to_mpld3(graphs[graph_key], zoom=zoom, graph_pos=graph_pos) # !~! most likely the yticklabels are getting lost here
-        graph = graphs[graph_key]
-        while len(graph.axes)>1:
-            print('Warning, too many axes, attempting removal')
-            graph.delaxes(graph.axes[1])
-        ylabels = [l.get_text() for l in graph.axes[0].get_yticklabels()]
-        graph_dict['ylabels'] = ylabels
-        xlabels = [l.get_text() for l in graph.axes[0].get_xticklabels()]
-        graph_dict['xlabels'] = xlabels
-        graph_dict['id'] = ('graph%i-' % g) + graph_dict['id'] # Prepend graph dict
-        mpld3_graphs.append(graph_dict)
+    for plot_keys in group_plot_keys(which):
+        plot_graphs = load_cached_graphs(result.uid, plot_keys, zoom, startYear, endYear)
+        if plot_graphs is None:
+            print(">> make_mpld3_graph_dict rendering:", plot_keys)
+            plot_graphs = render_mpld3_graphs(result=result, plot_keys=plot_keys, zoom=zoom, startYear=startYear, endYear=endYear)
+            save_cached_graphs(result.uid, plot_graphs, plot_keys, zoom, startYear, endYear)
+        for graph_selector, graph_dict in plot_graphs:
+            graph_dict['id'] = ('graph%i-' % len(mpld3_graphs)) + graph_dict['id'] # Prepend graph dict
+            graph_selectors.append(graph_selector)
+            mpld3_graphs.append(graph_dict)
 
     return {
         'graphs': {
@@ -0,0 +1,289 @@
+"""
+projectstore.py
+===============
+
+Stores projects in Redis as separate components, so that loading a project only
+fetches the parts that get used, and saving it only writes the parts that changed.
+
+For a project with id <hex>, the keys are:
+ - project-<hex>-shell: the project without its components
+ - project-<hex>-manifest: the keys of the shell and of each component's items, in order
+ - project-<hex>-<component>-<stamp>: one item (e.g. a parset), where the stamp is a hash of its contents
+
+Since the stamp changes whenever the item does, a saved key is never overwritten:
+changed items get new keys, and the keys that are no longer used are deleted.
+
+Several processes (e.g. a web request and a Celery task) can have the same project
+loaded. Saving only writes the components a process has loaded, and takes the rest
+from the manifest currently in Redis, in a transaction that is retried if another
+process saves the project in the meantime.
+
+Projects saved before this were stored whole under <hex>. They are still loaded,
+and are converted the next time they're saved.
+"""
+
+import io
+import copyreg
+from hashlib import md5
+
+import optima as op
+from optima.optimization import Projectpickler, Projectunpickler
+
+from redis.exceptions import WatchError
+
+from .dbconn import redis
+
+
+components = ['data', 'parsets', 'progsets', 'scens', 'optims', 'results']
+max_save_attempts = 10
+
+
+#############################################################################################
+### LAZY PROJECTS
+#############################################################################################
+
+class LazyProject(op.Project):
+    """
+    A project loaded from the project store, which fetches each component (e.g. all
+    the parsets) from Redis the first time it's used. Pickling or copying it gives
+    an ordinary Project with all of its components.
+    """
+
+    def __getattr__(self, attr):
+        # Only called if the attribute isn't there, i.e. the component hasn't been fetched yet
+        store = self.__dict__.get('_projectstore')
+        if store is not None and attr in store['pending']:
+            load_component(self, attr)
+            return self.__dict__[attr]
+        raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, attr))
+
+    def __reduce_ex__(self, protocol):
+        load_all_components(self)
+        state = dict((key, value) for key, value in self.__dict__.items() if key != '_projectstore')
+        return (copyreg._reconstructor, (op.Project, object, None), state)
+
+
+def is_loaded(project, attr):
+    """ Whether this component is in memory, i.e. may have been changed """
+    store = project.__dict__.get('_projectstore')
+    return store is None or attr not in store['pending']
+
+
+def load_component(project, attr):
+    store = project._projectstore
+    entry = store['manifest'][attr]
+    print(">> projectstore.load_component %s %s" % (store['id'], attr))
+    blobs = fetch_entry(entry)
+    if any(blob is None for blob in blobs): # Another process may have saved the project since it was loaded
+        entry = refresh_entries(project)[attr]
+        blobs = fetch_entry(entry)
+    if any(blob is None for blob in blobs):
+        raise op.OptimaException('Project %s is missing some of its %s' % (store['id'], attr))
+    items = [undump_item(blob, project) for blob in blobs]
+    if entry['container'] is None: # Stored as a single item
+        value = items[0]
+    else:
+        value = undump_item(entry['container'], project)
+        for (name, key), item in zip(entry['items'], items):
+            op.odict.__setitem__(value, name, item) # Don't call the odict_custom function, since nothing has changed
+    restore_component_links(project, attr, value)
+    project.__dict__[attr] = value
+    store['pending'].discard(attr)
+    return value
+
+
+def fetch_entry(entry):
+    keys = [key for name, key in entry['items']]
+    return redis.mget(keys) if keys else []
+
+
+def refresh_entries(project):
+    """
+    Update the manifest entries of the components that haven't been loaded yet from the
+    manifest currently in Redis, since another process may have saved the project since
+    this one loaded it, and deleted the keys it had. Returns the project's manifest.
+    """
+    store = project.__dict__.get('_projectstore')
+    if store is None:
+        return None
+    manifest = get_manifest(store['id'])
+    if manifest is not None:
+        for attr in store['pending']:
+            store['manifest'][attr] = manifest[attr]
+    return store['manifest']
+
+
+def load_all_components(project):
+    store = project.__dict__.get('_projectstore')
+    if store is not None:
+        for attr in list(store['pending']):
+            load_component(project, attr)
+
+
+def restore_component_links(project, attr, value):
+    """ Same as Project.restorelinks(), but for one component """
+    if attr == 'data' or not isinstance(value, op.odict):
+        return
+    for item in value.values():
+        if hasattr(item, 'projectref'):
+            item.projectref = op.Link(project)
+        if hasattr(item, 'restorelinks'):
+            item.restorelinks()
+        if attr == 'progsets' and not hasattr(item, 'inactive_programs'):
+            item.inactive_programs = op.odict()
+    if attr in ['parsets', 'progsets'] and isinstance(value, op.odict_custom):
+        value.func = project.checkpropagateversionlink
+
+
+#############################################################################################
+### SERIALIZATION
+#############################################################################################
+
+def dump_item(item, project):
+    """ Pickle an item, replacing links to the project with its UID """
+    output = io.BytesIO()
+    Projectpickler(output, project=project).dump(item)
+    return output.getvalue()
+
+
+def undump_item(blob, project):
+    return Projectunpickler(io.BytesIO(blob), projects={project.uid: project}).load()
+
+
+def empty_container(value):
+    """ A copy of an odict (e.g. project.parsets) without its items, but with its other attributes """
+    container = type(value).__new__(type(value))
+    op.odict.__init__(container)
+    container.__dict__.update(value.__dict__)
+    return container
+
+
+def project_shell(project):
+    """ A copy of the project without its components """
+    state = dict((key, value) for key, value in project.__dict__.items() if key not in components + ['_projectstore'])
+    shell = op.Project.__new__(op.Project)
+    shell.__dict__.update(state)
+    return shell
+
+
+def make_key(project_id, attr, blob):
+    return 'project-%s-%s-%s' % (project_id, attr, md5(blob).hexdigest())
+
+
+def key_stamp(key):
+    """ The hash of the contents of an item, from its key """
+    return key.rsplit('-', 1)[-1]
+
+
+def get_manifest(project_id):
+    blob = redis.get('project-%s-manifest' % project_id)
+    return op.loadstr(blob) if blob is not None else None
+
+
+def manifest_keys(manifest):
+    keys = set([manifest['shell']])
+    for attr in components:
+        keys.update(key for name, key in manifest[attr]['items'])
+    return keys
+
+
+#############################################################################################
+### LOAD AND SAVE
+#############################################################################################
+
+def load_project(project_id):
+    """ Load a project, fetching only its shell; the components are fetched as they're used """
+    manifest = get_manifest(project_id)
+    if manifest is None: # Saved whole
+        return op.loadproj(redis.get(project_id), fromdb=True)
+
+    shell = op.loadstr(redis.get(manifest['shell']))
+    project = LazyProject.__new__(LazyProject)
+    project.__dict__.update(shell.__dict__)
+    project._projectstore = {'id': project_id, 'manifest': manifest, 'pending': set(components)}
+    if shell.version not in op.supported_versions or str(getattr(shell, 'revision', None)) != str(op.revision):
+        return op.loadproj(op.dumpstr(project), fromdb=True) # Migrations need the whole project
+    return project
+
+
+def save_project(project_id, project):
+    """
+    Save a project, writing only the shell and items that have changed. The components
+    that haven't been loaded are taken from the manifest in Redis, which is watched, so
+    if another process saves the project at the same time, this is tried again.
+    """
+    store = project.__dict__.get('_projectstore')
+    if store is not None and store['id'] != project_id: # Being saved as a different project, so needs all of it
+        load_all_components(project)
+        store = None
+
+    towrite = {}
+    entries = {}
+    blob = op.dumpstr(project_shell(project))
+    shell_key = make_key(project_id, 'shell', blob)
+    towrite[shell_key] = blob
+
+    for attr in components:
+        if not is_loaded(project, attr): # Can't have changed, so is taken from the current manifest below
+            continue
+        value = project.__dict__.get(attr)
+        if isinstance(value, op.odict):
+            entry = {'container': dump_item(empty_container(value), project), 'items': []}
+            for name, item in value.items():
+                blob = dump_item(item, project)
+                key = make_key(project_id, attr, blob)
+                entry['items'].append((name, key))
+                towrite[key] = blob
+        else:
+            blob = dump_item(value, project)
+            key = make_key(project_id, attr, blob)
+            entry = {'container': None, 'items': [(None, key)]}
+            towrite[key] = blob
+        entries[attr] = entry
+
+    manifest_key = 'project-%s-manifest' % project_id
+    for attempt in range(max_save_attempts):
+        pipe = redis.pipeline()
+        try:
+            pipe.watch(manifest_key)
+            manifest_blob = pipe.get(manifest_key)
+            oldmanifest = op.loadstr(manifest_blob) if manifest_blob is not None else None
+            if oldmanifest is None and store is not None:
+                oldmanifest = store['manifest'] # Deleted or converted in the meantime: the best there is
+            manifest = op.odict()
+            manifest['shell'] = shell_key
+            for attr in components:
+                manifest[attr] = entries[attr] if attr in entries else oldmanifest[attr]
+            oldkeys = manifest_keys(oldmanifest) if oldmanifest is not None else set()
+            newkeys = manifest_keys(manifest)
+
+            pipe.multi()
+            for key, blob in towrite.items():
+                if key not in oldkeys: # Otherwise, it's already there
+                    pipe.set(key, blob)
+            pipe.set(manifest_key, op.dumpstr(manifest))
+            stale_keys = oldkeys - newkeys # Only the manifest being replaced refers to these
+            if stale_keys:
+                pipe.delete(*stale_keys)
+            if manifest_blob is None:
+                pipe.delete(project_id) # Remove the old whole-project entry, if any
+            pipe.execute()
+            break
+        except WatchError: # Another process saved the project after the manifest was read
+            print(">> projectstore.save_project %s: saved by another process, trying again" % project_id)
+            continue
+        finally:
+            pipe.reset()
+    else:
+        raise op.OptimaException('Could not save project %s, since other processes kept saving it at the same time' % project_id)
+    print(">> projectstore.save_project %s: wrote %i of %i items" % (project_id, len(set(towrite) - oldkeys), len(towrite)))
+
+    if store is not None:
+        store['manifest'] = manifest
+    return None
+
+
+def delete_project(project_id):
+    manifest = get_manifest(project_id)
+    keys = list(manifest_keys(manifest)) if manifest is not None else []
+    redis.delete(project_id, 'project-%s-manifest' % project_id, *keys)
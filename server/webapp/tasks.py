@@ -1,10 +1,12 @@
 import traceback
 import pprint
+import time
+import threading
+from hashlib import md5
 from celery import Celery
 from celery.contrib.abortable import AbortableTask, AbortableAsyncResult
-from flask_sqlalchemy import SQLAlchemy
+from celery.signals import worker_process_init
 from sqlalchemy.orm import sessionmaker, scoped_session
-# import inspect # Use for debugging "too many clients already" FE error
 import optima as op
 
 
@@ -46,7 +48,8 @@ put on the celery queue.
 
 - in any async function, access to the db has to be carefully
   circumsribed. This is done through a paired call to
-  `init_db_session` and `close_db_session`
+  `init_db_session` and `close_db_session`, which take a
+  connection from the process's connection pool and give it back
 
 The function `run_task.delay` should not need to be run directly,
 and should be accessed through `launch_task`, which will
@@ -60,8 +63,9 @@ set up the worklog before running the task
 
 # must import api first
 from ..api import app
-from . import dbmodels, parse, dataio
-db = SQLAlchemy(app)
+from . import dbmodels, parse, dataio, dbconn, projectstore
+db = dbconn.db # Share the app's engine, and so its connection pool
+db_sessions = scoped_session(sessionmaker(bind=db.engine)) # One session per thread, reused between calls
 
 
 
@@ -98,24 +102,78 @@ def parse_work_log_record(work_log):
 
 
 
+@worker_process_init.connect
+def reset_db_pool(**kwargs):
+    """
+    Each Celery worker process is forked from the main one, so it needs its own
+    connections rather than copies of the parent's
+    """
+    db.engine.dispose()
+
+
 def init_db_session():
     """
-    Create scoped_session, eventually bound to engine
+    Returns the scoped_session for this thread, which uses the engine's connection pool
     """
-    # Use for debugging "too many clients already" FE error
-    # print(f"!! init_db_session called from:{inspect.currentframe().f_back.f_code.co_name}. Returning:{out}, status of out.bind.pool:{out.bind.pool.status()}")
-    return scoped_session(sessionmaker(db.engine))
+    return db_sessions
 
 
 def close_db_session(db_session):
-    # this line might be redundant (not 100% sure - not clearly described)
-
-    # Use for debugging "too many clients already" FE error
-    # print(f"!! close_db_session called with db_session:{db_session}, from:{inspect.currentframe().f_back.f_code.co_name}, status of db_session.bind.pool:{db_session.bind.pool.status()}")
-    db_session.connection().close() # pylint: disable=E1101
+    """
+    Closes the session, returning its connection to the pool (rather than
+    closing it, so the next call doesn't have to reconnect)
+    """
     db_session.remove()
-    # black magic to actually close the connection by forcing the engine to dispose of garbage (I assume)
-    db_session.bind.dispose() # pylint: disable=E1101
+
+
+def finite_or_none(value):
+    """ JSON can't hold NaN or infinity """
+    value = float(value)
+    return value if abs(value) < float('inf') else None
+
+
+class ProgressPublisher(object):
+    """
+    Passed to the optima functions as their progressfunc, to publish the progress of
+    a task to Redis for check_task, at most once every interval seconds. Keeps the
+    best objective and budget seen over all of the runs (e.g. optimizations from
+    different starting budgets).
+    """
+
+    def __init__(self, task_id, interval=2.0):
+        self.task_id = task_id
+        self.interval = interval
+        self.start = time.time()
+        self.last = 0
+        self.bestfval = None
+        self.bestbudget = None
+        self.lock = threading.Lock() # Chains of a multi-chain optimization run in threads
+
+    def __call__(self, info):
+        with self.lock:
+            fval = finite_or_none(info['fval'])
+            if fval is not None and (self.bestfval is None or fval < self.bestfval):
+                self.bestfval = fval
+                self.bestbudget = info.get('budget')
+            now = time.time()
+            if now - self.last < self.interval:
+                return
+            self.last = now
+            progress = {
+                'iteration': int(info['iteration']),
+                'maxiters': int(info['maxiters']),
+                'fval': fval,
+                'fvalorig': finite_or_none(info['fvalorig']),
+                'bestfval': self.bestfval,
+                'elapsed': now - self.start,
+                'label': info.get('label'),
+            }
+            for key in ['run', 'runind', 'nruns', 'block', 'nblocks', 'chain', 'nchains']:
+                if key in info:
+                    progress[key] = info[key]
+            if self.bestbudget is not None:
+                progress['budget'] = dict((str(name), finite_or_none(value)) for name, value in self.bestbudget.items())
+        dbmodels.save_task_progress(self.task_id, progress)
 
 
 def check_task(task_id):
@@ -140,6 +198,11 @@ def check_task(task_id):
             calc_state['status_string'] = 'Waiting to start...'
         else:
             calc_state['status_string'] = 'Running for %d seconds' % ((op.today()-work_log_record.start_time).seconds)
+            progress = dbmodels.load_task_progress(task_id)
+            if progress is not None:
+                calc_state['progress'] = progress
+                if progress['bestfval'] is not None:
+                    calc_state['status_string'] += ' (iteration %d, best objective %0.4g)' % (progress['iteration'], progress['bestfval'])
     elif calc_state['status'] == 'cancelled':
         calc_state['status_string'] = 'Job cancelled' # Probably won't get shown?
     elif calc_state['status'] == 'error':
@@ -197,6 +260,7 @@ def run_task(self, task_id, fn_name, args, kwargs=None):
 
     if fn_name in {'optimize','autofit'}:
         kwargs['stoppingfunc'] = self.is_aborted
+        kwargs['progressfunc'] = ProgressPublisher(task_id)
 
     try:
         task_fn(*args, **kwargs)
@@ -253,6 +317,8 @@ def launch_task(task_id, fn_name, args):
             print(">> launch_task cleanup %d logs" %  work_log_records.count())
             work_log_records.delete()
 
+        dbmodels.clear_task_progress(task_id) # From the last run
+
         # create a work_log status is 'started by default'
         print(">> launch_task new work log")
         work_log_record = dbmodels.WorkLogDb(task_id=task_id)
@@ -277,6 +343,7 @@ def cancel_task(task_id):
     celery_instance.control.revoke(str(work_log_record.id))
     res = AbortableAsyncResult(str(work_log_record.id), app=celery_instance)
     res.abort() # This triggers the WorkLogDb cleanup in run_task()
+    dbmodels.clear_task_progress(task_id)
     db_session.delete(work_log_record)
     db_session.commit()
     close_db_session(db_session)
@@ -295,7 +362,7 @@ def cancel_task(task_id):
 #   the `rpcService.runAsyncTask('launch_task')` interface
 
 
-def autofit(project_id, parset_id, maxtime, stoppingfunc=None):
+def autofit(project_id, parset_id, maxtime, stoppingfunc=None, progressfunc=None):
 
     db_session = init_db_session()
     project = dataio.load_project(project_id, db_session=db_session, authenticate=False)
@@ -312,6 +379,7 @@ def autofit(project_id, parset_id, maxtime, stoppingfunc=None):
         orig=orig_parset_name,
         maxtime=float(maxtime),
         stoppingfunc=stoppingfunc,
+        progressfunc=progressfunc,
     )
 
     result = project.parsets[autofit_parset_name].getresults()
@@ -345,7 +413,26 @@ def autofit(project_id, parset_id, maxtime, stoppingfunc=None):
     print("> autofit finish")
 
 
-def optimize(project_id, optimization_id, maxtime, stoppingfunc=None):
+def make_optim_checkpoint(project, optim, maxtime):
+    """
+    The checkpoint that an optimization saves its runs to as they go, so that if it's
+    relaunched after being interrupted (e.g. by a worker restart), it carries on from
+    there. The key covers the optimization settings and the parset and progset, so if
+    any of them change, the optimization starts again instead.
+    """
+    stamp = md5(op.dumpstr((optim.objectives, optim.getabsconstraints(), float(maxtime))))
+    store = project.__dict__.get('_projectstore')
+    for attr, name in [('parsets', optim.parsetname), ('progsets', optim.progsetname)]:
+        items = dict(store['manifest'][attr]['items']) if store is not None else {}
+        if name in items: # The hash of its contents when it was saved
+            stamp.update(projectstore.key_stamp(items[name]).encode())
+        else:
+            stamp.update(projectstore.dump_item(getattr(project, attr)[name], project))
+    prefix = 'optim-checkpoint-%s-%s-' % (optim.uid, stamp.hexdigest())
+    return op.Optimcheckpoint(dbmodels.CheckpointStore(), prefix=prefix, interval=30)
+
+
+def optimize(project_id, optimization_id, maxtime, stoppingfunc=None, progressfunc=None):
 
     db_session = init_db_session()
     project = dataio.load_project(project_id, db_session=db_session, authenticate=False)
@@ -370,10 +457,14 @@ def optimize(project_id, optimization_id, maxtime, stoppingfunc=None):
 
     print(">> optimize start")
     maxtime = float(maxtime)
+    if optim.objectives['which'] == 'money':
+        checkpoint = None # Money optimizations can't be resumed, so always start again
+    else:
+        checkpoint = make_optim_checkpoint(project, optim, maxtime)
     if maxtime>3600: mc = (12,6,6) # Arbitrary threshold for "unlimited" run: run with mc initiation
     else:            mc = (12,0,0) # No mc, just get through as many baseline budgets in the time
     # Notice, we have not modified the optim, so if the optim is from the BE, it will maintain its constraints, absconstraints and proporigconstraints
-    result = project.optimize(optim=optim, maxtime=maxtime, mc=mc, nchains=1, nblocks=1, parallel=False, stoppingfunc=stoppingfunc)  # Set this to zero for now while we decide how to handle uncertainties etc.
+    result = project.optimize(optim=optim, maxtime=maxtime, mc=mc, nchains=1, nblocks=1, parallel=False, stoppingfunc=stoppingfunc, progressfunc=progressfunc, checkpoint=checkpoint, resume=checkpoint is not None)  # Set this to zero for now while we decide how to handle uncertainties etc.
 
     print(">> optimize budgets %s" % result.budgets)
 
@@ -399,6 +490,8 @@ def optimize(project_id, optimization_id, maxtime, stoppingfunc=None):
     db_session.add(result_record)
     db_session.commit()
     close_db_session(db_session)
+    if checkpoint is not None:
+        checkpoint.clear() # Saved, so there's nothing to resume
 
     print(">> optimize finish")
 
@@ -0,0 +1,183 @@
+"""
+undostore.py
+============
+
+Stores the versions on a project's undo stack in Redis as a series of frames, each
+under its own key, undo-stack-frame-<hex>.
+
+A project version is split into parts: the project shell, and the container and
+each item (e.g. each parset) of every component. A frame lists the hash of every
+part of its version, but only holds the parts that changed since the frame before
+it. Every snapshot_interval frames, a snapshot frame holds all of the parts, so
+getting a version back never needs more than that many frames.
+"""
+
+import zlib
+from hashlib import md5
+
+import optima as op
+
+from .dbconn import redis
+from .projectstore import components, is_loaded, load_component, refresh_entries, dump_item, undump_item, empty_container, project_shell, key_stamp, restore_component_links
+
+
+snapshot_interval = 20
+
+
+#############################################################################################
+### PROJECT PARTS
+#############################################################################################
+
+def split_project(project):
+    """
+    Split a project into its parts. Returns an odict of part: hash, and a dict of
+    part: blob. The blobs of components that haven't been loaded from the project
+    store aren't made: instead, a third dict gives the Redis key they're stored at,
+    from the manifest now in Redis, in case another process has saved the project since.
+    """
+    hashes = op.odict()
+    blobs = {}
+    stored = {}
+    refresh_entries(project)
+
+    def add(part, blob):
+        hashes[part] = md5(blob).hexdigest()
+        blobs[part] = blob
+
+    add(('shell',), op.dumpstr(project_shell(project)))
+    for attr in components:
+        if not is_loaded(project, attr): # Use what the project store already has
+            entry = project._projectstore['manifest'][attr]
+            if entry['container'] is None:
+                part = (attr, 'value')
+                hashes[part] = key_stamp(entry['items'][0][1])
+                stored[part] = entry['items'][0][1]
+            else:
+                add((attr, 'container'), entry['container'])
+                for name, key in entry['items']:
+                    part = (attr, 'item', name)
+                    hashes[part] = key_stamp(key)
+                    stored[part] = key
+            continue
+        value = getattr(project, attr)
+        if isinstance(value, op.odict):
+            add((attr, 'container'), dump_item(empty_container(value), project))
+            for name, item in value.items():
+                add((attr, 'item', name), dump_item(item, project))
+        else:
+            add((attr, 'value'), dump_item(value, project))
+    return hashes, blobs, stored
+
+
+def join_project(parts):
+    """ Put a project back together from an odict of part: blob """
+    shell = op.loadstr(parts[('shell',)])
+    project = op.Project.__new__(op.Project)
+    project.__dict__.update(shell.__dict__)
+    for attr in components:
+        if (attr, 'value') in parts:
+            value = undump_item(parts[(attr, 'value')], project)
+        else:
+            value = undump_item(parts[(attr, 'container')], project)
+            for part, blob in parts.items():
+                if part[0] == attr and part[1] == 'item':
+                    op.odict.__setitem__(value, part[2], undump_item(blob, project))
+        restore_component_links(project, attr, value)
+        project.__dict__[attr] = value
+    return project
+
+
+#############################################################################################
+### FRAMES
+#############################################################################################
+
+def new_frame_key():
+    return 'undo-stack-frame-%s' % op.uuid().hex
+
+
+def make_frame(project, lasthashes=None):
+    """
+    Make the frame for a project version. If the hashes of the version before it
+    are given, the frame only holds the parts that have changed since; otherwise,
+    it's a snapshot. Returns the frame and the hashes of this version.
+    """
+    hashes, blobs, stored = split_project(project)
+    if lasthashes is None:
+        changed = list(hashes.keys())
+    else:
+        changed = [part for part, stamp in hashes.items() if lasthashes.get(part) != stamp]
+    fetch = [part for part in changed if part in stored]
+    if fetch:
+        fetched = redis.mget([stored[part] for part in fetch])
+        missing = set(part[0] for part, blob in zip(fetch, fetched) if blob is None)
+        if missing: # Saved by another process since the manifest was read: load these components instead
+            for attr in missing:
+                load_component(project, attr)
+            return make_frame(project, lasthashes)
+        blobs.update(zip(fetch, fetched))
+    frame = {'snapshot': lasthashes is None,
+             'hashes': hashes,
+             'blobs': dict((part, blobs[part]) for part in changed)}
+    return frame, hashes
+
+
+def dump_frame(frame):
+    return zlib.compress(op.dumpstr(frame))
+
+
+def undump_frame(blob):
+    return op.loadstr(zlib.decompress(blob))
+
+
+def load_version(keys, pending=None):
+    """
+    Replay frames, from a snapshot to the frame of the version wanted, to get the
+    project version. Frames not yet written to Redis are taken from pending.
+    Returns the project and its hashes.
+    """
+    if pending is None: pending = {}
+    tofetch = [key for key in keys if key not in pending]
+    fetched = dict(zip(tofetch, redis.mget(tofetch))) if tofetch else {}
+    blobs = {}
+    for key in keys:
+        if key in pending:
+            frame = pending[key]
+        elif fetched[key] is not None:
+            frame = undump_frame(fetched[key])
+        else:
+            raise op.OptimaException('Undo stack frame %s is missing' % key)
+        blobs.update(frame['blobs'])
+    hashes = frame['hashes']
+    parts = op.odict((part, blobs[part]) for part in hashes.keys())
+    print(">> undostore.load_version replayed %i frames" % len(keys))
+    return join_project(parts), hashes
+
+
+#############################################################################################
+### STACKS
+#############################################################################################
+
+def save_stack(key, stack):
+    """ Write the frames pushed since the stack was loaded, delete the dropped ones, and save the stack itself """
+    pipe = redis.pipeline()
+    for framekey, frame in stack.pendingFrames.items():
+        if framekey in stack.frameKeys:
+            pipe.set(framekey, dump_frame(frame))
+    if stack.staleFrameKeys:
+        pipe.delete(*stack.staleFrameKeys)
+    pipe.set(key, op.dumpstr(stack))
+    pipe.execute()
+    stack.pendingFrames.clear()
+    del stack.staleFrameKeys[:]
+    return None
+
+
+def load_stack(key):
+    blob = redis.get(key)
+    return op.loadstr(blob) if blob is not None else None
+
+
+def delete_stack(key):
+    stack = load_stack(key)
+    framekeys = getattr(stack, 'frameKeys', [])
+    redis.delete(key, *framekeys)
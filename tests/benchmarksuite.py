@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+"""
+BENCHMARKSUITE
+
+Time the hot paths of Optima -- the model at several population counts, makesimpars, Resultset.make, outcomecalc, a
+short minoutcomes, getpars and the geospatial allocation -- and compare them against a stored baseline.
+
+As well as the demo projects, the model is timed on copies of the concentrated project with every population
+duplicated 2, 4 and 8 times (model-scaling-x2 etc), and the model times are reported against the number of
+populations, with the exponent of a power law fitted to them.
+
+Each benchmark is run nrepeats times (after one untimed run), and the times are normalized by a CPU micro-benchmark,
+as in benchmarkmodel.py, so results from different machines are roughly comparable. The results are saved as JSON to
+outputfile. If a baseline exists, each benchmark's normalized times are compared to it with a one-sided Mann-Whitney U
+test: it counts as slower (or faster) only if the difference is both significant (p < alpha) and bigger than
+tolerance. The script exits with status 1 if anything got slower, so it can be used in CI.
+
+Usage:
+    python benchmarksuite.py                 # Run all benchmarks and compare against the baseline
+    python benchmarksuite.py model-simple    # Run only the named benchmarks
+    python benchmarksuite.py --savebaseline  # Run, then store the results as the new baseline
+
+Version: 2026oct18
+"""
+
+## Define benchmarks to run here!!!
+benchmarks = [
+'model-simple',
+'model-concentrated',
+'model-generalized',
+'model-scaling-x2',
+'model-scaling-x4',
+'model-scaling-x8',
+'makesimpars',
+'resultsetmake',
+'outcomecalc',
+'minoutcomes',
+'getpars',
+'gaallocate',
+]
+
+n_benchmark = 10 # Number of times to run the CPU benchmark
+nrepeats = 7 # Number of timed runs of each benchmark
+outputfile = 'benchmarkresults.json'
+baselinefile = 'benchmarkbaseline.json'
+savebaseline = False # Whether to store these results as the new baseline
+alpha = 0.05 # Significance level for the comparison
+tolerance = 0.10 # Changes smaller than this fraction of the baseline median aren't reported
+failonregression = True # Exit with status 1 if any benchmark got slower
+
+
+import sys
+import json
+import timeit
+import platform
+from time import perf_counter
+from numpy import array, median, percentile, linspace, concatenate, kron, eye, log, polyfit
+from scipy.stats import mannwhitneyu
+import optima as op
+
+args = sys.argv[1:]
+if '--savebaseline' in args:
+    savebaseline = True
+    args.remove('--savebaseline')
+if args: benchmarks = args
+
+
+
+############################################################################################################################
+## Benchmarks -- each one does its setup, then returns the function to time
+############################################################################################################################
+
+def cpubenchmark():
+    ''' Same as in benchmarkmodel.py: millions of loop iterations per second '''
+    elapsed = timeit.timeit(lambda: [0+tmp for tmp in range(int(1e6))], number=n_benchmark)
+    return n_benchmark/elapsed
+
+
+projects = {}
+def getproject(which):
+    ''' Make each default project only once '''
+    if which not in projects: projects[which] = op.defaultproject(which, dorun=False, verbose=0)
+    return projects[which]
+
+
+def copypops(pars, ncopies):
+    '''
+    Duplicate every population ncopies times (the copies of FSW are FSW-2, FSW-3, etc), to time the model with more
+    populations than the demo projects have. Each copy only has partnerships and transitions within itself, so it's
+    the same epidemic ncopies times over, but the model does all the work for each population.
+    '''
+    popkeys = list(pars['popkeys'])
+    def copykey(key, c):
+        if isinstance(key, tuple): return tuple(copykey(k, c) for k in key)
+        elif key in popkeys and c>1: return '%s-%i' % (key, c)
+        else: return key
+    for key in ['male', 'female', 'age', 'injects']: pars[key] = concatenate([pars[key]]*ncopies)
+    for key in ['risktransit', 'agetransit', 'birthtransit']: pars[key] = kron(eye(ncopies), pars[key])
+    pars['popkeys'] = [copykey(key, c) for c in range(1, ncopies+1) for key in popkeys]
+    pars['fromto'], pars['transmatrix'] = op.loadtranstable(npops=len(pars['popkeys'])) # As in makepars()
+    for par in pars.values():
+        if not isinstance(par, op.Par): continue
+        for attr in vars(par).values(): # E.g. y, t, prior and start, where they're keyed by population
+            if not isinstance(attr, dict) or not any(key in popkeys or isinstance(key, tuple) for key in attr.keys()): continue
+            origkeys = list(attr.keys())
+            for c in range(2, ncopies+1):
+                for key in origkeys:
+                    if copykey(key, c)!=key: attr[copykey(key, c)] = op.dcp(attr[key]) # Not e.g. 'tot'
+    for key in ['numtx', 'numpmtct', 'numost', 'numvlmon']: # Numbers for the total population, so there's enough for every copy
+        if key in pars: pars[key].y['tot'] = pars[key].y['tot']*ncopies
+    return pars
+
+
+def modelbenchmark(which, ncopies=1):
+    P = getproject(which)
+    pars = copypops(op.dcp(P.pars()), ncopies) if ncopies>1 else P.pars()
+    simpars = op.makesimpars(pars, settings=P.settings, projectversion=P.version, verbose=0)
+    info = {'npops': len(pars['popkeys'])}
+    return (lambda: op.model(simpars, settings=P.settings, version=P.version, verbose=0)), info
+
+
+def makesimparsbenchmark():
+    P = getproject('concentrated')
+    return (lambda: op.makesimpars(P.pars(), settings=P.settings, projectversion=P.version, verbose=0)), {}
+
+
+def resultsetmakebenchmark():
+    P = getproject('concentrated')
+    raw = P.runsim(keepraw=True, addresult=False, verbose=0).raw
+    R = op.Resultset(raw=raw, pars=P.pars(), project=P, domake=False)
+    return (lambda: R.make(raw, verbose=0)), {}
+
+
+def getbudgetvec(P):
+    budget = P.progset().getdefaultbudget()
+    return array([budget[key] for key,program in P.progset().programs.items() if program.optimizable()])
+
+
+def outcomecalcbenchmark():
+    P = getproject('concentrated')
+    objectives = op.defaultobjectives(project=P, verbose=0)
+    budgetvec = getbudgetvec(P)
+    return (lambda: op.outcomecalc(budgetvec=budgetvec, project=P, objectives=objectives, doconstrainbudget=False, outcomecache=False, verbose=0)), {}
+
+
+def minoutcomesbenchmark():
+    from optima.optimization import minoutcomes
+    P = getproject('concentrated')
+    optim = op.Optim(project=P)
+    tvec = P.settings.maketvec(end=optim.objectives['end'])
+    return (lambda: minoutcomes(project=P, optim=optim, tvec=tvec, maxiters=5, mc=0, parallel=False, randseed=1, verbose=0)), {'maxiters': 5}
+
+
+def getparsbenchmark():
+    P = getproject('concentrated')
+    coverage = P.progset().getdefaultcoverage(t=2020, parset=P.parset())
+    return (lambda: P.progset().getpars(coverage=coverage, t=2020, parset=P.parset(), verbose=0)), {}
+
+
+def gaallocatebenchmark():
+    ''' The allocation step of Portfolio.runGA(), with synthetic BOCs for 20 regions -- the rest of runGA() is optimizations '''
+    nregions, npts = 20, 2000
+    grandtotal = 50e6
+    relspendvecs = []
+    relimprovevecs = []
+    for r in range(nregions):
+        spend = linspace(1, grandtotal, npts)[1:]
+        relspendvecs.append(spend)
+        relimprovevecs.append((1+r%5)*1e3*(1-1/(1+spend/(5e5*(1+r)))))
+    from optima.portfolio import gaallocate
+    return (lambda: gaallocate(relspendvecs=relspendvecs, relimprovevecs=relimprovevecs, grandtotal=grandtotal, verbose=0)), {'nregions':nregions, 'npts':npts}
+
+
+allbenchmarks = op.odict([
+    ('model-simple',       lambda: modelbenchmark('simple')),
+    ('model-concentrated', lambda: modelbenchmark('concentrated')),
+    ('model-generalized',  lambda: modelbenchmark('generalized')),
+    ('model-scaling-x2',   lambda: modelbenchmark('concentrated', ncopies=2)),
+    ('model-scaling-x4',   lambda: modelbenchmark('concentrated', ncopies=4)),
+    ('model-scaling-x8',   lambda: modelbenchmark('concentrated', ncopies=8)),
+    ('makesimpars',        makesimparsbenchmark),
+    ('resultsetmake',      resultsetmakebenchmark),
+    ('outcomecalc',        outcomecalcbenchmark),
+    ('minoutcomes',        minoutcomesbenchmark),
+    ('getpars',            getparsbenchmark),
+    ('gaallocate',         gaallocatebenchmark),
+])
+
+
+
+############################################################################################################################
+## Run the benchmarks
+############################################################################################################################
+
+for name in benchmarks:
+    if name not in allbenchmarks: raise Exception('Benchmark "%s" not recognized: choices are %s' % (name, allbenchmarks.keys()))
+
+T = op.tic()
+performance1 = cpubenchmark()
+gitbranch, gitversion = op.gitinfo()
+output = op.odict()
+output['created'] = op.getdate(op.today())
+output['gitbranch'] = gitbranch
+output['gitversion'] = gitversion
+output['python'] = platform.python_version()
+output['machine'] = platform.machine()
+output['results'] = op.odict()
+
+for name in benchmarks:
+    print('Benchmarking %s...' % name)
+    func, info = allbenchmarks[name]()
+    func() # Untimed run, e.g. to fill caches or compile
+    times = []
+    for r in range(nrepeats):
+        start = perf_counter()
+        func()
+        times.append(perf_counter()-start)
+    result = op.odict(info)
+    result['times'] = times
+    result['median'] = median(times)
+    result['iqr'] = percentile(times, 75) - percentile(times, 25)
+    output['results'][name] = result
+    print('  %0.4f s (median of %i, IQR %0.4f s)' % (result['median'], nrepeats, result['iqr']))
+
+performance2 = cpubenchmark()
+output['cpubenchmark'] = (performance1+performance2)/2. # Find average of before and after
+for result in output['results'].values():
+    result['normtimes'] = [time*output['cpubenchmark'] for time in result['times']] # In units of CPU benchmark iterations (millions)
+    result['normmedian'] = median(result['normtimes'])
+
+# How the model time scales with the number of populations
+scaling = sorted((result['npops'], result['median']) for name,result in output['results'].items() if name.startswith('model-'))
+if len(set(npops for npops,t in scaling))>1:
+    exponent = polyfit(log([npops for npops,t in scaling]), log([t for npops,t in scaling]), 1)[0] # Time ~ npops**exponent
+    output['scaling'] = op.odict([('npops', [npops for npops,t in scaling]), ('median', [t for npops,t in scaling]), ('exponent', exponent)])
+    print('\nModel time against the number of populations:')
+    print('%10s %10s %12s' % ('npops', 'time (s)', 'per pop (ms)'))
+    for npops,t in scaling: print('%10i %10.4f %12.2f' % (npops, t, 1e3*t/npops))
+    print('Fitted exponent: %0.2f (1 would be linear in the number of populations)' % exponent)
+
+
+
+############################################################################################################################
+## Compare against the baseline
+############################################################################################################################
+
+try:
+    with open(baselinefile) as f: baseline = json.load(f)
+except (IOError, OSError):
+    baseline = None
+    print('No baseline found in %s: not comparing' % baselinefile)
+
+regressions = []
+if baseline is not None:
+    output['baseline'] = op.odict([('created', baseline.get('created')), ('gitversion', baseline.get('gitversion'))])
+    print('\nComparison with baseline %s (%s):' % (str(baseline.get('gitversion'))[:7], baseline.get('created')))
+    print('%20s %10s %10s %8s %8s  %s' % ('benchmark', 'baseline', 'now', 'ratio', 'p', 'status'))
+    for name,result in output['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            result['comparison'] = None
+            continue
+        ratio = result['normmedian']/base['normmedian']
+        pslower = mannwhitneyu(result['normtimes'], base['normtimes'], alternative='greater').pvalue
+        pfaster = mannwhitneyu(result['normtimes'], base['normtimes'], alternative='less').pvalue
+        if   pslower<alpha and ratio>1+tolerance: status, pvalue = 'slower', pslower
+        elif pfaster<alpha and ratio<1-tolerance: status, pvalue = 'faster', pfaster
+        else:                                     status, pvalue = 'same',   min(pslower, pfaster)
+        if status=='slower': regressions.append(name)
+        result['comparison'] = op.odict([('ratio',ratio), ('pvalue',pvalue), ('status',status)])
+        print('%20s %10.3f %10.3f %8.2f %8.3f  %s' % (name, base['normmedian'], result['normmedian'], ratio, pvalue, status))
+    output['regressions'] = regressions
+
+def tojson(obj):
+    ''' Convert odicts and NumPy numbers for saving '''
+    if isinstance(obj, dict): return dict((key, tojson(value)) for key,value in obj.items())
+    if isinstance(obj, (list, tuple)): return [tojson(value) for value in obj]
+    if hasattr(obj, 'item'): return obj.item()
+    return obj
+
+with open(outputfile, 'w') as f: json.dump(tojson(output), f, indent=2)
+print('\nResults saved to %s' % outputfile)
+if savebaseline:
+    with open(baselinefile, 'w') as f: json.dump(tojson(output), f, indent=2)
+    print('Baseline saved to %s' % baselinefile)
+
+op.toc(T)
+if regressions:
+    print('WARNING: slower than the baseline: %s' % ', '.join(regressions))
+    if failonregression: sys.exit(1)
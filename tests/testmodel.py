@@ -16,6 +16,8 @@ Version: 2016feb06 by cliffk
 tests = [
 'force',
 'treatment',
+'batch',
+'engine',
 ]
 
 
@@ -100,5 +102,47 @@ if 'treatment' in tests:
 
 
 
+## Batched model test
+if 'batch' in tests:
+    t = tic()
+
+    print('Running batched model test...')
+    from optima import Project, makesimpars, model, batchmodel
+    from numpy import allclose
+    
+    P = Project(spreadsheet='simple.xlsx')
+    simparslist = [makesimpars(P.pars(), settings=P.settings, sample='new', randseed=seed) for seed in range(3)]
+    raws = batchmodel(simparslist, settings=P.settings, version=P.version)
+    for simpars,raw in zip(simparslist, raws):
+        single = model(simpars, settings=P.settings, version=P.version)
+        assert allclose(single['people'], raw['people'], rtol=1e-6), 'Batched and single runs differ'
+    
+    done(t)
+
+
+
+## Compiled model engine test
+if 'engine' in tests:
+    t = tic()
+
+    print('Running model engine test...')
+    from optima import defaultproject
+    import optima.modelkernels as kernels
+    from numpy import allclose
+    
+    P = defaultproject('generalized', dorun=False)
+    orig = P.runsim(keepraw=True, engine='numpy')
+    realhasjit = kernels.hasjit
+    kernels.hasjit = True # Without Numba, the kernels just run as Python: slow, but should give the same results
+    try:     jit = P.runsim(keepraw=True, engine='jit')
+    finally: kernels.hasjit = realhasjit
+    for key in ['people', 'inci', 'incibypop', 'births', 'mtct', 'pmtct', 'diag']:
+        assert allclose(orig.raw[0][key], jit.raw[0][key], rtol=1e-6, atol=1e-6), 'Engines differ for %s' % key
+    
+    done(t)
+
+
+
+
 print('\n\n\nDONE: ran %i tests' % len(tests))
 toc(T)
\ No newline at end of file
@@ -11,6 +11,11 @@ Version: 2019oct14
 ## Define tests to run here!!!
 tests = [
 'minimizeoutcomes',
+'leanoutcomes',
+'batchoutcomes',
+'outcomecache',
+'progress',
+'checkpoint',
 # 'multichain',
 # 'investmentstaircase',
 #'minimizemoney',
@@ -197,5 +202,125 @@ if 'meet909090' in tests:
     done(t)
 
 
+## Check that the objective is the same whether or not the full results are made
+if 'leanoutcomes' in tests:
+    t = tic()
+
+    print('Running lean outcomes test...')
+    from optima import defaultobjectives, outcomecalc, objectiveoutcomekeys
+    from numpy import array_equal
+    
+    P = defaultproject('best', dorun=False)
+    objectives = defaultobjectives(project=P)
+    fastoutcome = outcomecalc(project=P, objectives=objectives, outputresults=False)
+    fullresults = outcomecalc(project=P, objectives=objectives, outputresults=True)
+    assert fastoutcome == fullresults.outcome, 'Objective differs without Resultset: %s vs. %s' % (fastoutcome, fullresults.outcome)
+    
+    outcomes = P.runsim(addresult=False, outcomekeys=objectiveoutcomekeys)
+    results = P.runsim(addresult=False)
+    for key in objectiveoutcomekeys:
+        assert array_equal(outcomes[key], results.main[key].tot[0]), 'Outcome %s differs without Resultset' % key
+    
+    done(t)
+
+
+## Check that running the models for several budgets together gives the same objectives
+if 'batchoutcomes' in tests:
+    t = tic()
+
+    print('Running batch outcomes test...')
+    from optima import defaultobjectives, outcomecalc, batchoutcomecalc, asd, batchevaluator
+    from numpy import allclose, array
+    
+    P = defaultproject('best', dorun=False)
+    objectives = defaultobjectives(project=P)
+    budget = P.progset().getdefaultbudget()
+    budgetvec = array([budget[key] for key,program in P.progset().programs.items() if program.optimizable()])
+    budgetvecs = [budgetvec*factor for factor in [0.8, 1.0, 1.2]]
+    single = [outcomecalc(budgetvec=vec, project=P, objectives=objectives, doconstrainbudget=False) for vec in budgetvecs]
+    batch = batchoutcomecalc(budgetvecs=budgetvecs, project=P, objectives=objectives, doconstrainbudget=False)
+    assert allclose(single, batch, rtol=1e-9), 'Batched objectives differ: %s vs. %s' % (single, batch)
+    
+    args = {'project':P, 'objectives':objectives, 'totalbudget':budgetvec.sum()}
+    res = asd(outcomecalc, budgetvec, args=args, popsize=3, evaluator=batchevaluator, maxiters=5, randseed=1)
+    assert res.fval <= res.details.fvals[0] and len(res.details.xvals)==len(res.details.fvals)
+    
+    done(t)
+
+
+
+
+## Outcome cache test
+if 'outcomecache' in tests:
+    t = tic()
+
+    print('Running outcome cache test...')
+    from optima import defaultobjectives, outcomecalc, batchoutcomecalc, Outcomecache
+    from numpy import array
+    import pickle
+    import os
+    
+    P = defaultproject('best', dorun=False)
+    objectives = defaultobjectives(project=P)
+    budget = P.progset().getdefaultbudget()
+    budgetvec = array([budget[key] for key,program in P.progset().programs.items() if program.optimizable()])
+    cache = Outcomecache(maxsize=2)
+    args = {'project':P, 'objectives':objectives, 'doconstrainbudget':False, 'outcomecache':cache}
+    first = outcomecalc(budgetvec=budgetvec, **args)
+    again = outcomecalc(budgetvec=budgetvec+1e-4, **args) # Rounds to the same budget
+    assert first==again and cache.hits==1 and cache.misses==1, cache
+    batch = batchoutcomecalc(budgetvecs=[budgetvec, budgetvec*0.9, budgetvec*1.1], **args)
+    assert batch[0]==first and len(cache.cache)==2, cache # Only the last two are kept
+    assert pickle.loads(pickle.dumps(cache)) is cache # Each process keeps its own copy
+    hits, misses = cache.hits, cache.misses
+    cache.addstats((-1, 5, 7)) # Lookups by the copy in another process...
+    cache.addstats((os.getpid(), 5, 7)) # ... but not in this one, since they're already counted
+    assert cache.hits==hits+5 and cache.misses==misses+7, cache
+    
+    done(t)
+
+
+
+## Progress reporting test
+if 'progress' in tests:
+    t = tic()
+
+    print('Running progress test...')
+    
+    P = defaultproject('best', dorun=False)
+    progress = []
+    P.optimize(name='progress', maxtime=3, mc=(2,0,0), parallel=False, randseed=1, progressfunc=progress.append)
+    assert progress and all(info.runind in [1,2] and info.nruns==2 for info in progress)
+    best = progress[-1]
+    assert best.fval <= best.fvalorig and abs(sum(best.budget[:]) - sum(P.results[-1].budgets['Optimized'][:])) < 1, best
+    
+    done(t)
+
+
+
+## Checkpoint and resume test
+if 'checkpoint' in tests:
+    t = tic()
+
+    print('Running checkpoint test...')
+    from numpy import array, allclose
+    import tempfile, shutil
+    
+    P = defaultproject('best', dorun=False)
+    kwargs = dict(maxtime=100, maxiters=20, mc=(2,0,0), parallel=False, randseed=3)
+    uninterrupted = P.optimize(name='checkpoint', **kwargs)
+    folder = tempfile.mkdtemp()
+    calls = []
+    def stoppingfunc(): # Interrupt the first run partway through
+        calls.append(1)
+        return len(calls)==8
+    P.optimize(name='checkpoint', checkpoint=folder, stoppingfunc=stoppingfunc, **kwargs)
+    resumed = P.optimize(name='checkpoint', resume=folder, **kwargs)
+    shutil.rmtree(folder)
+    assert allclose(array(uninterrupted.budgets['Optimized'][:], dtype=float), array(resumed.budgets['Optimized'][:], dtype=float))
+    
+    done(t)
+
+
 print('\n\n\nDONE: ran %i tests' % len(tests))
 toc(T)
\ No newline at end of file
@@ -19,6 +19,7 @@ tests = [
 'addpopfactor',
 #'plotprogram',
 'compareoutcomes',
+'getoutcomes',
 #'reconcilepars',
 ]
 
@@ -156,6 +157,7 @@ if 'addpopfactor' in tests:
     
     print(cov1)
     print(cov2)
+    assert cov1[0] != cov2[0] # The compiled cost-coverage curves are rebuilt when the parameters change in place
     
 
 
@@ -189,6 +191,31 @@ if 'compareoutcomes' in tests:
 
 
 
+## Check that the compiled program effects are rebuilt when the programs change
+if 'getoutcomes' in tests:
+    t = tic()
+    import optima as op
+    P = op.defaultproject('best', dorun=False)
+    ps = P.progset()
+    coverage = ps.getdefaultcoverage(t=2016, parset=P.parset())
+    outcomes1 = ps.getoutcomes(coverage=op.dcp(coverage), t=2016, parset=P.parset())
+    outcomes2 = ps.getoutcomes(coverage=op.dcp(coverage), t=2016, parset=P.parset()) # Uses the cached effects
+    for partype in outcomes1.keys():
+        for pop in outcomes1[partype].keys():
+            assert_allclose(outcomes1[partype][pop], outcomes2[partype][pop])
+    
+    # With no coverage the outcomes are the intercepts: halve one of them in place
+    nocoverage = op.odict([(key, 0.) for key in coverage.keys()])
+    outcomes3 = ps.getoutcomes(coverage=nocoverage, t=2016, parset=P.parset())
+    partype, pop = [(partype, pop) for partype in outcomes3.keys() for pop in outcomes3[partype].keys() if partype not in P.parset().getcovpars() and outcomes3[partype][pop] is not None and outcomes3[partype][pop].all()][0]
+    ccopars = ps.covout[partype][pop].ccopars
+    ccopars['intercept'] = [(0.5*low, 0.5*high) for low,high in ccopars['intercept']]
+    outcomes4 = ps.getoutcomes(coverage=nocoverage, t=2016, parset=P.parset())
+    assert_allclose(outcomes4[partype][pop], 0.5*outcomes3[partype][pop])
+    done(t)
+
+
+
 # Reconciliation test
 if 'reconcilepars' in tests:
     import optima as op
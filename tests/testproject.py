@@ -20,6 +20,8 @@ tests = [
 'parametercheck',
 #'resultsaddition',
 #'saveload',
+'binarysaveload',
+'mappedraw',
 'loadspreadsheet',
 #'loadeconomics',
 'runsim'
@@ -169,6 +171,60 @@ if 'saveload' in tests:
 
 
 
+## Memory-mapped raw results test
+if 'mappedraw' in tests:
+    t = tic()
+    print('Running memory-mapped raw results test...')
+    
+    from optima import defaultproject, Mappedraw, Mappedarray, clearrawcache, dcp, dumpstr, loadstr
+    from numpy import array_equal, ndarray
+    
+    P = defaultproject('simple', dorun=False)
+    P.settings.rawcache = True
+    P.runsim(keepraw=True)
+    R = P.results[-1]
+    assert isinstance(R.raw[0], Mappedraw)
+    people = R.raw[0].unmap()['people']
+    R.mapraw(minsize=0) # Map everything, however small
+    assert isinstance(R.raw[0].stored()['people'], Mappedarray)
+    assert array_equal(R.raw[0]['people'], people)
+    for S in [dcp(R), loadstr(dumpstr(R))]: # Only the filenames are copied
+        assert isinstance(S.raw[0].stored()['people'], Mappedarray)
+        assert array_equal(S.raw[0]['people'], people)
+    R.unmapraw()
+    assert type(R.raw[0]['people'])==ndarray
+    clearrawcache(P)
+    assert array_equal(R.raw[0]['people'], people)
+    
+    done(t)
+
+
+
+## Binary save/load test
+if 'binarysaveload' in tests:
+    t = tic()
+    print('Running binary save/load test...')
+    
+    from optima import defaultproject, loadproj, isbinaryfile
+    from numpy import array_equal
+    from os import remove
+    filename = 'testproject.prj'
+    
+    P = defaultproject('simple', dorun=False)
+    P.runsim(keepraw=True)
+    for compression in [None, 'zlib']:
+        P.save(filename, saveresults=True, binary=True, compression=compression)
+        assert isbinaryfile(filename)
+        Q = loadproj(filename)
+        assert array_equal(Q.results[-1].raw[0]['people'], P.results[-1].raw[0]['people'])
+        Q.results[-1].raw[0]['people'][0,0,0] += 1 # Mapped arrays can still be changed
+    Q.save(filename, saveresults=True, binary=True) # Including over the file they're mapped from
+    remove(filename)
+    
+    done(t)
+
+
+
 
 ## Load spreadsheet test
 if 'loadspreadsheet' in tests:
@@ -0,0 +1,198 @@
+"""
+Test the project store used by the server (server/webapp/projectstore.py), and the undo
+stack frames made from it (undostore.py), with an in-memory stand-in for Redis, so it
+needs the server's requirements but no Redis server.
+
+The main thing to check is that processes which have the same project loaded (e.g. a
+web request and a Celery task) don't lose each other's changes, or the project, when
+they save it.
+
+Version: 2026oct18
+"""
+
+
+
+## Define tests to run here!!!
+tests = [
+'saveload',
+'concurrentsave',
+'interleavedsave',
+'undoframe',
+]
+
+
+##############################################################################
+## Initialization -- same for every test script
+##############################################################################
+
+from optima import tic, toc, blank, pd # analysis:ignore
+
+if 'doplot' not in locals(): doplot = True
+
+def done(t=0):
+    print('Done.')
+    toc(t)
+    blank()
+
+blank()
+print('Running tests:')
+for i,test in enumerate(tests): print(('%i.  '+test) % (i+1))
+blank()
+
+T = tic()
+
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.pardir)) # For the server package
+import optima as op
+from redis.exceptions import WatchError
+from server.webapp import projectstore, undostore
+
+
+class FakeRedis(object):
+    ''' The Redis commands used by the project store, in memory. Functions in beforeexecute are run (once) just before the next transaction is executed. '''
+
+    def __init__(self):
+        self.data = {}
+        self.versions = {} # Incremented whenever a key is written, for WATCH
+        self.beforeexecute = []
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def delete(self, *keys):
+        for key in keys:
+            if key in self.data:
+                del self.data[key]
+                self.versions[key] = self.versions.get(key, 0) + 1
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.watched = {}
+        self.commands = []
+
+    def watch(self, *keys):
+        for key in keys: self.watched[key] = self.redis.versions.get(key, 0)
+
+    def get(self, key):
+        return self.redis.get(key)
+
+    def multi(self):
+        pass
+
+    def set(self, key, value, ex=None):
+        self.commands.append(('set', (key, value)))
+
+    def delete(self, *keys):
+        self.commands.append(('delete', keys))
+
+    def execute(self):
+        while self.redis.beforeexecute: self.redis.beforeexecute.pop(0)()
+        try:
+            for key, version in self.watched.items():
+                if self.redis.versions.get(key, 0) != version: raise WatchError('Watched key %s changed' % key)
+            for command, args in self.commands: getattr(self.redis, command)(*args)
+        finally:
+            self.reset()
+
+    def reset(self):
+        self.watched = {}
+        self.commands = []
+
+
+def newstore():
+    ''' Start again with an empty Redis, holding one project '''
+    projectstore.redis = undostore.redis = FakeRedis()
+    P = op.defaultproject('simple', dorun=False, verbose=0)
+    projectstore.save_project('abc', P)
+    return P
+
+
+##############################################################################
+## The tests
+##############################################################################
+
+
+## Save and load a project
+if 'saveload' in tests:
+    t = tic()
+    P = newstore()
+    A = projectstore.load_project('abc')
+    assert A.parsets.keys() == P.parsets.keys()
+    assert A.scens.keys() == P.scens.keys()
+    done(t)
+
+
+
+## Two processes save the project one after the other, each having changed a different component
+if 'concurrentsave' in tests:
+    t = tic()
+    newstore()
+    A = projectstore.load_project('abc') # E.g. an optimization task
+    A.parsets[0].name = 'changed by A'
+    B = projectstore.load_project('abc') # E.g. a web request
+    B.scens[0].name = 'changed by B' # So its old key is deleted when B saves
+    projectstore.save_project('abc', B)
+    projectstore.save_project('abc', A)
+
+    C = projectstore.load_project('abc')
+    assert C.parsets[0].name == 'changed by A'
+    assert C.scens[0].name == 'changed by B' # Not lost, or missing, when A saved
+    assert A.scens[0].name == 'changed by B' # A loads the scenarios B saved
+    for key in projectstore.manifest_keys(projectstore.get_manifest('abc')):
+        assert projectstore.redis.get(key) is not None
+    done(t)
+
+
+
+## Another process saves the project while this one is saving it
+if 'interleavedsave' in tests:
+    t = tic()
+    newstore()
+    A = projectstore.load_project('abc')
+    A.parsets[0].name = 'changed by A'
+    B = projectstore.load_project('abc')
+    B.scens[0].name = 'changed by B' # So its old key is deleted when B saves
+    projectstore.redis.beforeexecute.append(lambda: projectstore.save_project('abc', B)) # Saved after A reads the manifest
+    projectstore.save_project('abc', A)
+
+    C = projectstore.load_project('abc')
+    assert C.parsets[0].name == 'changed by A'
+    assert C.scens[0].name == 'changed by B'
+    done(t)
+
+
+
+## Make an undo stack frame of a project that another process has saved since it was loaded
+if 'undoframe' in tests:
+    t = tic()
+    newstore()
+    A = projectstore.load_project('abc')
+    A.parsets[0].name = 'changed by A'
+    B = projectstore.load_project('abc')
+    B.scens[0].name = 'changed by B' # So its old key is deleted when B saves
+    projectstore.save_project('abc', B) # Deletes the key of the scenario A would have used
+    frame, hashes = undostore.make_frame(A)
+    framekey = undostore.new_frame_key()
+    C, hashes = undostore.load_version([framekey], pending={framekey: frame})
+    assert C.parsets[0].name == 'changed by A'
+    assert C.scens[0].name == 'changed by B'
+    done(t)
+
+
+
+print('\n\n\nDONE: ran %i tests' % len(tests))
+toc(T)
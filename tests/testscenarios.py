@@ -14,6 +14,7 @@ tests = [
 #'sensitivity',
 #'VMMC',
 #'newcascade'
+'branch',
 ]
 
 ##############################################################################
@@ -407,6 +408,36 @@ if 'budget' in tests:
 
 
 
+## Test that scenarios started from a snapshot of an earlier one give the same results as full runs
+if 'branch' in tests:
+    t = tic()
+
+    print('Running scenario branching test...')
+    from optima import Parscen, defaultproject, runscenarios
+    from numpy import allclose
+    
+    P = defaultproject('concentrated', dorun=False, verbose=0)
+    scenlist = [
+        Parscen(name='Baseline', parsetname='default', pars=[]),
+        Parscen(name='More testing', parsetname='default', pars=[{'name':'hivtest', 'for':['FSW','Clients'], 'startyear':2020., 'endyear':2025, 'endval':0.9}]),
+        Parscen(name='More treatment', parsetname='default', pars=[{'name':'proptx', 'for':'tot', 'startyear':2021., 'endyear':2027, 'endval':0.9}]),
+        ]
+    P.addscens(scenlist)
+    full   = runscenarios(P, branch=False, keepraw=True, verbose=0)['scenarios']
+    branch = runscenarios(P, branch=True,  keepraw=True, verbose=0)['scenarios']
+    for fullraw,branchraw in zip(full.raw.values(), branch.raw.values()):
+        assert sorted(fullraw[0].keys()) == sorted(branchraw[0].keys())
+        for key in ['people', 'inci', 'diag', 'newtreat', 'death']:
+            assert allclose(fullraw[0][key], branchraw[0][key], rtol=1e-10, atol=0)
+    for key in full.main.keys():
+        assert allclose(full.main[key].tot[0], branch.main[key].tot[0], rtol=1e-10, atol=0, equal_nan=True)
+    
+    done(t)
+
+
+
+
+
 ## Set up project etc.
 if 'VMMC' in tests:
     t = tic()
@@ -11,6 +11,7 @@ Version: 2016jan05 by cliffk
 ## Define tests to run here!!!
 tests = [
 'odict',
+'smoothinterprows',
 'gridcolormap',
 ]
 
@@ -71,6 +72,25 @@ if 'odict' in tests:
 
 
 
+## Interpolating several rows together should be the same as one at a time
+if 'smoothinterprows' in tests:
+    t = tic()
+    
+    print('Running smoothinterprows test...')
+    from optima import smoothinterp, smoothinterprows
+    from numpy import linspace, nan, inf, allclose
+    
+    newx = linspace(1995, 2035, 201)
+    origxs = [[2000, 2010, 2020], [2015, 2005], [2010], [2000, 2005, 2010, 2015], [2000, 2010, 2020]]
+    origys = [[0.1, 0.5, 0.3],    [0.8, 0.2],   [0.4],  [0.1, nan, 0.3, inf],    [1e3, 5e3, 2e3]]
+    for smoothness in [0, 5]:
+        newys = smoothinterprows(newx, origxs, origys, smoothness=smoothness)
+        for r in range(len(origys)):
+            assert allclose(newys[r], smoothinterp(newx, origxs[r], origys[r], smoothness=smoothness), rtol=1e-12, atol=0, equal_nan=True)
+    done(t)
+
+
+
 ## gridcolormap test
 if 'gridcolormap' in tests and doplot:
     from mpl_toolkits.mplot3d import Axes3D # analysis:ignore